@@ -28,11 +28,19 @@ setup(
         'setuptools',
         'Flask',
         'lxml',
+        'numpy',
     ],
+    extras_require={
+        'ujson': ['ujson'],
+        'gevent': ['gunicorn', 'gevent'],
+        'prefork': ['gunicorn'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     get-xml = presence_analyzer.script:get_xml
+    presence-bench = presence_analyzer.benchmarks.harness:main
+    presence-load = presence_analyzer.benchmarks.load:main
     [paste.app_factory]
     main = presence_analyzer.script:make_app
     debug = presence_analyzer.script:make_debug
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregates of presence data of many users.
+
+Per user weekday aggregates are computed when the data is loaded, so
+group statistics are reductions over the users x weekdays table rather
+than over all entries. The table is kept as a single NumPy array and
+reduced in one vectorized call. Statistics of a range of days, and
+quantile sketches, are reduced straight from the store columns instead.
+"""
+
+import threading
+from array import array
+
+import numpy
+
+from presence_analyzer.sketch import QuantileSketch, RESOLUTION
+from presence_analyzer.store import WeekdayStats
+
+lock = threading.Lock()  # pylint: disable-msg=C0103
+
+
+def aggregate_table(store):
+    """
+    Returns (user positions, users x 7 x 4 array) of store's aggregates.
+
+    The table is built once per store.
+    """
+    with lock:
+        if 'aggregate_table' not in store.derived:
+            positions = {}
+            table = numpy.zeros((len(store), 7, 4), dtype=numpy.int64)
+            for i, (user_id, _, _, stats) in enumerate(store.users()):
+                positions[user_id] = i
+                table[i] = stats
+            store.derived['aggregate_table'] = positions, table
+        return store.derived['aggregate_table']
+
+
+def column_array(values):
+    """
+    Returns NumPy array of store column, without copying it when possible.
+    """
+    if isinstance(values, array):
+        return numpy.frombuffer(values, values.typecode)
+    return numpy.asarray(values)
+
+
+def column_mask(store, user_ids, first, last):
+    """
+    Returns boolean mask of store rows of given users (all of them for
+    None) from `first` to `last` day ordinal. Missing limits are not
+    applied.
+    """
+    days = column_array(store.days)
+    mask = numpy.ones(len(days), dtype=bool)
+    if first is not None:
+        mask &= days >= first
+    if last is not None:
+        mask &= days <= last
+    if user_ids is not None:
+        mask &= numpy.in1d(column_array(store.user_ids), list(user_ids))
+    return mask
+
+
+def range_totals(store, user_ids, first, last):
+    """
+    Returns 7 x 4 array of aggregates of given users' entries from `first`
+    to `last` day ordinal, reduced straight from the store columns.
+    """
+    mask = column_mask(store, user_ids, first, last)
+    weekdays = (column_array(store.days)[mask] - 1) % 7
+    starts = column_array(store.starts)[mask].astype(numpy.int64)
+    ends = column_array(store.ends)[mask].astype(numpy.int64)
+    totals = numpy.zeros((7, 4), dtype=numpy.int64)
+    totals[:, 0] = numpy.bincount(weekdays, minlength=7)
+    for i, weights in enumerate((ends - starts, starts, ends), 1):
+        totals[:, i] = numpy.bincount(weekdays, weights, minlength=7)
+    return totals
+
+
+def weekday_histograms(weekdays, values):
+    """
+    Returns seven QuantileSketch objects of values, Monday first, counted
+    in a single weekday x bucket histogram.
+    """
+    buckets = values // RESOLUTION
+    width = int(buckets.max()) + 1 if len(buckets) else 1
+    table = numpy.bincount(weekdays * width + buckets,
+                           minlength=7 * width).reshape(7, width)
+    sketches = []
+    for counts in table:
+        used = numpy.flatnonzero(counts)
+        if not len(used):
+            sketches.append(QuantileSketch())
+            continue
+        first, last = used[0], used[-1] + 1
+        sketches.append(QuantileSketch(
+            int(first), array('i', counts[first:last].tolist()),
+            int(counts.sum())))
+    return sketches
+
+
+def column_sketches(store, user_ids, first, last):
+    """
+    Returns list of seven (start, end) QuantileSketch pairs of given
+    users' entries from `first` to `last` day ordinal, counted straight
+    from the store columns.
+    """
+    mask = column_mask(store, user_ids, first, last)
+    weekdays = (column_array(store.days)[mask].astype(numpy.int64) - 1) % 7
+    starts, ends = [
+        weekday_histograms(
+            weekdays, column_array(values)[mask].astype(numpy.int64))
+        for values in (store.starts, store.ends)]
+    return zip(starts, ends)
+
+
+def group_weekday_stats(store, user_ids=None, first=None, last=None):
+    """
+    Returns list of seven WeekdayStats summed over given users.
+
+    All users are taken when `user_ids` is None, unknown ones are skipped.
+    Optional `first` and `last` day ordinals limit entries to that range.
+    Stores aggregating on their own (see backends.SQLiteStore) are asked
+    to do it.
+    """
+    if hasattr(store, 'group_weekday_stats'):
+        return store.group_weekday_stats(user_ids, first, last)
+    if first is None and last is None:
+        positions, table = aggregate_table(store)
+        if user_ids is None:
+            totals = table.sum(axis=0)
+        else:
+            rows = [positions[user_id] for user_id in user_ids
+                    if user_id in positions]
+            totals = table[rows].sum(axis=0)
+    else:
+        totals = range_totals(store, user_ids, first, last)
+    return [WeekdayStats(*[int(value) for value in stats])
+            for stats in totals]
+
+
+def group_weekday_sketches(store, user_ids=None, first=None, last=None):
+    """
+    Returns list of seven (start, end) QuantileSketch pairs merged over
+    given users.
+
+    All users are taken when `user_ids` is None, unknown ones are skipped.
+    Optional `first` and `last` day ordinals limit entries to that range.
+    Sketches of all entries are counted once per store.
+    """
+    if hasattr(store, 'group_weekday_sketches'):
+        return store.group_weekday_sketches(user_ids, first, last)
+    if user_ids is None and first is None and last is None:
+        with lock:
+            if 'office_sketches' not in store.derived:
+                store.derived['office_sketches'] = column_sketches(
+                    store, None, None, None)
+            return store.derived['office_sketches']
+    return column_sketches(store, user_ids, first, last)
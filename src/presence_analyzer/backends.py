@@ -0,0 +1,569 @@
+# -*- coding: utf-8 -*-
+"""
+Storage backends of presence data.
+
+Backend loads DATA_CSV files and returns a store: mapping of user ids to
+UserPresence views, with `ids` and `source` attributes and
+weekday_stats and weekday_sketches methods, see PresenceStore.
+
+MemoryBackend keeps PresenceStore in memory of every worker.
+SQLiteBackend keeps entries in an embedded database and answers queries,
+group ones included, with SQL, so memory of workers does not grow with
+the history. LazyBackend reads entries of a user from the CSV files only
+when they are asked for, see lazy.py.
+"""
+
+import os
+import sqlite3
+import threading
+from array import array
+from collections import Mapping
+from contextlib import contextmanager
+from datetime import date
+from itertools import islice
+
+from presence_analyzer.caching import keyed_cache
+from presence_analyzer.ingest import (DatasetLoader, data_files,
+                                      dataset_source, is_appended,
+                                      is_unchanged, parse_lines)
+from presence_analyzer.lazy import load_index, user_ranges
+from presence_analyzer.sketch import QuantileSketch, RESOLUTION
+from presence_analyzer.snapshot import CHECK_SIZE
+from presence_analyzer.store import PresenceStore, WeekdayStats, weekday
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# amount of lines inserted with a single executemany call
+BATCH_SIZE = 10000
+
+# amount of user ids bound to a single query
+IDS_PER_QUERY = 500
+
+# seconds a connection waits for the database locked by another process,
+# which may be rebuilding it
+BUSY_TIMEOUT = 600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS presence (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    weekday INTEGER NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS files (
+    position INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    offset INTEGER NOT NULL,
+    lines INTEGER NOT NULL,
+    checked BLOB NOT NULL
+);
+"""
+
+WEEKDAY_INDEX = """
+CREATE INDEX IF NOT EXISTS presence_weekday
+ON presence (user_id, weekday, day)
+"""
+
+INSERT = 'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?, ?)'
+
+# amount of users whose entries LazyStore keeps parsed
+LAZY_USERS = 1000
+
+
+class Backend(object):
+    """
+    Interface of storage backends.
+    """
+
+    def load(self, config):
+        """
+        Returns store with up to date contents of DATA_CSV files, set up
+        by given application config.
+        """
+        raise NotImplementedError
+
+
+class MemoryBackend(Backend):
+    """
+    Backend keeping PresenceStore in memory, see ingest.DatasetLoader.
+    """
+
+    def __init__(self):
+        self.loader = DatasetLoader()
+
+    def load(self, config):
+        return self.loader.load(config['DATA_CSV'],
+                                snapshot=config.get('DATA_SNAPSHOT', False),
+                                processes=config.get('DATA_PROCESSES', 1))
+
+
+def default_database(pattern):
+    """
+    Returns path of database kept next to DATA_CSV files.
+    """
+    directory = pattern if os.path.isdir(pattern) else \
+        os.path.dirname(pattern)
+    return os.path.join(directory, 'presence.sqlite')
+
+
+def insert_file(connection, path, stat, state):
+    """
+    Inserts entries of file from the offset of given state up to its
+    size, in batches. State is updated like in CSVLoader.
+    """
+    position = state['offset']
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(position)
+        while position < stat.st_size:
+            first_line = state['lines']
+            batch = []
+            for line in islice(csvfile, BATCH_SIZE):
+                line = line[:stat.st_size - position]
+                position += len(line)
+                batch.append(line)
+                if line.endswith('\n'):
+                    state['offset'] = position
+                    state['lines'] += 1
+                if position >= stat.st_size:
+                    break
+            if not batch:
+                break
+            connection.executemany(INSERT, (
+                (user_id, day, weekday(day), start, end)
+                for user_id, day, start, end
+                in parse_lines(batch, first_line)))
+        csvfile.seek(max(state['offset'] - CHECK_SIZE, 0))
+        state['check'] = csvfile.read(min(state['offset'], CHECK_SIZE))
+    state['inode'] = stat.st_ino
+    state['size'] = stat.st_size
+    state['mtime'] = stat.st_mtime
+
+
+def read_states(connection):
+    """
+    Returns states of files loaded into the database, in their order.
+    """
+    return [dict(zip(
+        ('path', 'inode', 'size', 'mtime', 'offset', 'lines', 'check'),
+        row[:-1] + (str(row[-1]),)))
+        for row in connection.execute(
+            'SELECT path, inode, size, mtime, offset, lines, checked '
+            'FROM files ORDER BY position')]
+
+
+def is_current(paths, stats, states):
+    """
+    Tells whether files of given states are given files, unchanged.
+    """
+    return [state['path'] for state in states] == paths and all(
+        is_unchanged(stat, state) for stat, state in zip(stats, states))
+
+
+@contextmanager
+def transaction(connection):
+    """
+    Runs the block in a transaction, committed unless it raises.
+    """
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except:  # pylint: disable-msg=W0702
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+class SQLiteBackend(Backend):
+    """
+    Backend keeping entries in SQLite database DATA_DATABASE (by default
+    presence.sqlite next to DATA_CSV files).
+
+    The database remembers up to where every file was loaded. Lines
+    appended to the last file are inserted, any other change rebuilds
+    the table. Entries are inserted with executemany in batches, all in
+    a single transaction, with the secondary index dropped while the
+    table is rebuilt. Processes loading the same database wait for each
+    other for up to BUSY_TIMEOUT seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.store = None
+
+    def connect(self, database):
+        """
+        Returns connection used for loading given database.
+        """
+        if database not in self.connections:
+            # transactions are managed explicitly, see transaction
+            connection = sqlite3.connect(database, timeout=BUSY_TIMEOUT,
+                                         check_same_thread=False,
+                                         isolation_level=None)
+            connection.text_factory = str
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            connection.executescript(SCHEMA)
+            connection.execute(WEEKDAY_INDEX)
+            self.connections[database] = connection
+        return self.connections[database]
+
+    def load(self, config):
+        pattern = config['DATA_CSV']
+        database = config.get('DATA_DATABASE') or default_database(pattern)
+        with self.lock:
+            connection = self.connect(database)
+            paths = data_files(pattern)
+            stats = [os.stat(path) for path in paths]
+            if not is_current(paths, stats, read_states(connection)):
+                self.update(connection, paths, stats)
+            source = dataset_source(tuple(
+                (stat.st_ino, stat.st_size, stat.st_mtime) for stat in stats))
+            if self.store is None or self.store.database != database or \
+                    self.store.source != source:
+                self.store = SQLiteStore(database, source)
+            return self.store
+
+    def update(self, connection, paths, stats):
+        """
+        Inserts appended lines or rebuilds the table from given files.
+
+        Other processes may load the same database: states of files are
+        read again once the write lock is taken, and nothing is done when
+        one of them has already brought the database up to date.
+        """
+        with transaction(connection):
+            states = read_states(connection)
+            if is_current(paths, stats, states):
+                return
+            known = [state['path'] for state in states] == paths
+            changed = [not is_unchanged(stat, state)
+                       for stat, state in zip(stats, states)]
+            if known and not any(changed[:-1]) and is_appended(
+                    paths[-1], stats[-1], states[-1]):
+                insert_file(connection, paths[-1], stats[-1], states[-1])
+            else:
+                states = self.rebuild(connection, paths, stats)
+            connection.execute('DELETE FROM files')
+            connection.executemany(
+                'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(i, state['path'], state['inode'], state['size'],
+                  state['mtime'], state['offset'], state['lines'],
+                  sqlite3.Binary(state['check']))
+                 for i, state in enumerate(states)])
+
+    @staticmethod
+    def rebuild(connection, paths, stats):
+        """
+        Loads all files into emptied table. Returns states of the files.
+        """
+        log.debug('Full reload of %s', ', '.join(paths))
+        connection.execute('DROP INDEX IF EXISTS presence_weekday')
+        connection.execute('DELETE FROM presence')
+        states = []
+        for path, stat in zip(paths, stats):
+            state = {'path': path, 'offset': 0, 'lines': 0, 'check': ''}
+            insert_file(connection, path, stat, state)
+            states.append(state)
+        connection.execute(WEEKDAY_INDEX)
+        return states
+
+
+def sketches_from_counts(rows):
+    """
+    Creates seven QuantileSketch objects, Monday first, out of
+    (weekday, bucket, count) rows.
+    """
+    buckets = [[] for _ in range(7)]
+    for day, bucket, count in rows:
+        buckets[day].append((bucket, count))
+    sketches = []
+    for counts in buckets:
+        if not counts:
+            sketches.append(QuantileSketch())
+            continue
+        first = min(bucket for bucket, _ in counts)
+        last = max(bucket for bucket, _ in counts)
+        values = array('i', [0]) * (last - first + 1)
+        for bucket, count in counts:
+            values[bucket - first] += count
+        sketches.append(QuantileSketch(first, values,
+                                       sum(count for _, count in counts)))
+    return sketches
+
+
+class SQLiteStore(Mapping):
+    """
+    Store answering queries from SQLite database of SQLiteBackend.
+
+    Only the set of user ids is kept in memory. Every thread uses its own
+    connection.
+    """
+
+    def __init__(self, database, source):
+        self.database = database
+        self.source = source
+        self.derived = {}
+        self.local = threading.local()
+        self.ids = frozenset(
+            user_id for user_id, in self.query(
+                'SELECT DISTINCT user_id FROM presence'))
+
+    def query(self, sql, parameters=()):
+        """
+        Returns all rows of the query.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(
+                self.database, timeout=BUSY_TIMEOUT)
+        return connection.execute(sql, parameters).fetchall()
+
+    def group_query(self, sql, user_ids, parameters=()):
+        """
+        Returns rows of query run for given users, or all users when
+        `user_ids` is None. The query has '{users}' placeholder for the
+        condition, followed by placeholders of `parameters`, and is run
+        once per IDS_PER_QUERY users.
+        """
+        if user_ids is None:
+            return self.query(sql.format(users='1'), parameters)
+        user_ids = sorted(set(user_ids) & self.ids)
+        rows = []
+        for i in xrange(0, len(user_ids), IDS_PER_QUERY):
+            chunk = user_ids[i:i + IDS_PER_QUERY]
+            rows += self.query(sql.format(users='user_id IN ({0})'.format(
+                ', '.join('?' * len(chunk)))), tuple(chunk) + parameters)
+        return rows
+
+    def weekday_stats(self, user_id, first=None, last=None):
+        """
+        Returns list of seven WeekdayStats of given user, Monday first.
+        """
+        return self.group_weekday_stats([user_id], first, last)
+
+    def weekday_sketches(self, user_id, first=None, last=None):
+        """
+        Returns list of seven (start, end) QuantileSketch pairs of given
+        user, Monday first.
+        """
+        return self.group_weekday_sketches([user_id], first, last)
+
+    def group_weekday_stats(self, user_ids=None, first=None, last=None):
+        """
+        Returns list of seven WeekdayStats summed over given users (all of
+        them for None), see aggregate.group_weekday_stats.
+        """
+        first = 0 if first is None else first
+        last = date.max.toordinal() if last is None else last
+        totals = [[0, 0, 0, 0] for _ in range(7)]
+        for row in self.group_query(
+                'SELECT weekday, COUNT(*), SUM(end_time - start_time), '
+                'SUM(start_time), SUM(end_time) FROM presence '
+                'WHERE {users} AND day BETWEEN ? AND ? GROUP BY weekday',
+                user_ids, (first, last)):
+            for i, value in enumerate(row[1:]):
+                totals[row[0]][i] += value
+        return [WeekdayStats(*stats) for stats in totals]
+
+    def group_weekday_sketches(self, user_ids=None, first=None, last=None):
+        """
+        Returns list of seven (start, end) QuantileSketch pairs merged over
+        given users (all of them for None).
+        """
+        first = 0 if first is None else first
+        last = date.max.toordinal() if last is None else last
+        sketches = []
+        for name in ('start_time', 'end_time'):
+            rows = self.group_query(
+                'SELECT weekday, {0} / {1} AS bucket, COUNT(*) FROM presence '
+                'WHERE {{users}} AND day BETWEEN ? AND ? '
+                'GROUP BY weekday, bucket'.format(name, RESOLUTION),
+                user_ids, (first, last))
+            sketches.append(sketches_from_counts(rows))
+        return zip(*sketches)
+
+    def __getitem__(self, user_id):
+        if user_id not in self.ids:
+            raise KeyError(user_id)
+        return PresenceStore.from_rows(
+            (user_id, day, start, end) for day, start, end in self.query(
+                'SELECT day, start_time, end_time FROM presence '
+                'WHERE user_id = ? ORDER BY day', (user_id,)))[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self.ids
+
+    def __iter__(self):
+        return iter(sorted(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class LazyBackend(Backend):
+    """
+    Backend parsing entries of a user only when they are asked for.
+
+    Every file gets a sidecar index of byte ranges of users' lines (see
+    lazy.py), built once and extended when lines are appended. Entries of
+    at most DATA_LAZY_USERS (LAZY_USERS by default) recently used users
+    are kept parsed, so memory of workers depends on the amount of active
+    users rather than on the history.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexes = {}
+        self.max_users = None
+        self.load_user = None
+        self.store = None
+
+    def load(self, config):
+        with self.lock:
+            paths = data_files(config['DATA_CSV'])
+            stats = [os.stat(path) for path in paths]
+            rewritten = bool(set(self.indexes) - set(paths))
+            indexes = {}
+            for path, stat in zip(paths, stats):
+                index = self.indexes.get(path)
+                if index is not None and not is_unchanged(stat, index) and \
+                        not is_appended(path, stat, index):
+                    rewritten = True
+                indexes[path] = load_index(path, stat, index)
+            self.indexes = indexes
+            max_users = config.get('DATA_LAZY_USERS', LAZY_USERS)
+            if self.max_users != max_users:
+                self.max_users = max_users
+                self.load_user = lazy_user_stores(max_users)
+            elif rewritten:
+                # parsed users are cached by byte ranges, which lines of
+                # a rewritten or removed and recreated file may take again
+                self.load_user.invalidate_all()
+            source = dataset_source(tuple(
+                (stat.st_ino, stat.st_size, stat.st_mtime) for stat in stats))
+            if self.store is None or self.store.source != source or \
+                    self.store.load_user is not self.load_user:
+                self.store = LazyStore(
+                    user_ranges((path, self.indexes[path]) for path in paths),
+                    source, self.load_user)
+            return self.store
+
+
+def read_ranges(ranges):
+    """
+    Parses (path, begin, end) byte ranges of files into list of
+    (user_id, day, start, end) tuples, in the order of ranges.
+    """
+    rows = []
+    for path, begin, end in ranges:
+        with open(path, 'rb') as csvfile:
+            csvfile.seek(begin)
+            rows += parse_lines(csvfile.read(end - begin).splitlines(True))
+    return rows
+
+
+def lazy_user_stores(max_users):
+    """
+    Returns function parsing byte ranges of a user into PresenceStore,
+    which keeps `max_users` recently used stores, see caching.keyed_cache.
+    """
+    @keyed_cache(None, max_entries=max_users)
+    def lazy_user_store(ranges):
+        """
+        Returns PresenceStore of entries in given byte ranges.
+        """
+        # later files win for the same day, like in PresenceStore.from_rows
+        return PresenceStore.from_rows(read_ranges(ranges))
+    return lazy_user_store
+
+
+class LazyStore(Mapping):
+    """
+    Store reading entries of a user from byte ranges of CSV files on the
+    first use.
+
+    Entries of every user are parsed into PresenceStore of their own by
+    `load_user` (see lazy_user_stores). Stores of the same backend share
+    it, so users whose ranges did not change are not parsed again.
+    """
+
+    def __init__(self, ranges, source, load_user):
+        self.ranges = ranges
+        self.source = source
+        self.load_user = load_user
+        self.derived = {}
+        self.ids = frozenset(ranges)
+
+    def user_store(self, user_id):
+        """
+        Returns PresenceStore of given user's entries.
+        """
+        return self.load_user(self.ranges[user_id])
+
+    def cache_info(self):
+        """
+        Returns counters of the cache of parsed users.
+        """
+        return self.load_user.cache_info()
+
+    def weekday_stats(self, user_id, first=None, last=None):
+        """
+        Returns list of seven WeekdayStats of given user, Monday first.
+        """
+        return self.user_store(user_id).weekday_stats(user_id, first, last)
+
+    def weekday_sketches(self, user_id, first=None, last=None):
+        """
+        Returns list of seven (start, end) QuantileSketch pairs of given
+        user, Monday first.
+        """
+        return self.user_store(user_id).weekday_sketches(user_id, first,
+                                                         last)
+
+    def group_weekday_stats(self, user_ids=None, first=None, last=None):
+        """
+        Returns list of seven WeekdayStats summed over given users (all of
+        them for None), see aggregate.group_weekday_stats.
+        """
+        totals = [[0, 0, 0, 0] for _ in range(7)]
+        for user_id in self.ids if user_ids is None else user_ids:
+            if user_id not in self.ids:
+                continue
+            for day, stats in enumerate(
+                    self.weekday_stats(user_id, first, last)):
+                for i, value in enumerate(stats):
+                    totals[day][i] += value
+        return [WeekdayStats(*stats) for stats in totals]
+
+    def group_weekday_sketches(self, user_ids=None, first=None, last=None):
+        """
+        Returns list of seven (start, end) QuantileSketch pairs merged over
+        given users (all of them for None).
+        """
+        pairs = [self.weekday_sketches(user_id, first, last)
+                 for user_id in (self.ids if user_ids is None else user_ids)
+                 if user_id in self.ids]
+        return [(QuantileSketch.merged(user[day][0] for user in pairs),
+                 QuantileSketch.merged(user[day][1] for user in pairs))
+                for day in range(7)]
+
+    def __getitem__(self, user_id):
+        if user_id not in self.ids:
+            raise KeyError(user_id)
+        return self.user_store(user_id)[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self.ids
+
+    def __iter__(self):
+        return iter(sorted(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
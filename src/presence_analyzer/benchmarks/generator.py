@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Deterministic generator of large presence CSV and users XML files.
+
+The same arguments always produce the same files, so benchmark results
+of different runs can be compared.
+
+Usage: python -m presence_analyzer.benchmarks.generator DIRECTORY
+           [--users N] [--years N] [--seed N]
+"""
+
+import argparse
+import os
+import random
+from datetime import date, timedelta
+from xml.sax.saxutils import escape
+
+FIRST_DAY = date(2010, 1, 4)
+FIRST_NAMES = ('Adam', 'Agata', 'Dawid', 'Ewa', 'Łukasz', 'Maciej', 'Marta',
+               'Piotr', 'Zofia', 'Żaneta')
+LETTERS = 'ABCDEFGHIJKLMNOPRSTUWZŁŚŻ'.decode('utf-8')
+
+
+def format_time(seconds):
+    """
+    Formats amount of seconds since midnight as HH:MM:SS.
+    """
+    return '{0:02d}:{1:02d}:{2:02d}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def user_rows(user_id, days, rng):
+    """
+    Yields CSV lines of single user: working days with some absences,
+    start around a personal habit and about eight hours of work.
+    """
+    habit = rng.randint(7 * 3600, 10 * 3600)
+    for offset in xrange(days):
+        day = FIRST_DAY + timedelta(days=offset)
+        if day.weekday() > 4 and rng.random() > 0.02:
+            continue
+        if rng.random() < 0.08:
+            continue
+        start = min(max(int(rng.gauss(habit, 1200)), 0), 14 * 3600)
+        end = min(start + int(rng.gauss(8 * 3600, 2400)), 86399)
+        yield '{0},{1},{2},{3}\n'.format(
+            user_id, day, format_time(start), format_time(max(end, start)))
+
+
+def write_csv(path, users=10000, years=5, seed=0):
+    """
+    Writes presence CSV file, rows grouped by user. Returns amount of rows.
+    """
+    rng = random.Random(seed)
+    days = years * 365
+    rows = 0
+    with open(path, 'w') as csvfile:
+        for user_id in xrange(1, users + 1):
+            for line in user_rows(user_id, days, rng):
+                csvfile.write(line)
+                rows += 1
+    return rows
+
+
+def write_users_xml(path, users=10000, seed=0):
+    """
+    Writes users XML file in intranet export format.
+    """
+    rng = random.Random(seed)
+    with open(path, 'w') as xml_file:
+        xml_file.write('<?xml version="1.0" encoding="UTF-8" ?>\n'
+                       '<intranet>\n'
+                       '    <server>\n'
+                       '        <host>intranet.example.com</host>\n'
+                       '        <port>443</port>\n'
+                       '        <protocol>https</protocol>\n'
+                       '    </server>\n'
+                       '    <users>\n')
+        for user_id in xrange(1, users + 1):
+            name = u'{0} {1}.'.format(rng.choice(FIRST_NAMES).decode('utf-8'),
+                                      rng.choice(LETTERS))
+            xml_file.write(
+                '        <user id="{0}">\n'
+                '            <avatar>/api/images/users/{0}</avatar>\n'
+                '            <name>{1}</name>\n'
+                '        </user>\n'.format(user_id,
+                                           escape(name).encode('utf-8')))
+        xml_file.write('    </users>\n'
+                       '</intranet>\n')
+
+
+def generate(directory, users=10000, years=5, seed=0):
+    """
+    Writes data.csv and users.xml into given directory.
+
+    Returns (csv path, xml path, amount of rows).
+    """
+    csv_path = os.path.join(directory, 'data.csv')
+    xml_path = os.path.join(directory, 'users.xml')
+    rows = write_csv(csv_path, users, years, seed)
+    write_users_xml(xml_path, users, seed)
+    return csv_path, xml_path, rows
+
+
+def main(argv=None):
+    """
+    Generates files into directory given on command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('directory')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    _, _, rows = generate(args.directory, args.users, args.years, args.seed)
+    print 'Generated {0} rows of {1} users.'.format(rows, args.users)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of data loading, grouping helpers and API views.
+
+Generates (or reuses) a dataset, times every case and saves results as
+JSON, optionally comparing them with results of a previous run.
+
+Usage: python -m presence_analyzer.benchmarks.harness [--users N]
+           [--years N] [--seed N] [--data DIRECTORY] [--output FILE]
+           [--compare FILE]
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from presence_analyzer import ingest, main as app_main, utils
+from presence_analyzer.benchmarks.generator import generate
+
+# amount of users whose statistics are requested from each API view
+SAMPLE_USERS = 50
+
+VIEWS = (
+    '/api/v1/users',
+    '/api/v2/users',
+    '/api/v1/mean_time_weekday/{0}',
+    '/api/v1/presence_weekday/{0}',
+    '/api/v1/presence_start_end/{0}',
+    '/api/v1/presence_start_end_percentiles/{0}',
+    '/api/v1/presence_weekday/{0}?from=2011-01-01&to=2011-12-31',
+    '/api/v1/batch?metrics=presence_weekday',
+    '/api/v1/office/presence_start_end',
+    '/api/v1/export?users={0}',
+)
+
+
+def peak_memory():
+    """
+    Returns peak resident memory of the process in kilobytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def measure(name, function, repeat=1, items=1):
+    """
+    Calls function `repeat` times and returns result dictionary.
+
+    `items` is amount of work units (rows, users, requests) done by
+    a single call, used for throughput.
+    """
+    memory_before = peak_memory()
+    started = time.time()
+    for _ in xrange(repeat):
+        function()
+    wall = time.time() - started
+    result = {
+        'name': name,
+        'calls': repeat,
+        'wall_time': wall,
+        'mean_time': wall / repeat,
+        'throughput': items * repeat / wall if wall else None,
+        'peak_memory_kb': peak_memory(),
+        'peak_memory_growth_kb': peak_memory() - memory_before,
+    }
+    print '{name:60} {mean_time:10.4f} s {peak_memory_kb:10d} kB'.format(
+        **result)
+    return result
+
+
+def run(csv_path, xml_path, rows):
+    """
+    Runs all benchmark cases against given data files.
+    """
+    app_main.app.config.update({
+        'DATA_CSV': csv_path,
+        'USERS_XML': xml_path,
+        'DATA_SNAPSHOT': False,
+    })
+    results = [
+        measure('parse csv', lambda: ingest.CSVLoader().load(csv_path),
+                items=rows),
+        measure('parse csv (all CPUs)',
+                lambda: ingest.CSVLoader().load(csv_path, processes=None),
+                items=rows),
+        measure('get_data (cold)', utils.get_data, items=rows),
+        measure('get_data (warm)', utils.get_data, repeat=1000),
+        measure('get_users_from_xml (cold)', utils.get_users_from_xml),
+        measure('get_users_from_xml (warm)', utils.get_users_from_xml,
+                repeat=100),
+    ]
+    data = utils.get_data()
+    users = list(data)
+    sample = users[:SAMPLE_USERS]
+    results += [
+        measure('group_by_weekday (all users)',
+                lambda: [utils.group_by_weekday(data[i]) for i in users],
+                items=len(users)),
+        measure('group_by_start_end (all users)',
+                lambda: [utils.group_by_start_end(data[i]) for i in users],
+                items=len(users)),
+    ]
+    client = app_main.app.test_client()
+    for view in VIEWS:
+        urls = [view.format(user_id) for user_id in sample] \
+            if '{0}' in view else [view] * 10
+
+        def request_all(urls=urls):
+            """
+            Requests every url once.
+            """
+            for url in urls:
+                assert client.get(url).status_code == 200, url
+        results.append(measure('GET ' + view, request_all, items=len(urls)))
+    return results
+
+
+def compare(results, previous):
+    """
+    Prints mean time changes against results of a previous run.
+    """
+    before = dict((case['name'], case) for case in previous['results'])
+    for case in results:
+        if case['name'] not in before:
+            continue
+        old = before[case['name']]['mean_time']
+        change = (case['mean_time'] - old) / old * 100 if old else 0
+        print '{0:60} {1:+8.1f} %'.format(case['name'], change)
+
+
+def main(argv=None):
+    """
+    Runs the benchmark suite.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data', help='keep generated files there')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='results of a previous run')
+    args = parser.parse_args(argv)
+
+    directory = args.data or tempfile.mkdtemp()
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        started = time.time()
+        csv_path, xml_path, rows = generate(directory, args.users,
+                                            args.years, args.seed)
+        print 'Generated {0} rows in {1:.1f} s'.format(
+            rows, time.time() - started)
+        results = run(csv_path, xml_path, rows)
+    finally:
+        if not args.data:
+            shutil.rmtree(directory)
+
+    report = {
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'users': args.users,
+        'years': args.years,
+        'seed': args.seed,
+        'rows': rows,
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the fast CSV ingest path with the old strptime based parser.
+
+Usage: python -m presence_analyzer.benchmarks.ingest [ROWS] [PATH]
+
+ROWS is approximate, the file is generated with benchmarks.generator.
+"""
+
+import csv
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from presence_analyzer.benchmarks.generator import write_csv
+from presence_analyzer.ingest import parse_lines
+from presence_analyzer.store import PresenceStore
+
+
+def legacy_parse(path):
+    """
+    The original get_data parser, kept for comparison.
+    """
+    data = {}
+    with open(path, 'r') as csvfile:
+        presence_reader = csv.reader(csvfile, delimiter=',')
+        for row in presence_reader:
+            if len(row) != 4:
+                continue
+            try:
+                user_id = int(row[0])
+                day = datetime.strptime(row[1], '%Y-%m-%d').date()
+                start = datetime.strptime(row[2], '%H:%M:%S').time()
+                end = datetime.strptime(row[3], '%H:%M:%S').time()
+            except (ValueError, TypeError):
+                continue
+            data.setdefault(user_id, {})[day] = {'start': start, 'end': end}
+    return data
+
+
+def fast_parse(path):
+    """
+    The current get_data parser.
+    """
+    with open(path, 'r') as csvfile:
+        return PresenceStore.from_rows(parse_lines(csvfile))
+
+
+def measure(function, *args):
+    """
+    Returns wall time of single call in seconds and its result.
+    """
+    started = time.time()
+    result = function(*args)
+    return time.time() - started, result
+
+
+def main(argv=None):
+    """
+    Runs the benchmark and prints timings.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    rows = int(argv[0]) if argv else 2000000
+    if len(argv) > 1:
+        path, cleanup = argv[1], False
+    else:
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        cleanup = True
+    try:
+        if not os.path.exists(path) or cleanup:
+            # five years give about 1170 rows per user
+            write_csv(path, users=max(rows // 1170, 1), years=5)
+        legacy, _ = measure(legacy_parse, path)
+        fast, store = measure(fast_parse, path)
+    finally:
+        if cleanup:
+            os.remove(path)
+    # rows actually parsed, also when an existing file was given
+    rows = len(store.days)
+    print 'rows:   {0}'.format(rows)
+    print 'legacy: {0:.2f} s ({1:.0f} rows/s)'.format(legacy, rows / legacy)
+    print 'fast:   {0:.2f} s ({1:.0f} rows/s)'.format(fast, rows / fast)
+    print 'speedup: {0:.1f}x'.format(legacy / fast)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of a running server, for comparing server modes.
+
+Many concurrent clients request API views for a given time. Slow clients
+send their requests in two parts with a pause in between, keeping
+connections (and threads of threadpool servers) busy. Results are saved
+as JSON, optionally comparing them with results of a previous run, e.g.
+of another server mode:
+
+    bin/flask-ctl serve fg --server threadpool
+    bin/presence-load --output threadpool.json
+    bin/flask-ctl serve fg --server gevent
+    bin/presence-load --output gevent.json --compare threadpool.json
+
+Usage: python -m presence_analyzer.benchmarks.load [--url URL]
+           [--clients N] [--slow-clients N] [--slow-pause SECONDS]
+           [--duration SECONDS] [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import json
+import platform
+import random
+import socket
+import threading
+import time
+from datetime import datetime
+from urlparse import urlsplit
+
+from presence_analyzer.benchmarks.harness import SAMPLE_USERS, VIEWS
+
+
+def exchange(host, port, path, pause=0):
+    """
+    Sends GET request over new connection and returns the whole response.
+
+    Request headers are sent in two parts, `pause` seconds apart.
+    """
+    connection = socket.create_connection((host, port), timeout=60)
+    try:
+        connection.sendall('GET {0} HTTP/1.0\r\nHost: {1}:{2}\r\n'.format(
+            path, host, port))
+        if pause:
+            time.sleep(pause)
+        connection.sendall('Connection: close\r\n\r\n')
+        return ''.join(iter(lambda: connection.recv(65536), ''))
+    finally:
+        connection.close()
+
+
+def status_code(response):
+    """
+    Returns status code of response, 0 for empty one.
+    """
+    return int(response.split(' ', 2)[1]) if response else 0
+
+
+def get_body(host, port, path):
+    """
+    Returns body of successful GET response.
+    """
+    response = exchange(host, port, path)
+    if status_code(response) != 200:
+        raise SystemExit('{0} answered: {1}'.format(
+            path, response.split('\r\n')[0]))
+    return response.partition('\r\n\r\n')[2]
+
+
+def percentile(values, fraction):
+    """
+    Returns given percentile of sorted values, None when there are none.
+    """
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def client(host, port, paths, deadline, pause, samples, lock):
+    """
+    Requests random paths until the deadline, recording (kind, latency,
+    status) samples.
+    """
+    kind = 'slow' if pause else 'fast'
+    while time.time() < deadline:
+        started = time.time()
+        try:
+            status = status_code(exchange(host, port, random.choice(paths),
+                                          pause))
+        except (socket.error, ValueError, IndexError):
+            status = 0
+        with lock:
+            samples.append((kind, time.time() - started, status))
+
+
+def summarize(kind, samples, duration):
+    """
+    Returns result dictionary of samples of given kind of clients.
+    """
+    latencies = sorted(latency for sample_kind, latency, status in samples
+                       if sample_kind == kind and status == 200)
+    errors = sum(1 for sample_kind, _, status in samples
+                 if sample_kind == kind and status != 200)
+    result = {
+        'name': '{0} clients'.format(kind),
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / duration,
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+    }
+    print '{name:20} {requests:8d} req {errors:6d} err ' \
+        '{throughput:10.1f} req/s p90 {p90} s'.format(**result)
+    return result
+
+
+def run(url, clients, slow_clients, slow_pause, duration):
+    """
+    Runs the load test against server at given url.
+    """
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    base = parts.path.rstrip('/')
+    user_ids = [user['user_id'] for user in json.loads(
+        get_body(host, port, base + '/api/v1/users'))][:SAMPLE_USERS]
+    paths = [base + view.format(user_id)
+             for view in VIEWS for user_id in user_ids]
+    samples = []
+    lock = threading.Lock()
+    deadline = time.time() + duration
+    threads = [
+        threading.Thread(target=client, args=(
+            host, port, paths, deadline, slow_pause if i < slow_clients
+            else 0, samples, lock))
+        for i in xrange(clients + slow_clients)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [summarize(kind, samples, duration)
+            for kind in ('fast', 'slow') if slow_clients or kind == 'fast']
+
+
+def compare(results, previous):
+    """
+    Prints throughput and 90th percentile latency changes against results
+    of a previous run.
+    """
+    before = dict((case['name'], case) for case in previous['results'])
+    for case in results:
+        if case['name'] not in before:
+            continue
+        old = before[case['name']]
+        changes = []
+        for key in ('throughput', 'p90'):
+            if old[key] and case[key] is not None:
+                changes.append((case[key] - old[key]) / old[key] * 100)
+            else:
+                changes.append(0)
+        print '{0:20} throughput {1:+8.1f} %  p90 {2:+8.1f} %'.format(
+            case['name'], *changes)
+
+
+def main(argv=None):
+    """
+    Runs the load test.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://localhost:8080/')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--slow-clients', type=int, default=200)
+    parser.add_argument('--slow-pause', type=float, default=1.0)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--output', default='load_results.json')
+    parser.add_argument('--compare', help='results of a previous run')
+    args = parser.parse_args(argv)
+
+    results = run(args.url, args.clients, args.slow_clients,
+                  args.slow_pause, args.duration)
+    report = {
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'url': args.url,
+        'clients': args.clients,
+        'slow_clients': args.slow_clients,
+        'slow_pause': args.slow_pause,
+        'duration': args.duration,
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Caching of function results per call arguments, with least recently used
+values evicted first.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+
+# separates positional and keyword arguments in keyed_cache keys
+KWARGS_MARK = object()
+
+
+def approximate_size(value, seen=None):
+    """
+    Estimates amount of memory used by value and objects it contains.
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approximate_size(key, seen) + approximate_size(item, seen)
+                    for key, item in value.iteritems())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(item, seen) for item in value)
+    return size
+
+
+def keyed_cache(time_in_sec, max_entries=None, max_bytes=None):
+    """
+    Creates cache decorator keeping separate value for each call arguments.
+
+    Values expire after `time_in_sec` seconds, never when it is None.
+    Least recently used values are evicted once there are more than
+    `max_entries` of them or their approximate size exceeds `max_bytes`.
+    Decorated function gets invalidate(*args, **kwargs) to forget single
+    value, invalidate_all() to start new generation of values and
+    cache_info() returning counters.
+    """
+    def wrap(function):
+        lock = threading.Lock()
+        function._cache = {
+            'entries': OrderedDict(),
+            'bytes': 0,
+            'generation': 0,
+            'stats': {
+                'hits': 0,
+                'misses': 0,
+                'evictions': 0,
+            },
+        }
+        entries = function._cache['entries']
+        stats = function._cache['stats']
+
+        def make_key(args, kwargs):
+            """
+            Creates hashable key of call arguments.
+            """
+            if kwargs:
+                return args + (KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+            return args
+
+        def forget(key):
+            """
+            Removes single entry, must be called with lock held.
+            """
+            _, _, size = entries.pop(key)
+            function._cache['bytes'] -= size
+
+        @wraps(function)
+        def inner(*args, **kwargs):
+            key = make_key(args, kwargs)
+            with lock:
+                if key in entries:
+                    data, timeout, size = entries.pop(key)
+                    if datetime.now() < timeout:
+                        entries[key] = (data, timeout, size)
+                        stats['hits'] += 1
+                        return data
+                    function._cache['bytes'] -= size
+                stats['misses'] += 1
+                generation = function._cache['generation']
+
+            data = function(*args, **kwargs)
+            size = approximate_size(data)
+            timeout = datetime.max if time_in_sec is None else \
+                datetime.now() + timedelta(seconds=time_in_sec)
+            with lock:
+                if generation != function._cache['generation'] or \
+                        (max_bytes is not None and size > max_bytes):
+                    return data
+                if key in entries:
+                    forget(key)
+                entries[key] = (data, timeout, size)
+                function._cache['bytes'] += size
+                while (max_entries is not None and
+                       len(entries) > max_entries) or \
+                        (max_bytes is not None and
+                         function._cache['bytes'] > max_bytes):
+                    forget(next(iter(entries)))
+                    stats['evictions'] += 1
+            return data
+
+        def invalidate(*args, **kwargs):
+            """
+            Forgets value cached for given arguments.
+            """
+            with lock:
+                key = make_key(args, kwargs)
+                if key in entries:
+                    forget(key)
+
+        def invalidate_all():
+            """
+            Forgets all values, including ones being computed right now.
+            """
+            with lock:
+                entries.clear()
+                function._cache['bytes'] = 0
+                function._cache['generation'] += 1
+
+        def cache_info():
+            """
+            Returns copy of cache counters together with its size.
+            """
+            with lock:
+                info = dict(stats)
+                info['entries'] = len(entries)
+                info['bytes'] = function._cache['bytes']
+                info['generation'] = function._cache['generation']
+            requests = info['hits'] + info['misses']
+            info['hit_ratio'] = float(info['hits']) / requests \
+                if requests else 0.0
+            return info
+
+        inner.invalidate = invalidate
+        inner.invalidate_all = invalidate_all
+        inner.cache_info = cache_info
+        return inner
+    return wrap
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Refreshing of the users XML file from the intranet.
+
+The file is downloaded only when the server says it changed (validators
+of the previous download are kept in a sidecar file), streamed into
+a temporary file and atomically renamed over the old one, so the
+application never reads a half-written file.
+"""
+
+import json
+import os
+import shutil
+import urllib2
+
+from lxml import etree
+
+from presence_analyzer.files import replace_file
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# size of chunks the download is copied in
+CHUNK_SIZE = 64 * 1024
+
+
+def meta_path(path):
+    """
+    Returns path of the file keeping validators of the downloaded file.
+    """
+    return path + '.meta'
+
+
+def read_meta(path):
+    """
+    Returns validators of the previous download of the file, if it is
+    still there.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(meta_path(path)) as meta_file:
+            return json.load(meta_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def fetch(url, path, timeout=60):
+    """
+    Downloads url into path, unless it did not change since the previous
+    download. Returns True when the file was replaced.
+
+    Downloads which are not well-formed XML are rejected with
+    etree.XMLSyntaxError, leaving the old file in place.
+    """
+    meta = read_meta(path)
+    request = urllib2.Request(url)
+    if meta.get('etag'):
+        request.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        request.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            log.debug('%s not modified', url)
+            return False
+        raise
+
+    def write(temp):
+        """
+        Streams the download and checks it is well-formed.
+        """
+        shutil.copyfileobj(response, temp, CHUNK_SIZE)
+        temp.flush()
+        etree.parse(temp.name)
+
+    try:
+        replace_file(path, write)
+    finally:
+        response.close()
+    meta = {
+        'etag': response.info().getheader('ETag'),
+        'last_modified': response.info().getheader('Last-Modified'),
+    }
+    replace_file(meta_path(path),
+                 lambda temp: json.dump(meta, temp))
+    log.info('Downloaded %s', url)
+    return True
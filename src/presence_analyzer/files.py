@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Atomic replacing of files read by other processes.
+"""
+
+import os
+import tempfile
+
+
+def replace_file(path, write):
+    """
+    Creates file by calling write with a temporary file object and
+    renames it over the given path.
+
+    The temporary file is created next to the path and synced to disk
+    before the rename, so readers see either the old or the complete new
+    file, also after a crash.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    temp = tempfile.NamedTemporaryFile(dir=directory, delete=False,
+                                       prefix='.' + os.path.basename(path))
+    try:
+        with temp:
+            write(temp)
+            temp.flush()
+            os.fsync(temp.fileno())
+        os.rename(temp.name, path)
+    finally:
+        if os.path.exists(temp.name):
+            os.unlink(temp.name)
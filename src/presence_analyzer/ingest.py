@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+Fast parsing of presence CSV files.
+
+Lines have fixed "id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS" layout, so fields are
+converted straight into integers instead of going through
+datetime.strptime. Dates and times repeat a lot, so already converted
+values are remembered.
+
+Data may be split into many files (e.g. rotated monthly). Files, and
+chunks of large files, which have to be parsed from scratch can be parsed
+in a pool of processes, see DatasetLoader.
+"""
+
+import glob
+import multiprocessing
+import os
+import threading
+from datetime import date
+from itertools import izip
+
+from presence_analyzer.metrics import STAGE_LATENCY
+from presence_analyzer.snapshot import (read_snapshot, write_snapshot,
+                                        snapshot_path, SnapshotError,
+                                        CHECK_SIZE)
+from presence_analyzer.store import PresenceStore
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# files bigger than that are parsed in chunks of about that size
+CHUNK_SIZE = 32 * 1024 * 1024
+
+
+def parse_day(text):
+    """
+    Converts 'YYYY-MM-DD' string to day ordinal.
+    """
+    year, month, day = text.split('-')
+    return date(int(year), int(month), int(day)).toordinal()
+
+
+def parse_time(text):
+    """
+    Converts 'HH:MM:SS' string to amount of seconds since midnight.
+    """
+    hours, minutes, seconds = [int(part) for part in text.split(':')]
+    if not (0 <= hours < 24 and 0 <= minutes < 60 and 0 <= seconds < 60):
+        raise ValueError('Time out of range: {0!r}'.format(text))
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def parse_lines(lines, first_line=0):
+    """
+    Parses presence lines into list of (user_id, day, start, end) tuples.
+
+    Lines which do not have exactly four fields (header and footer) are
+    skipped, lines with invalid values are logged and skipped as well.
+    """
+    days = {}
+    times = {}
+    rows = []
+    append = rows.append
+    for i, line in enumerate(lines, first_line):
+        fields = line.rstrip('\r\n').split(',')
+        if len(fields) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            day = days.get(fields[1])
+            if day is None:
+                day = days[fields[1]] = parse_day(fields[1])
+            start = times.get(fields[2])
+            if start is None:
+                start = times[fields[2]] = parse_time(fields[2])
+            end = times.get(fields[3])
+            if end is None:
+                end = times[fields[3]] = parse_time(fields[3])
+            append((int(fields[0]), day, start, end))
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: %r', i, line, exc_info=True)
+    return rows
+
+
+def split_ranges(path, size, chunk_size=None):
+    """
+    Splits first `size` bytes of file into (path, begin, end) ranges of
+    about `chunk_size` (CHUNK_SIZE by default) bytes, each ending at the
+    end of a line.
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    bounds = [0]
+    with open(path, 'rb') as csvfile:
+        position = chunk_size
+        while position < size:
+            csvfile.seek(position)
+            csvfile.readline()
+            position = csvfile.tell()
+            if position >= size:
+                break
+            bounds.append(position)
+            position += chunk_size
+    bounds.append(size)
+    return [(path, begin, end) for begin, end in izip(bounds, bounds[1:])]
+
+
+def parse_range(byte_range):
+    """
+    Parses (path, begin, end) byte range of file.
+
+    Returns (store, offset after the last complete line, amount of
+    complete lines). Line numbers in logs are counted from the beginning
+    of the range.
+    """
+    path, begin, end = byte_range
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(begin)
+        data = csvfile.read(end - begin)
+    store = PresenceStore.from_rows(parse_lines(data.splitlines(True)))
+    return store, begin + data.rfind('\n') + 1, data.count('\n')
+
+
+def pool_size(processes=None):
+    """
+    Returns amount of parsing processes, as many as CPUs by default.
+    """
+    return multiprocessing.cpu_count() if processes is None else processes
+
+
+def parse_ranges(ranges, processes=None):
+    """
+    Returns results of parse_range of all given ranges, computed by pool
+    of `processes` processes (see pool_size).
+    """
+    processes = min(pool_size(processes), len(ranges))
+    if processes <= 1:
+        return [parse_range(byte_range) for byte_range in ranges]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(parse_range, ranges, chunksize=1)
+    finally:
+        pool.terminate()
+
+
+def data_files(pattern):
+    """
+    Returns sorted list of files given as a directory (its *.csv files),
+    a glob pattern or a single path.
+    """
+    if os.path.isdir(pattern):
+        return sorted(glob.glob(os.path.join(pattern, '*.csv')))
+    if glob.has_magic(pattern):
+        return sorted(glob.glob(pattern))
+    return [pattern]
+
+
+def is_unchanged(stat, state):
+    """
+    Checks whether file of given stat is the same as when it was loaded
+    up to given state.
+    """
+    return (stat.st_ino, stat.st_size, stat.st_mtime) == (
+        state['inode'], state['size'], state['mtime'])
+
+
+def is_appended(path, stat, state):
+    """
+    Checks whether file could only have grown since it was loaded up to
+    given state.
+    """
+    if stat.st_ino != state['inode']:
+        return False
+    if stat.st_size < state['offset']:
+        return False
+    if stat.st_size == state['size'] and stat.st_mtime != state['mtime']:
+        return False
+    check = state['check']
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(state['offset'] - len(check))
+        return csvfile.read(len(check)) == check
+
+
+def dataset_source(sources):
+    """
+    Returns identity of data loaded from files of given identities. Its
+    last item is the newest modification time, like in file identities.
+    """
+    if len(sources) == 1:
+        return sources[0]
+    return (sources, max([source[-1] for source in sources] or [0]))
+
+
+class CSVLoader(object):
+    """
+    Loads presence CSV file into PresenceStore.
+
+    The file is expected to grow by appending lines, so the loader
+    remembers the file's identity and the byte offset it parsed up to,
+    and on the next load parses only the newly appended tail. When the
+    file was truncated or replaced, it is parsed from scratch.
+
+    With snapshots enabled, fresh loader starts from the snapshot written
+    next to the file (parsing only lines appended after it was taken) and
+    the snapshot is rewritten once it lags behind the file by a tenth.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.store = None
+        self.path = None
+        self.state = None
+        self.saved = None
+        self.stat = None
+        self.snapshot = False
+
+    def load(self, path, snapshot=False, processes=1):
+        """
+        Returns store with up to date contents of given file.
+
+        File parsed from scratch is split into chunks parsed by pool of
+        `processes` processes.
+        """
+        with self.lock:
+            ranges = self.prepare(path, snapshot,
+                                  chunked=pool_size(processes) > 1)
+            if ranges:
+                with STAGE_LATENCY.time('csv_parse'):
+                    self.finish(parse_ranges(ranges, processes))
+            return self.store
+
+    def prepare(self, path, snapshot=False, chunked=False):
+        """
+        Brings the store up to date, unless the file has to be parsed from
+        scratch. Then (path, begin, end) ranges of the file are returned,
+        and results of parse_range of them must be passed to finish.
+        Large files are split into many ranges when `chunked` is set.
+
+        Caller holds the lock.
+        """
+        stat = os.stat(path)
+        if path != self.path or self.store is None:
+            self.path = path
+            self.store = None
+            if snapshot:
+                self._restore()
+        self.snapshot = snapshot
+        if self.store is not None and self._is_unchanged(stat):
+            return []
+        if self.store is not None and self._is_appended(stat):
+            self._read(stat)
+            if snapshot:
+                self._save()
+            return []
+        self._reset()
+        self.stat = stat
+        if not chunked:
+            return [(path, 0, stat.st_size)]
+        return split_ranges(path, stat.st_size)
+
+    def finish(self, results):
+        """
+        Completes parsing from scratch with results of parse_range.
+        """
+        stores = [store for store, _, _ in results]
+        self.store = stores[0] if len(stores) == 1 else \
+            PresenceStore.concatenate(stores)
+        state = self.state
+        state['offset'] = results[-1][1]
+        state['lines'] = sum(lines for _, _, lines in results)
+        with open(self.path, 'rb') as csvfile:
+            csvfile.seek(max(state['offset'] - CHECK_SIZE, 0))
+            state['check'] = csvfile.read(
+                min(state['offset'], CHECK_SIZE))
+        state['inode'] = self.stat.st_ino
+        state['size'] = self.stat.st_size
+        state['mtime'] = self.stat.st_mtime
+        self.store.source = (state['inode'], state['size'], state['mtime'])
+        if self.snapshot:
+            self._save()
+
+    def _is_unchanged(self, stat):
+        """
+        Checks whether file is the same as on the last load.
+        """
+        return is_unchanged(stat, self.state)
+
+    def _is_appended(self, stat):
+        """
+        Checks whether file could only have grown since the last load.
+        """
+        return is_appended(self.path, stat, self.state)
+
+    def _reset(self):
+        """
+        Forgets everything parsed so far.
+        """
+        log.debug('Full reload of %s', self.path)
+        self.store = PresenceStore()
+        self.state = {
+            'inode': None,
+            'size': 0,
+            'mtime': 0,
+            'offset': 0,
+            'lines': 0,
+            'check': '',
+        }
+        self.saved = None
+
+    def _read(self, stat):
+        """
+        Parses file from the remembered offset and merges new rows.
+
+        Unterminated last line is parsed too, but the offset is left
+        before it, so it is parsed again once it is complete.
+        """
+        state = self.state
+        with open(self.path, 'rb') as csvfile:
+            csvfile.seek(state['offset'])
+            tail = csvfile.read(stat.st_size - state['offset'])
+        lines = tail.splitlines(True)
+        with STAGE_LATENCY.time('csv_parse'):
+            self.store = self.store.merge(parse_lines(lines, state['lines']))
+        complete = tail[:tail.rfind('\n') + 1]
+        state['offset'] += len(complete)
+        state['lines'] += complete.count('\n')
+        state['check'] = (state['check'] + complete)[-CHECK_SIZE:]
+        state['inode'] = stat.st_ino
+        state['size'] = stat.st_size
+        state['mtime'] = stat.st_mtime
+        self.store.source = (state['inode'], state['size'], state['mtime'])
+
+    def _restore(self):
+        """
+        Starts from the snapshot of the file, if there is one.
+        """
+        try:
+            with STAGE_LATENCY.time('snapshot_read'):
+                self.store, state = read_snapshot(snapshot_path(self.path))
+        except SnapshotError:
+            log.debug('No usable snapshot of %s', self.path, exc_info=True)
+            return
+        self.state = state
+        self.saved = state['offset']
+        self.store.source = (state['inode'], state['size'], state['mtime'])
+
+    def _save(self):
+        """
+        Writes snapshot, unless the last one is still reasonably fresh.
+        """
+        offset = self.state['offset']
+        if self.saved is not None and offset - self.saved <= self.saved / 10:
+            return
+        try:
+            with STAGE_LATENCY.time('snapshot_write'):
+                write_snapshot(snapshot_path(self.path), self.store,
+                               self.state)
+        except (IOError, OSError):
+            log.warning('Can not write snapshot of %s', self.path,
+                        exc_info=True)
+            return
+        self.saved = offset
+
+
+class DatasetLoader(object):
+    """
+    Loads presence data from a file, all *.csv files of a directory or
+    files matching a glob pattern, see data_files.
+
+    Every file has its own CSVLoader, so unchanged files are not parsed
+    again and appended ones only partly. Files parsed from scratch, split
+    into chunks when large, are parsed together, in a pool of processes
+    when more than one is asked for. The pool is forked from the calling
+    process, which is unsafe in a server running many threads, so there is
+    none by default.
+    Stores of files are concatenated in the order of file names, so later
+    files win for the same user and day.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaders = {}
+        self.store = None
+        self.sources = None
+
+    def load(self, pattern, snapshot=False, processes=1):
+        """
+        Returns store with up to date contents of all files.
+        """
+        with self.lock:
+            paths = data_files(pattern)
+            self.loaders = dict((path, self.loaders.get(path, CSVLoader()))
+                                for path in paths)
+            chunked = pool_size(processes) > 1
+            ranges = [self.loaders[path].prepare(path, snapshot, chunked)
+                      for path in paths]
+            if any(ranges):
+                with STAGE_LATENCY.time('csv_parse'):
+                    results = parse_ranges(sum(ranges, []), processes)
+                position = 0
+                for path, path_ranges in izip(paths, ranges):
+                    if path_ranges:
+                        self.loaders[path].finish(
+                            results[position:position + len(path_ranges)])
+                        position += len(path_ranges)
+
+            stores = [self.loaders[path].store for path in paths]
+            sources = tuple(store.source for store in stores)
+            if sources != self.sources:
+                if len(stores) == 1:
+                    self.store = stores[0]
+                else:
+                    self.store = PresenceStore.concatenate(stores)
+                    self.store.source = dataset_source(sources)
+                self.sources = sources
+            return self.store
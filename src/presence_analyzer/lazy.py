@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy, per user loading of presence CSV files.
+
+Exported files keep lines of every user together, so a sidecar index
+mapping user ids to byte ranges of the file is enough to read entries of
+a single user without parsing the rest. Index is written next to the CSV
+file once and extended when lines are appended to it.
+
+File layout, all numbers little-endian:
+ - header (see HEADER), identifying the source file and how far it was
+   indexed,
+ - ranges: user id, begin and end byte offsets, in the order of the file.
+"""
+
+import struct
+from itertools import chain
+
+from presence_analyzer.files import replace_file
+from presence_analyzer.ingest import is_appended, is_unchanged
+from presence_analyzer.snapshot import CHECK_SIZE
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+MAGIC = 'PRSINDEX'
+VERSION = 1
+
+# magic, version, source inode, size and mtime, indexed offset and lines,
+# ranges, length of check bytes, check bytes
+HEADER = struct.Struct('<8sIQQdQQQI{0}s'.format(CHECK_SIZE))
+RANGE = struct.Struct('<iQQ')
+
+
+class IndexFileError(Exception):
+    """
+    Raised when index can not be used.
+    """
+
+
+def index_path(path):
+    """
+    Returns path of index belonging to given CSV file.
+    """
+    return path + '.index'
+
+
+def scan(csvfile, offset, size):
+    """
+    Indexes lines of open file between `offset` and `size` bytes.
+
+    Returns (ranges, offset after the last complete line, amount of
+    complete lines), where ranges are (user_id, begin, end) tuples of
+    consecutive lines of the same user. Only complete lines are indexed,
+    lines which do not start with a user id (header and footer) are
+    skipped.
+    """
+    ranges = []
+    current = None
+    lines = 0
+    csvfile.seek(offset)
+    for line in csvfile:
+        if offset + len(line) > size or not line.endswith('\n'):
+            break
+        try:
+            user_id = int(line[:line.find(',')])
+        except ValueError:
+            user_id = None
+        if user_id is not None:
+            if current is not None and current[0] == user_id and \
+                    current[2] == offset:
+                current[2] += len(line)
+            else:
+                current = [user_id, offset, offset + len(line)]
+                ranges.append(current)
+        offset += len(line)
+        lines += 1
+    return [tuple(item) for item in ranges], offset, lines
+
+
+def update_index(path, stat, index=None):
+    """
+    Brings index of the file up to date and returns it.
+
+    When the file only grew since `index` was built, lines appended to it
+    are indexed, otherwise the file is indexed from scratch. Index is a
+    dictionary with 'inode', 'size', 'mtime', 'offset', 'lines' and
+    'check' of the file, like states of ingest.CSVLoader, and 'ranges'.
+    """
+    if index is not None and is_unchanged(stat, index):
+        return index
+    if index is None or not is_appended(path, stat, index):
+        log.debug('Full indexing of %s', path)
+        index = {'offset': 0, 'lines': 0, 'check': '', 'ranges': []}
+    with open(path, 'rb') as csvfile:
+        ranges, offset, lines = scan(csvfile, index['offset'],
+                                     stat.st_size)
+        csvfile.seek(max(offset - CHECK_SIZE, 0))
+        check = csvfile.read(min(offset, CHECK_SIZE))
+    return {
+        'inode': stat.st_ino,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'offset': offset,
+        'lines': index['lines'] + lines,
+        'check': check,
+        'ranges': index['ranges'] + ranges,
+    }
+
+
+def write_index(path, index):
+    """
+    Atomically writes index.
+    """
+    header = HEADER.pack(
+        MAGIC, VERSION, index['inode'], index['size'], index['mtime'],
+        index['offset'], index['lines'], len(index['ranges']),
+        len(index['check']), index['check'])
+
+    def write(index_file):
+        """
+        Writes header followed by ranges of users.
+        """
+        index_file.write(header)
+        index_file.write(struct.pack(
+            '<' + 'iQQ' * len(index['ranges']),
+            *chain.from_iterable(index['ranges'])))
+
+    replace_file(path, write)
+
+
+def read_index(path):
+    """
+    Reads index written by write_index.
+
+    Raises IndexFileError when the file is missing, damaged or of other
+    version.
+    """
+    try:
+        with open(path, 'rb') as index_file:
+            data = index_file.read()
+    except (IOError, OSError) as error:
+        raise IndexFileError(str(error))
+    if len(data) < HEADER.size:
+        raise IndexFileError('Index {0} is truncated.'.format(path))
+    (magic, version, inode, size, mtime, offset, lines, ranges,
+     check_size, check) = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise IndexFileError('Index {0} has unknown format.'.format(path))
+    if len(data) != HEADER.size + ranges * RANGE.size:
+        raise IndexFileError('Index {0} is truncated.'.format(path))
+    values = struct.unpack_from('<' + 'iQQ' * ranges, data, HEADER.size)
+    return {
+        'inode': inode,
+        'size': size,
+        'mtime': mtime,
+        'offset': offset,
+        'lines': lines,
+        'check': check[:check_size],
+        'ranges': [values[i:i + 3] for i in xrange(0, len(values), 3)],
+    }
+
+
+def load_index(path, stat, index=None):
+    """
+    Returns up to date index of the file, starting from given index or
+    the one kept next to the file. Changed index is written back.
+    """
+    if index is None:
+        try:
+            index = read_index(index_path(path))
+        except IndexFileError:
+            log.debug('No usable index of %s', path, exc_info=True)
+    updated = update_index(path, stat, index)
+    if updated is not index:
+        try:
+            write_index(index_path(path), updated)
+        except (IOError, OSError):
+            log.warning('Can not write index of %s', path, exc_info=True)
+    return updated
+
+
+def user_ranges(indexes):
+    """
+    Groups ranges of given (path, index) pairs by user id.
+
+    It returns dictionary like this:
+    {10: (('data.csv', 0, 1024), ('data.csv', 4096, 4160)), ...}
+    """
+    result = {}
+    for path, index in indexes:
+        for user_id, begin, end in index['ranges']:
+            result.setdefault(user_id, []).append((path, begin, end))
+    return dict((user_id, tuple(ranges))
+                for user_id, ranges in result.iteritems())
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Application metrics in Prometheus text exposition format.
+
+Metrics are kept in process memory and rendered by render(), which the
+/metrics view returns. init_app installs request hooks recording
+per-endpoint latency, response sizes and in-flight requests.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, request
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+REGISTRY = []
+
+
+def format_labels(names, values, extra=()):
+    """
+    Formats label set as {name="value",...}.
+    """
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, unicode(value).encode('utf-8')
+                           .replace('\\', '\\\\').replace('"', '\\"')
+                           .replace('\n', '\\n'))
+        for name, value in pairs) + '}'
+
+
+def format_value(value):
+    """
+    Formats number the way Prometheus expects it.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """
+    Base of metrics with optional labels, added to registry on creation.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        if registry is not None:
+            registry.append(self)
+
+    def samples(self):
+        """
+        Yields (suffix, label values, extra labels, value) tuples.
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            yield '', labels, (), value
+
+    def render(self):
+        """
+        Returns metric in text exposition format.
+        """
+        lines = ['# HELP {0} {1}'.format(self.name, self.documentation),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        for suffix, labels, extra, value in self.samples():
+            lines.append('{0}{1}{2} {3}'.format(
+                self.name, suffix, format_labels(self.labels, labels, extra),
+                format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    Value which only goes up.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, *labels):
+        """
+        Increases counter of given label values.
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    """
+    Value which goes up and down.
+    """
+    kind = 'gauge'
+
+    def dec(self, amount=1, *labels):
+        """
+        Decreases gauge of given label values.
+        """
+        self.inc(-amount, *labels)
+
+
+class Histogram(Metric):
+    """
+    Observations counted in cumulative buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        super(Histogram, self).__init__(name, documentation, labels,
+                                        registry)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, *labels):
+        """
+        Records single observation for given label values.
+        """
+        with self.lock:
+            if labels not in self.values:
+                self.values[labels] = [[0] * len(self.buckets), 0]
+            counts, total = self.values[labels]
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[labels][1] = total + value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((labels, (list(counts), total))
+                            for labels, (counts, total)
+                            in self.values.items())
+        for labels, (counts, total) in values:
+            seen = 0
+            for bound, count in zip(self.buckets, counts):
+                seen += count
+                yield '_bucket', labels, [('le', format_value(bound))], seen
+            yield '_sum', labels, (), total
+            yield '_count', labels, (), seen
+
+    @contextmanager
+    def time(self, *labels):
+        """
+        Observes duration of the block in seconds.
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, *labels)
+
+
+class Callback(Metric):
+    """
+    Metric whose values are read from a function at render time.
+
+    The function returns dictionary of label values tuples to values.
+    """
+
+    def __init__(self, name, documentation, labels, function,
+                 kind='gauge', registry=REGISTRY):
+        super(Callback, self).__init__(name, documentation, labels,
+                                       registry)
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        for labels, value in sorted(self.function().items()):
+            yield '', labels, (), value
+
+
+REQUEST_LATENCY = Histogram(
+    'presence_analyzer_request_duration_seconds',
+    'Time spent handling requests.', ['endpoint', 'method'])
+RESPONSE_SIZE = Histogram(
+    'presence_analyzer_response_size_bytes',
+    'Size of response bodies.', ['endpoint'], buckets=SIZE_BUCKETS)
+RESPONSES = Counter(
+    'presence_analyzer_responses_total',
+    'Responses sent, by status code.', ['endpoint', 'status'])
+IN_FLIGHT = Gauge(
+    'presence_analyzer_requests_in_flight',
+    'Requests being handled right now.')
+STAGE_LATENCY = Histogram(
+    'presence_analyzer_stage_duration_seconds',
+    'Time spent in internal processing stages.', ['stage'])
+
+
+def timed(stage):
+    """
+    Creates decorator observing duration of calls as given stage.
+    """
+    def wrap(function):
+        @wraps(function)
+        def inner(*args, **kwargs):
+            with STAGE_LATENCY.time(stage):
+                return function(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def render():
+    """
+    Returns all registered metrics in text exposition format.
+    """
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+def init_app(app):
+    """
+    Installs request hooks recording request metrics.
+    """
+    @app.before_request
+    def start_timer():
+        """
+        Remembers when the request started.
+        """
+        g.metrics_started = time.time()
+        IN_FLIGHT.inc()
+
+    @app.after_request
+    def record_request(response):
+        """
+        Records latency, size and status of the response.
+        """
+        endpoint = request.endpoint or 'unknown'
+        REQUEST_LATENCY.observe(time.time() - g.metrics_started,
+                                endpoint, request.method)
+        if response.content_length is not None:
+            RESPONSE_SIZE.observe(response.content_length, endpoint)
+        RESPONSES.inc(1, endpoint, response.status_code)
+        return response
+
+    @app.teardown_request
+    def stop_timer(_):
+        """
+        Marks the request as finished.
+        """
+        if hasattr(g, 'metrics_started'):
+            IN_FLIGHT.dec()
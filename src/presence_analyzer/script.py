@@ -4,8 +4,8 @@
 
 import os
 import sys
-import shutil
 import urllib2
+from ConfigParser import RawConfigParser
 from functools import partial
 
 import paste.script.command
@@ -22,6 +22,21 @@ DEPLOY_CFG = etc('deploy.cfg')
 DEBUG_INI = etc('debug.ini')
 DEBUG_CFG = etc('debug.cfg')
 
+PID_FILE = ('var', 'log', '.paster.pid')
+
+# server modes of flask-ctl serve: server section of deploy.ini
+SERVER_MODES = {
+    'threadpool': 'main',
+    'gevent': 'gevent',
+    'prefork': 'prefork',
+}
+
+# gunicorn modes, loading the application before forking workers
+FORKING_MODES = ('gevent', 'prefork')
+
+# environment variable telling make_app the server mode
+SERVER_MODE_ENV = 'PRESENCE_ANALYZER_SERVER'
+
 _buildout_path = __file__
 for i in range(2 + __name__.count('.')):
     _buildout_path = os.path.dirname(_buildout_path)
@@ -30,14 +45,48 @@ abspath = partial(os.path.join, _buildout_path)
 del _buildout_path
 
 
-# bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+# application with configuration only, no watchers or warm-up
+def load_config(config=DEPLOY_CFG, debug=False):
     from presence_analyzer import app
     app.config.from_pyfile(abspath(config))
     app.debug = debug
     return app
 
 
+# bin/paster serve parts/etc/deploy.ini
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+    from presence_analyzer.utils import start_watching
+    from presence_analyzer.views import start_warm_up
+    app = load_config(config, debug)
+    # gunicorn forks workers from this process: threads do not survive the
+    # fork and locks they hold stay locked in workers, so none is started
+    # here and watchers start in every worker, see post_fork
+    forking = os.environ.get(SERVER_MODE_ENV) in FORKING_MODES
+    if app.config.get('DATA_WATCH') and not forking:
+        start_watching()
+    # WARMUP = "background" or "blocking" preloads data before serving
+    warmup = app.config.get('WARMUP')
+    if forking and warmup not in (None, '', 'blocking'):
+        raise ValueError('WARMUP = {0!r} can not be used with {1} server '
+                         'mode, use "blocking".'.format(
+                             warmup, os.environ[SERVER_MODE_ENV]))
+    if warmup:
+        start_warm_up(blocking=warmup == 'blocking', retry=not forking)
+    return app
+
+
+# post_fork hook of gunicorn server modes, run in every worker
+def post_fork(server, worker):
+    from presence_analyzer import app
+    from presence_analyzer.utils import start_watching
+    from presence_analyzer.views import readiness, start_warm_up
+    if app.config.get('DATA_WATCH'):
+        start_watching()
+    if app.config.get('WARMUP') and readiness['state'] != 'ready':
+        # warm-up failed before the fork, retry it in the worker
+        start_warm_up()
+
+
 # bin/paster serve parts/etc/debug.ini
 def make_debug(global_conf={}, **conf):
     from werkzeug.debug import DebuggedApplication
@@ -55,13 +104,32 @@ def make_shell():
     return locals()
 
 
-def _serve(action, debug=False, dry_run=False):
-    """Build paster command from 'action' and 'debug' flag."""
+def configured_server(config):
+    """Server mode set in buildout, written to [flask-ctl] of config."""
+    parser = RawConfigParser()
+    parser.read(abspath(config))
+    if parser.has_option('flask-ctl', 'server'):
+        return parser.get('flask-ctl', 'server')
+    return 'threadpool'
+
+
+def _serve(action, debug=False, dry_run=False, server=None):
+    """Build paster command from 'action' and 'debug' flag.
+
+    'server' is one of SERVER_MODES, the one configured in buildout by
+    default.
+    """
     if debug:
         config = DEBUG_INI
     else:
         config = DEPLOY_INI
-    argv = ['bin/paster', 'serve', config]
+    server = server or configured_server(config)
+    if server not in SERVER_MODES:
+        raise SystemExit('Unknown server mode {0!r}, use one of: {1}'.format(
+            server, ', '.join(sorted(SERVER_MODES))))
+    os.environ[SERVER_MODE_ENV] = server
+    argv = ['bin/paster', 'serve', config,
+            '--server-name', SERVER_MODES[server]]
     if action in ('start', 'restart'):
         argv += [action, '--daemon']
     elif action in ('', 'fg', 'foreground'):
@@ -76,7 +144,7 @@ def _serve(action, debug=False, dry_run=False):
     if action in ('start', 'stop', 'restart', 'status'):
         argv += [
             '--log-file', abspath('var', 'log', 'paster.log'),
-            '--pid-file', abspath('var', 'log', '.paster.pid'),
+            '--pid-file', abspath(*PID_FILE),
         ]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
     # Run the 'paster' command
@@ -88,7 +156,8 @@ def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
     # bin/flask-ctl serve [fg|start|stop|restart|status]
-    def action_serve(action=('a', 'start'), dry_run=False):
+    def action_serve(action=('a', 'start'), server=('s', ''),
+                     dry_run=False):
         """Serve the application.
 
         This command serves a web application that uses a paste.deploy
@@ -96,14 +165,17 @@ def run():
 
         Options:
          - 'action' is one of [fg|start|stop|restart|status]
+         - '--server' is one of [threadpool|gevent|prefork], by default
+           the one set with server_mode in buildout.cfg
          - '--dry-run' print the paster command and exit
         """
-        _serve(action, debug=False, dry_run=dry_run)
+        _serve(action, debug=False, dry_run=dry_run, server=server)
 
     # bin/flask-ctl debug [fg|start|stop|restart|status]
-    def action_debug(action=('a', 'start'), dry_run=False):
+    def action_debug(action=('a', 'start'), server=('s', ''),
+                     dry_run=False):
         """Serve the debugging application."""
-        _serve(action, debug=True, dry_run=dry_run)
+        _serve(action, debug=True, dry_run=dry_run, server=server)
 
     # bin/flask-ctl status
     def action_status(dry_run=False):
@@ -121,12 +193,16 @@ def run():
 # bin/get-xml
 def get_xml():
     """
-    Get user xml file from server.
+    Get user xml file from server, if it changed.
+
+    Running servers pick the new file up by its changed inode, size and
+    mtime, see utils.get_users_directory.
     """
-    app = make_app()
+    from lxml import etree
+    from presence_analyzer.fetch import fetch
+    app = load_config()
     try:
-        src_url = urllib2.urlopen(app.config['XML_LOCATION'], data='text/xml')
-        dst_file = open(app.config['USERS_XML'], 'w')
-        shutil.copyfileobj(src_url, dst_file, length=-1)
-    except (IOError, urllib2.URLError, urllib2.HTTPError):
+        fetch(app.config['XML_LOCATION'], app.config['USERS_XML'])
+    except (IOError, urllib2.URLError, urllib2.HTTPError,
+            etree.XMLSyntaxError):
         log.info('Error downloading xml file.', exc_info=True)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable quantile sketches of start and end times.
+
+Times are integers from a small, bounded domain (seconds since midnight),
+so a histogram of fixed-width buckets is enough: it answers any quantile
+with error of at most half of the bucket width, takes space bounded by
+the spread of values, and sketches of different weekdays or users are
+merged exactly by adding their counts.
+"""
+
+import math
+from array import array
+
+import numpy
+
+# width of a bucket in seconds
+RESOLUTION = 60
+
+
+class QuantileSketch(object):
+    """
+    Histogram of seconds since midnight with buckets RESOLUTION wide.
+
+    Only the buckets between the lowest and the highest value are kept.
+    """
+    __slots__ = ('first', 'counts', 'total')
+
+    def __init__(self, first=0, counts=None, total=0):
+        self.first = first
+        self.counts = array('i') if counts is None else counts
+        self.total = total
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        Creates sketch of given values.
+        """
+        if not values:
+            return cls()
+        first = min(values) // RESOLUTION
+        counts = array('i', [0]) * (max(values) // RESOLUTION - first + 1)
+        for value in values:
+            counts[value // RESOLUTION - first] += 1
+        return cls(first, counts, len(values))
+
+    @classmethod
+    def merged(cls, sketches):
+        """
+        Creates sketch of values of all given sketches.
+        """
+        sketches = [sketch for sketch in sketches if sketch.total]
+        if not sketches:
+            return cls()
+        first = min(sketch.first for sketch in sketches)
+        last = max(sketch.first + len(sketch.counts) for sketch in sketches)
+        counts = numpy.zeros(last - first, dtype=numpy.int64)
+        for sketch in sketches:
+            shift = sketch.first - first
+            counts[shift:shift + len(sketch.counts)] += numpy.frombuffer(
+                sketch.counts, sketch.counts.typecode)
+        return cls(first, array('i', counts.tolist()),
+                   sum(sketch.total for sketch in sketches))
+
+    def quantile(self, fraction):
+        """
+        Returns value below which given fraction of values lies, or zero
+        for empty sketch. The value is the middle of the matching bucket.
+        """
+        if not self.total:
+            return 0
+        rank = max(int(math.ceil(fraction * self.total)), 1)
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        return (self.first + i) * RESOLUTION + RESOLUTION // 2
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots of parsed presence data.
+
+Snapshot is written next to the CSV file it was created from and can be
+memory mapped by other processes instead of parsing the CSV again.
+
+File layout, all numbers little-endian:
+ - header (see HEADER), identifying the source file and how far it was
+   parsed,
+ - user ids, day ordinals, starts and ends columns, int32 each,
+ - users index: user id, begin and end column positions, int32 each,
+ - weekday aggregates: 7 x (count, total, start, end) int64 per user.
+"""
+
+import mmap
+import struct
+from array import array
+from itertools import chain
+
+import numpy
+
+from presence_analyzer.files import replace_file
+from presence_analyzer.store import (PresenceStore, WeekdayStats,
+                                     COLUMN_TYPE)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+MAGIC = 'PRESENCE'
+VERSION = 1
+CHECK_SIZE = 64
+
+# magic, version, source inode, size and mtime, parsed offset and lines,
+# rows, users, length of check bytes, check bytes
+HEADER = struct.Struct('<8sIQQdQQQQI{0}s'.format(CHECK_SIZE))
+ITEM = struct.Struct('<i')
+USER = struct.Struct('<iii')
+STATS = struct.Struct('<' + 'q' * 28)
+
+
+class SnapshotError(Exception):
+    """
+    Raised when snapshot can not be used.
+    """
+
+
+class MappedColumn(object):
+    """
+    Read-only column of int32 values stored in a memory mapped file.
+
+    Items are unpacked on access, slicing returns a tuple. NumPy reads
+    the whole column without copying it, see __array__.
+    """
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if step != 1:
+                raise ValueError('Extended slicing is not supported.')
+            count = max(stop - start, 0)
+            return struct.unpack_from('<{0}i'.format(count), self.buf,
+                                      self.offset + ITEM.size * start)
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError(index)
+        return ITEM.unpack_from(self.buf, self.offset + ITEM.size * index)[0]
+
+    def __array__(self, dtype=None):
+        values = numpy.frombuffer(self.buf, numpy.dtype('<i4'), self.length,
+                                  self.offset)
+        return values if dtype is None else values.astype(dtype)
+
+    def __iter__(self):
+        chunk = 65536
+        for start in xrange(0, self.length, chunk):
+            for item in self[start:start + chunk]:
+                yield item
+
+
+def snapshot_path(path):
+    """
+    Returns path of snapshot belonging to given CSV file.
+    """
+    return path + '.snapshot'
+
+
+def little_endian(values):
+    """
+    Returns bytes of int32 values in little-endian order.
+    """
+    values = array(COLUMN_TYPE, values)
+    if struct.pack('=i', 1) != ITEM.pack(1):
+        values.byteswap()
+    return values.tostring()
+
+
+def write_snapshot(path, store, state):
+    """
+    Atomically writes snapshot of the store.
+
+    `state` is a dictionary with 'inode', 'size' and 'mtime' of the source
+    file and 'offset', 'lines' and 'check' describing how far it was
+    parsed.
+    """
+    users = list(store.users())
+    header = HEADER.pack(
+        MAGIC, VERSION, state['inode'], state['size'], state['mtime'],
+        state['offset'], state['lines'], len(store.user_ids), len(users),
+        len(state['check']), state['check'])
+
+    def write(snapshot):
+        """
+        Writes header, columns, users index and aggregates.
+        """
+        snapshot.write(header)
+        for values in (store.user_ids, store.days, store.starts,
+                       store.ends):
+            snapshot.write(little_endian(values))
+        for user_id, begin, end, _ in users:
+            snapshot.write(USER.pack(user_id, begin, end))
+        for _, _, _, stats in users:
+            snapshot.write(STATS.pack(*chain.from_iterable(stats)))
+
+    replace_file(path, write)
+
+
+def read_snapshot(path):
+    """
+    Memory maps snapshot and returns (store, state) tuple.
+
+    Columns of returned store read straight from the mapped file. Raises
+    SnapshotError when the file is missing, damaged or of other version.
+    """
+    try:
+        with open(path, 'rb') as snapshot:
+            buf = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError, mmap.error) as error:
+        raise SnapshotError(str(error))
+    if len(buf) < HEADER.size:
+        raise SnapshotError('Snapshot {0} is truncated.'.format(path))
+    (magic, version, inode, size, mtime, offset, lines, rows, users,
+     check_size, check) = HEADER.unpack_from(buf)
+    if magic != MAGIC or version != VERSION:
+        raise SnapshotError('Snapshot {0} has unknown format.'.format(path))
+    columns_size = 4 * rows * ITEM.size
+    if len(buf) != HEADER.size + columns_size + \
+            users * (USER.size + STATS.size):
+        raise SnapshotError('Snapshot {0} is truncated.'.format(path))
+
+    columns = [MappedColumn(buf, HEADER.size + i * rows * ITEM.size, rows)
+               for i in range(4)]
+    slices = {}
+    aggregates = {}
+    position = HEADER.size + columns_size
+    user_ids = []
+    for _ in xrange(users):
+        user_id, begin, end = USER.unpack_from(buf, position)
+        slices[user_id] = (begin, end)
+        user_ids.append(user_id)
+        position += USER.size
+    for user_id in user_ids:
+        values = STATS.unpack_from(buf, position)
+        aggregates[user_id] = [WeekdayStats(*values[i:i + 4])
+                               for i in range(0, 28, 4)]
+        position += STATS.size
+
+    store = PresenceStore(*columns, aggregates=aggregates, slices=slices)
+    state = {
+        'inode': inode,
+        'size': size,
+        'mtime': mtime,
+        'offset': offset,
+        'lines': lines,
+        'check': check[:check_size],
+    }
+    return store, state
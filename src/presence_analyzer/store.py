@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, column oriented storage of presence data.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Mapping, namedtuple
+from datetime import date, time
+from itertools import groupby, izip
+from operator import itemgetter
+
+from presence_analyzer.sketch import QuantileSketch
+
+COLUMN_TYPE = 'i'
+
+
+class WeekdayStats(namedtuple('WeekdayStats', 'count total start end')):
+    """
+    Aggregate of entries from single weekday: amount of entries, sum of
+    their intervals, and sums of their start and end times (in seconds).
+    """
+    __slots__ = ()
+
+
+def weekday(day):
+    """
+    Returns weekday (Monday is 0) of given day ordinal.
+    """
+    return (day - 1) % 7
+
+
+def column(values=None):
+    """
+    Returns given column, or a new empty one.
+    """
+    return array(COLUMN_TYPE) if values is None else values
+
+
+def summarize(rows):
+    """
+    Aggregates (day, start, end) rows into list of seven WeekdayStats and
+    list of seven (start, end) QuantileSketch pairs.
+    """
+    table = [[0, 0, 0, 0] for _ in range(7)]
+    starts = [[] for _ in range(7)]
+    ends = [[] for _ in range(7)]
+    for day, start, end in rows:
+        day_of_week = weekday(day)
+        totals = table[day_of_week]
+        totals[0] += 1
+        totals[1] += end - start
+        totals[2] += start
+        totals[3] += end
+        starts[day_of_week].append(start)
+        ends[day_of_week].append(end)
+    return (
+        [WeekdayStats(*values) for values in table],
+        [(QuantileSketch.from_values(starts[i]),
+          QuantileSketch.from_values(ends[i]))
+         for i in range(7)],
+    )
+
+
+def to_time(seconds):
+    """
+    Converts amount of seconds since midnight to datetime.time object.
+    """
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class UserPresence(Mapping):
+    """
+    Read-only view of single user's entries.
+
+    It behaves like the old {date: {'start': time, 'end': time}} mapping,
+    but reads straight from the slice of store columns.
+    """
+
+    def __init__(self, store, begin, end):
+        self._store = store
+        self.begin = begin
+        self.end = end
+
+    @property
+    def days(self):
+        """
+        Day ordinals of user's entries, in ascending order.
+        """
+        return self._store.days[self.begin:self.end]
+
+    @property
+    def starts(self):
+        """
+        Start times of user's entries, in seconds since midnight.
+        """
+        return self._store.starts[self.begin:self.end]
+
+    @property
+    def ends(self):
+        """
+        End times of user's entries, in seconds since midnight.
+        """
+        return self._store.ends[self.begin:self.end]
+
+    def rows(self):
+        """
+        Yields (day ordinal, start seconds, end seconds) tuples.
+        """
+        return izip(self.days, self.starts, self.ends)
+
+    def between(self, first=None, last=None):
+        """
+        Returns view of entries from `first` to `last` day ordinal
+        (inclusive). Missing limits are not applied.
+        """
+        days = self._store.days
+        begin = self.begin if first is None else \
+            bisect_left(days, first, self.begin, self.end)
+        end = self.end if last is None else \
+            bisect_right(days, last, begin, self.end)
+        return UserPresence(self._store, begin, end)
+
+    def _position(self, key):
+        """
+        Finds column position of given date or raises KeyError.
+        """
+        try:
+            day = key.toordinal()
+        except AttributeError:
+            raise KeyError(key)
+        days = self._store.days
+        position = bisect_left(days, day, self.begin, self.end)
+        if position == self.end or days[position] != day:
+            raise KeyError(key)
+        return position
+
+    def __getitem__(self, key):
+        position = self._position(key)
+        return {
+            'start': to_time(self._store.starts[position]),
+            'end': to_time(self._store.ends[position]),
+        }
+
+    def __contains__(self, key):
+        try:
+            self._position(key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for day in self.days:
+            yield date.fromordinal(day)
+
+    def __len__(self):
+        return self.end - self.begin
+
+
+class PresenceStore(Mapping):
+    """
+    Presence entries kept in four parallel integer columns:
+    user id, day ordinal, start and end (seconds since midnight).
+
+    Rows are sorted by user id and day, so entries of each user occupy
+    a contiguous slice of every column. Indexing the store by user id
+    returns UserPresence view of that slice.
+
+    Per weekday aggregates and quantile sketches of every user are
+    computed once, when the store is created.
+
+    Columns may be any sequences of integers supporting slicing, which
+    lets the store work on top of memory mapped snapshot, see snapshot.py.
+    Already known user slices and aggregates can be passed in as well,
+    sketches of such users are computed when they are needed.
+
+    `source` identifies the file contents the store was loaded from.
+    Values derived from the store later on are kept in `derived`.
+    """
+
+    def __init__(self, user_ids=None, days=None, starts=None, ends=None,
+                 aggregates=None, slices=None, sketches=None):
+        self.user_ids = column(user_ids)
+        self.days = column(days)
+        self.starts = column(starts)
+        self.ends = column(ends)
+        self._slices = slices
+        if slices is None:
+            self._slices = {}
+            position = 0
+            for user_id, group in groupby(self.user_ids):
+                count = sum(1 for _ in group)
+                self._slices[user_id] = (position, position + count)
+                position += count
+        self.ids = frozenset(self._slices)
+        self.source = None
+        self.derived = {}
+        self._aggregates = dict(aggregates or {})
+        self._sketches = dict(sketches or {})
+        for user_id in self._slices:
+            if user_id not in self._aggregates:
+                self._aggregates[user_id], self._sketches[user_id] = \
+                    summarize(self[user_id].rows())
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Creates store from iterable of (user_id, day, start, end) tuples.
+
+        When the same user and day appears more than once, the last
+        entry wins.
+        """
+        rows = sorted(rows, key=itemgetter(0, 1))
+        columns = [column() for _ in range(4)]
+        user_ids, days, starts, ends = columns
+        for i, row in enumerate(rows):
+            following = rows[i + 1] if i + 1 < len(rows) else None
+            if following is not None and following[:2] == row[:2]:
+                continue
+            user_ids.append(row[0])
+            days.append(row[1])
+            starts.append(row[2])
+            ends.append(row[3])
+        return cls(*columns)
+
+    def merge(self, rows):
+        """
+        Returns new store with given (user_id, day, start, end) rows added.
+
+        New rows win over existing entries for the same user and day.
+        Entries of every user are copied slice by slice. When new rows of
+        a user follow the existing ones in time, which is the case of
+        appended lines, aggregates and sketches of both are added up, so
+        the cost of a merge is dominated by the amount of new rows.
+        """
+        other = self.from_rows(rows)
+        if not other:
+            return self
+        if not self:
+            return other
+        parts = {}
+        for user_id in set(self._slices) | set(other._slices):
+            if user_id not in other._slices:
+                parts[user_id] = [(self,) + self._slices[user_id]]
+            elif user_id not in self._slices:
+                parts[user_id] = [(other,) + other._slices[user_id]]
+            else:
+                parts[user_id] = self._merge_user(other, user_id)
+        return self.from_parts(parts)
+
+    @classmethod
+    def from_parts(cls, parts):
+        """
+        Creates store out of {user_id: [(store, begin, end), ...]} slices
+        of other stores, which follow each other in time for every user.
+
+        Slices are copied and aggregates and sketches of them are added
+        up instead of being recomputed.
+        """
+        columns = [column() for _ in range(4)]
+        slices = {}
+        aggregates = {}
+        sketches = {}
+        for user_id in sorted(parts):
+            begin = len(columns[0])
+            for store, first, last in parts[user_id]:
+                columns[0].extend(store.user_ids[first:last])
+                columns[1].extend(store.days[first:last])
+                columns[2].extend(store.starts[first:last])
+                columns[3].extend(store.ends[first:last])
+            slices[user_id] = (begin, len(columns[0]))
+            owners = [store for store, _, _ in parts[user_id]]
+            if len(owners) == 1:
+                aggregates[user_id] = owners[0]._aggregates[user_id]
+                if user_id in owners[0]._sketches:
+                    sketches[user_id] = owners[0]._sketches[user_id]
+                continue
+            aggregates[user_id] = [
+                WeekdayStats(*[sum(values) for values in izip(*stats)])
+                for stats in izip(*[store._aggregates[user_id]
+                                    for store in owners])]
+            if all(user_id in store._sketches for store in owners):
+                sketches[user_id] = [
+                    tuple(QuantileSketch.merged(pair) for pair in izip(*pairs))
+                    for pairs in izip(*[store._sketches[user_id]
+                                        for store in owners])]
+        return cls(*columns, aggregates=aggregates, slices=slices,
+                   sketches=sketches)
+
+    @classmethod
+    def concatenate(cls, stores):
+        """
+        Creates store of entries of all given stores.
+
+        Later stores win for the same user and day. When entries of a user
+        in consecutive stores follow each other in time, which is the case
+        of files rotated by date, they are copied slice by slice and their
+        aggregates and sketches are added up instead of being recomputed.
+        """
+        stores = [store for store in stores if store]
+        parts = {}
+        for user_id in set().union(*[store.ids for store in stores]):
+            user_parts = [(store,) + store.slice(user_id)
+                          for store in stores if user_id in store]
+            ordered = all(
+                previous.days[previous_end - 1] < following.days[begin]
+                for (previous, _, previous_end), (following, begin, _)
+                in izip(user_parts, user_parts[1:]))
+            if not ordered:
+                entries = {}
+                for store, _, _ in user_parts:
+                    entries.update((day, (start, finish)) for day, start,
+                                   finish in store[user_id].rows())
+                merged = cls.from_rows(
+                    (user_id, day, start, finish)
+                    for day, (start, finish) in entries.iteritems())
+                user_parts = [(merged, 0, len(merged.days))]
+            parts[user_id] = user_parts
+        return cls.from_parts(parts)
+
+    def _merge_user(self, other, user_id):
+        """
+        Returns list of (store, begin, end) slices making up merged entries
+        of user present in both stores.
+        """
+        begin, end = self._slices[user_id]
+        other_begin, other_end = other._slices[user_id]
+        if self.days[end - 1] < other.days[other_begin]:
+            # the common case: new rows are appended after existing ones
+            return [(self, begin, end), (other, other_begin, other_end)]
+        entries = {}
+        for store in (self, other):
+            entries.update((day, (start, finish))
+                           for day, start, finish in store[user_id].rows())
+        merged = self.from_rows(
+            (user_id, day, start, finish)
+            for day, (start, finish) in entries.iteritems()
+        )
+        return [(merged, 0, len(merged.days))]
+
+    def slice(self, user_id):
+        """
+        Returns (begin, end) column positions of given user's entries.
+        """
+        return self._slices[user_id]
+
+    def users(self):
+        """
+        Yields (user_id, begin, end, weekday stats) of all users, sorted.
+        """
+        for user_id in self:
+            begin, end = self._slices[user_id]
+            yield user_id, begin, end, self._aggregates[user_id]
+
+    def weekday_stats(self, user_id, first=None, last=None):
+        """
+        Returns list of seven WeekdayStats of given user, Monday first.
+
+        When `first` or `last` day ordinal is given, only entries from
+        that range (inclusive) are taken, see range_index.
+        """
+        if first is None and last is None:
+            return self._aggregates[user_id]
+        first = 0 if first is None else first
+        last = date.max.toordinal() if last is None else last
+        result = []
+        for days, counts in self.range_index(user_id):
+            begin = bisect_left(days, first)
+            end = max(bisect_right(days, last), begin)
+            result.append(WeekdayStats(
+                end - begin,
+                *[sums[end] - sums[begin] for sums in counts]))
+        return result
+
+    def weekday_sketches(self, user_id, first=None, last=None):
+        """
+        Returns list of seven (start, end) QuantileSketch pairs of given
+        user, Monday first.
+
+        When `first` or `last` day ordinal is given, sketches are built
+        from entries of that range (inclusive).
+        """
+        if first is not None or last is not None:
+            return summarize(self[user_id].between(first, last).rows())[1]
+        if user_id not in self._sketches:
+            self._sketches[user_id] = summarize(self[user_id].rows())[1]
+        return self._sketches[user_id]
+
+    def range_index(self, user_id):
+        """
+        Returns per weekday index of user's entries used by range queries.
+
+        For each weekday it is a pair of sorted day ordinals and prefix
+        sums of intervals, starts and ends, so aggregate of any range
+        costs two bisections. Index is built on the first use.
+        """
+        key = ('range_index', user_id)
+        if key not in self.derived:
+            index = [(array(COLUMN_TYPE), [array('l', [0]) for _ in range(3)])
+                     for _ in range(7)]
+            for day, start, end in self[user_id].rows():
+                days, (totals, starts, ends) = index[(day - 1) % 7]
+                days.append(day)
+                totals.append(totals[-1] + end - start)
+                starts.append(starts[-1] + start)
+                ends.append(ends[-1] + end)
+            self.derived[key] = index
+        return self.derived[key]
+
+    def __getitem__(self, user_id):
+        begin, end = self._slices[user_id]
+        return UserPresence(self, begin, end)
+
+    def __contains__(self, user_id):
+        return user_id in self._slices
+
+    def __iter__(self):
+        return iter(sorted(self._slices))
+
+    def __len__(self):
+        return len(self._slices)
@@ -2,12 +2,26 @@
 """
 Presence analyzer unit tests.
 """
+import os
 import os.path
 import json
+import shutil
+import tempfile
+import threading
+import time
 import datetime
+import hashlib
 import unittest
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import Mapping
 
-from presence_analyzer import main, views, utils
+import numpy
+
+from presence_analyzer import (main, views, utils, store, ingest, snapshot,
+                               aggregate, sketch, metrics, fetch, watch,
+                               backends, lazy, caching)
+from presence_analyzer.benchmarks import generator
 
 
 TEST_DATA_CSV = os.path.join(
@@ -104,6 +118,276 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
                     },
                 msg=(uid, name, pos))
 
+    def test_api_users_encoded_once(self):
+        """
+        Test users listings are encoded once per data generation.
+        """
+        for view, listing in (('/api/v1/users', views.users_listing),
+                              ('/api/v2/users', views.users_listing_v2)):
+            first = self.client.get(view).data
+            hits = listing.cache_info()['hits']
+            self.assertEqual(self.client.get(view).data, first)
+            self.assertEqual(listing.cache_info()['hits'], hits + 1)
+
+    def test_api_conditional_get(self):
+        """
+        Test validators and 304 answers to conditional requests.
+        """
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('"'))
+        self.assertIn('Last-Modified', resp.headers)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        other = self.client.get('/api/v1/mean_time_weekday/11')
+        self.assertNotEqual(other.headers['ETag'], etag)
+
+        resp = self.client.get('/api/v1/mean_time_weekday/10',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+        resp = self.client.get('/api/v1/mean_time_weekday/10',
+                               headers={'If-None-Match': '"other"'})
+        self.assertEqual(resp.status_code, 200)
+
+        hits = views.users_listing.cache_info()['hits']
+        resp = self.client.get('/api/v1/users', headers={
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(views.users_listing.cache_info()['hits'], hits)
+        resp = self.client.get('/api/v1/users', headers={
+            'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_api_gzip(self):
+        """
+        Test large documents are gzipped for clients accepting it.
+        """
+        main.app.config['JSON_GZIP_MIN_SIZE'] = 100
+        self.addCleanup(main.app.config.pop, 'JSON_GZIP_MIN_SIZE')
+        plain = self.client.get('/api/v2/users')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        resp = self.client.get('/api/v2/users',
+                               headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(zlib.decompress(resp.data, 16 + zlib.MAX_WBITS),
+                         plain.data)
+        self.assertNotEqual(resp.headers['ETag'], plain.headers['ETag'])
+        again = self.client.get('/api/v2/users',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(again.data, resp.data)
+
+        resp = self.client.get('/api/v2/users', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get('/api/v1/mean_time_weekday/999',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp = self.client.get('/api/v2/users',
+                               headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_api_batch(self):
+        """
+        Test statistics of many users in one request.
+        """
+        resp = self.client.get('/api/v1/batch')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data.keys(), ['10', '11', '124', '154'])
+        self.assertItemsEqual(data['10'].keys(), views.METRICS.keys())
+        for metric in views.METRICS:
+            single = self.client.get('/api/v1/{0}/10'.format(metric))
+            self.assertEqual(data['10'][metric], json.loads(single.data))
+
+        resp = self.client.get(
+            '/api/v1/batch?users=11,10,999&metrics=presence_weekday')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data.keys(), ['10', '11'])
+        self.assertItemsEqual(data['11'].keys(), ['presence_weekday'])
+
+        streamed = self.client.get('/api/v1/batch?users=all&stream=1')
+        self.assertEqual(streamed.status_code, 200)
+        self.assertEqual(json.loads(streamed.data),
+                         json.loads(self.client.get('/api/v1/batch').data))
+
+        resp = self.client.get('/api/v1/batch?metrics=unknown')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/batch?users=a,b')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_export(self):
+        """
+        Test streamed export of entries.
+        """
+        resp = self.client.get('/api/v1/export')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/csv; charset=utf-8')
+        self.assertIn('presence.csv', resp.headers['Content-Disposition'])
+        lines = resp.data.splitlines()
+        self.assertEqual(lines[0], 'user_id,date,start,end,interval')
+        self.assertEqual(lines[1], '10,2013-09-10,09:39:05,17:59:52,30047')
+        self.assertEqual(len(lines) - 1, sum(
+            len(user) for user in utils.get_data().values()))
+
+        resp = self.client.get('/api/v1/export?format=ndjson&users=11,999'
+                               '&from=2013-09-10&to=2013-09-12')
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        rows = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertListEqual([row['date'] for row in rows],
+                             ['2013-09-10', '2013-09-11', '2013-09-12'])
+        self.assertDictEqual(rows[0], {
+            'user_id': 11, 'date': '2013-09-10', 'start': '09:19:50',
+            'end': '13:55:54', 'interval': 16564})
+
+        resp = self.client.get('/api/v1/export?format=xml')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/export?from=yesterday')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_group(self):
+        """
+        Test statistics of groups of users and of whole office.
+        """
+        data = utils.get_data()
+        resp = self.client.get('/api/v1/group/presence_weekday?users=10,11')
+        self.assertEqual(resp.status_code, 200)
+        result = json.loads(resp.data)
+        self.assertListEqual(result[0], ['Weekday', 'Presence (s)'])
+        for weekday in range(7):
+            expected = sum(data.weekday_stats(user_id)[weekday].total
+                           for user_id in (10, 11))
+            self.assertEqual(result[weekday + 1][1], expected)
+
+        office = json.loads(
+            self.client.get('/api/v1/office/presence_start_end').data)
+        group = json.loads(self.client.get(
+            '/api/v1/group/presence_start_end?users=10,11,124,154').data)
+        self.assertEqual(office, group)
+        self.assertEqual(len(office), 7)
+
+        resp = self.client.get('/api/v1/office/unknown')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/api/v1/group/presence_weekday?users=x')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_date_range(self):
+        """
+        Test limiting statistics to range of dates.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11?from=2013-09-09&to=2013-09-11')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertListEqual([total for _, total in data[1:]],
+                             [24123, 16564, 25321, 0, 0, 0, 0])
+        resp = self.client.get('/api/v1/presence_weekday/11?to=2013-09-05')
+        self.assertListEqual([total for _, total in json.loads(resp.data)[1:]],
+                             [0, 0, 0, 22999, 0, 0, 0])
+        resp = self.client.get('/api/v1/presence_weekday/11?from=')
+        self.assertEqual(json.loads(resp.data),
+                         json.loads(self.client.get(
+                             '/api/v1/presence_weekday/11').data))
+        for view in ('mean_time_weekday/11', 'presence_start_end/11',
+                     'batch', 'office/presence_weekday'):
+            resp = self.client.get(
+                '/api/v1/{0}?from=2013-09-10&to=2013-09-10'.format(view))
+            self.assertEqual(resp.status_code, 200, msg=view)
+            resp = self.client.get('/api/v1/{0}?from=10.09.2013'.format(view))
+            self.assertEqual(resp.status_code, 400, msg=view)
+            resp = self.client.get(
+                '/api/v1/{0}?from=2013-09-12&to=2013-09-09'.format(view))
+            self.assertEqual(resp.status_code, 400, msg=view)
+        resp = self.client.get(
+            '/api/v1/office/presence_weekday?from=2013-09-10&to=2013-09-10')
+        self.assertEqual(json.loads(resp.data)[2][1], 30047 + 16564)
+
+    def test_api_percentiles(self):
+        """
+        Test percentiles of start and end times.
+        """
+        resp = self.client.get('/api/v1/presence_start_end_percentiles/11')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 7)
+        # single entry on Friday: 13:16:56 - 15:04:02
+        self.assertListEqual(data[4], ['Fri'] + [47790] * 3 + [54270] * 3)
+        self.assertListEqual(data[6], ['Sun'] + [0] * 6)
+        resp = self.client.get('/api/v1/presence_start_end_percentiles/999')
+        self.assertListEqual(json.loads(resp.data), [])
+
+        office = json.loads(self.client.get(
+            '/api/v1/office/presence_start_end_percentiles').data)
+        group = json.loads(self.client.get(
+            '/api/v1/group/presence_start_end_percentiles?users=11').data)
+        self.assertListEqual(group, data)
+        self.assertEqual(len(office), 7)
+        self.assertNotEqual(office, group)
+
+        for url in ('/api/v1/presence_start_end_percentiles/11',
+                    '/api/v1/group/presence_start_end_percentiles?users=11'):
+            ranged = json.loads(self.client.get(
+                url + ('&' if '?' in url else '?') + 'from=2013-09-13').data)
+            self.assertListEqual(ranged[4], data[4], msg=url)
+            self.assertListEqual(ranged[3], ['Thu'] + [0] * 6, msg=url)
+            ranged = json.loads(self.client.get(
+                url + ('&' if '?' in url else '?') + 'to=2013-09-12').data)
+            self.assertListEqual(ranged[4], ['Fri'] + [0] * 6, msg=url)
+            self.assertNotEqual(ranged[3], ['Thu'] + [0] * 6, msg=url)
+            resp = self.client.get(
+                url + ('&' if '?' in url else '?') + 'from=2013-09-x')
+            self.assertEqual(resp.status_code, 400, msg=url)
+
+    def test_health_ready(self):
+        """
+        Test readiness is reported once warm-up finishes.
+        """
+        self.addCleanup(views.readiness.update, {'state': 'ready',
+                                                 'error': None})
+        views.readiness['state'] = 'running'
+        resp = self.client.get('/health/ready')
+        self.assertEqual(resp.status_code, 503)
+        self.assertFalse(json.loads(resp.data)['ready'])
+
+        views.readiness['state'] = 'pending'
+        views.start_warm_up(blocking=True)
+        resp = self.client.get('/health/ready')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertTrue(data['ready'])
+        self.assertItemsEqual(data['timings'], [
+            'data', 'users_xml', 'aggregates', 'users_listings'])
+        self.assertIn('presence_analyzer_warmup_seconds{step="data"}',
+                      self.client.get('/metrics').data)
+
+        data_csv = main.app.config['DATA_CSV']
+        main.app.config['DATA_CSV'] = os.path.join(
+            tempfile.gettempdir(), 'missing.csv')
+        utils.get_data.invalidate()
+        self.addCleanup(utils.get_data.invalidate)
+        retry = views.WARMUP_RETRY
+        views.WARMUP_RETRY = 0.05
+        self.addCleanup(setattr, views, 'WARMUP_RETRY', retry)
+        views.start_warm_up(blocking=True)
+        resp = self.client.get('/health/ready')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(json.loads(resp.data)['state'], 'failed')
+        self.assertIn('error', json.loads(resp.data))
+
+        # warm-up is retried until it succeeds
+        main.app.config['DATA_CSV'] = data_csv
+        for _ in range(100):
+            if views.readiness['state'] == 'ready':
+                break
+            time.sleep(0.05)
+        resp = self.client.get('/health/ready')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('error', json.loads(resp.data))
+
     def test_api_mean_time_weekday(self):
         """
         Test mean time weekday.
@@ -161,6 +445,29 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             self.assertIsInstance(weekday[1], (int, float), msg=str(item))
             self.assertIsInstance(weekday[2], (int, float), msg=str(item))
 
+    def test_api_matches_grouping(self):
+        """
+        Test views built from aggregates match grouping helpers.
+        """
+        user = utils.get_data()[11]
+        weekdays = utils.group_by_weekday(user)
+        start_end = utils.group_by_start_end(user)
+        mean_time = json.loads(
+            self.client.get('/api/v1/mean_time_weekday/11').data)
+        total = json.loads(self.client.get('/api/v1/presence_weekday/11').data)
+        averages = json.loads(
+            self.client.get('/api/v1/presence_start_end/11').data)
+        for weekday in range(7):
+            self.assertAlmostEqual(mean_time[weekday][1],
+                                   utils.mean(weekdays[weekday]))
+            self.assertEqual(total[weekday + 1][1], sum(weekdays[weekday]))
+            self.assertAlmostEqual(
+                averages[weekday][1],
+                utils.mean(start_end[weekday]['start_list']))
+            self.assertAlmostEqual(
+                averages[weekday][2],
+                utils.mean(start_end[weekday]['end_list']))
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -185,7 +492,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         Test parsing of CSV file.
         """
         data = utils.get_data()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, Mapping)
         self.assertItemsEqual(data.keys(), [10, 11, 124, 154])
         sample_date = datetime.date(2013, 9, 10)
         self.assertIn(sample_date, data[10])
@@ -206,6 +513,103 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             self.assertItemsEqual(user.keys(), ['avatar_url', 'name'],
                                   msg=str(user))
 
+    def test_jsonify_snapshot(self):
+        """
+        Test view and validators describe the same data when it is
+        reloaded while the view runs.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        with open(path, 'a') as csvfile:
+            csvfile.write('999,2013-09-10,08:00:00,16:00:00\n')
+        self.addCleanup(utils.get_data.invalidate)
+
+        def reload_and_count():
+            """
+            Switches to other data and counts users of the served one.
+            """
+            main.app.config['DATA_CSV'] = path
+            utils.get_data.invalidate()
+            utils.get_data()
+            return len(utils.current_data())
+
+        view = utils.jsonify(reload_and_count)
+        utils.get_data.invalidate()
+        generation = utils.get_generation()
+        with main.app.test_request_context('/test'):
+            resp = view()
+        self.assertEqual(json.loads(resp.data), 4)
+        self.assertEqual(resp.headers['ETag'], '"{0}"'.format(
+            hashlib.sha1(repr((generation, u'/test?'))).hexdigest()))
+        self.assertEqual(len(utils.current_data()), 5)
+
+    def test_start_thread(self):
+        """
+        Test function is called with given arguments in a daemon thread.
+        """
+        done = threading.Event()
+        calls = []
+
+        def record(*args):
+            """
+            Records arguments and thread of the call.
+            """
+            calls.append((args, threading.current_thread()))
+            done.set()
+        utils.start_thread(record, 1, 'a')
+        self.assertTrue(done.wait(5))
+        args, thread = calls[0]
+        self.assertEqual(args, (1, 'a'))
+        self.assertIsNot(thread, threading.current_thread())
+        self.assertTrue(thread.daemon)
+
+    def test_jsonify(self):
+        """
+        Test JSON encoding of view results.
+        """
+        view = utils.jsonify(lambda value: value)
+        with main.app.test_request_context():
+            self.assertEqual(json.loads(view([1, 'a']).data), [1, 'a'])
+            value = json.loads(view([28800.123456789, 1 / 3.0]).data)
+            self.assertEqual(value[0], 28800.123456789)
+            self.assertAlmostEqual(value[1], 1 / 3.0, places=14)
+            self.assertEqual(view(utils.JSONBytes('{"a": 1}')).data,
+                             '{"a": 1}')
+
+    def test_get_users_directory(self):
+        """
+        Test parsed user xml file is kept until the file changes.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'users.xml')
+            shutil.copy(TEST_USERS_XML, path)
+            main.app.config.update({'USERS_XML': path})
+            users = utils.get_users_directory()
+            self.assertEqual(len(users), 4)
+            self.assertIs(utils.get_users_directory(), users)
+            stat = os.stat(path)
+            os.utime(path, (stat.st_atime, stat.st_mtime + 5))
+            self.assertIsNot(utils.get_users_directory(), users)
+            users = utils.get_users_directory()
+            with open(path, 'w') as xml_file:
+                xml_file.write('<intranet><users><user id="1"><name>A</name>'
+                               '<avatar>/a</avatar></user></users><server>'
+                               '<host>h</host><port>80</port>'
+                               '<protocol>http</protocol></server>'
+                               '</intranet>')
+            stat = os.stat(path)
+            os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+            self.assertDictEqual(utils.get_users_directory(), {
+                1: {'name': 'A', 'avatar_url': 'http://h:80/a'},
+            })
+            os.remove(path)
+            self.assertDictEqual(utils.get_users_directory(), {})
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_group_by_weekday(self):
         """
         Test grouping user time by weekday.
@@ -220,6 +624,8 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
                 self.assertIsInstance(item, list, msg=str(user))
         sample_user = utils.group_by_weekday(data[10])
         self.assertItemsEqual(sample_user[1], [30047])
+        plain_user = dict(data[10].items())
+        self.assertDictEqual(utils.group_by_weekday(plain_user), sample_user)
 
     def test_seconds_since_midnight(self):
         """
@@ -281,6 +687,1417 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
                                       msg=str(item))
 
 
+class CacheTestCase(unittest.TestCase):
+    """
+    Cache decorator tests.
+    """
+
+    def wait_for_refresh(self, function):
+        """
+        Waits until background refresh of cached function is done.
+        """
+        for _ in range(500):
+            if not function._cache['refreshing']:
+                return
+            time.sleep(0.01)
+        self.fail('Background refresh did not finish.')
+
+    def test_fresh(self):
+        """
+        Test fresh value is computed once.
+        """
+        calls = []
+
+        @utils.cache(600)
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(compute(), 1)
+        self.assertEqual(compute(), 1)
+        info = compute.cache_info()
+        self.assertEqual(info['misses'], 1)
+        self.assertEqual(info['hits'], 1)
+        self.assertEqual(info['refreshes'], 1)
+        self.assertGreaterEqual(info['refresh_time'], 0)
+
+    def test_invalidate_refresh(self):
+        """
+        Test value is dropped or recomputed on demand.
+        """
+        calls = []
+
+        @utils.cache(600)
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(compute(), 1)
+        self.assertEqual(compute.refresh(), 2)
+        self.assertEqual(compute(), 2)
+        compute.invalidate()
+        self.assertEqual(compute(), 3)
+        self.assertEqual(compute.cache_info()['misses'], 2)
+
+    def test_stale_while_revalidate(self):
+        """
+        Test expired value is served while it is refreshed in background.
+        """
+        calls = []
+        release = threading.Event()
+
+        @utils.cache(0)
+        def compute():
+            calls.append(1)
+            if len(calls) > 1:
+                release.wait(5)
+            return len(calls)
+
+        self.assertEqual(compute(), 1)
+        self.assertEqual(compute(), 1)
+        self.assertEqual(compute(), 1)
+        self.assertTrue(compute._cache['refreshing'])
+        release.set()
+        self.wait_for_refresh(compute)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(compute(), 2)
+        self.wait_for_refresh(compute)
+        info = compute.cache_info()
+        self.assertEqual(info['misses'], 1)
+        self.assertEqual(info['stale_hits'], 3)
+        self.assertEqual(info['refreshes'], 3)
+
+    def test_refresh_after_compute(self):
+        """
+        Test background refresh waits for value computed meanwhile and
+        does not compute it again.
+        """
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        @utils.cache(600)
+        def compute():
+            calls.append(1)
+            if len(calls) == 2:
+                started.set()
+                release.wait(5)
+            return len(calls)
+
+        self.assertEqual(compute(), 1)
+        forced = threading.Thread(target=compute.refresh)
+        forced.start()
+        self.assertTrue(started.wait(5))
+        compute._cache['timeout'] = datetime.datetime.now()
+        self.assertEqual(compute(), 1)
+        release.set()
+        forced.join()
+        self.wait_for_refresh(compute)
+        self.assertEqual(compute(), 2)
+        self.assertEqual(len(calls), 2)
+
+    def test_failed_refresh(self):
+        """
+        Test stale value is kept when background refresh fails.
+        """
+        calls = []
+
+        @utils.cache(0)
+        def compute():
+            calls.append(1)
+            if len(calls) > 1:
+                raise ValueError()
+            return len(calls)
+
+        self.assertEqual(compute(), 1)
+        self.assertEqual(compute(), 1)
+        self.wait_for_refresh(compute)
+        self.assertEqual(compute(), 1)
+
+    def test_max_stale(self):
+        """
+        Test value older than max_stale is computed by the caller.
+        """
+        calls = []
+
+        @utils.cache(0, jitter=0, max_stale=0)
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(compute(), 1)
+        self.assertEqual(compute(), 2)
+        self.assertEqual(compute.cache_info()['misses'], 2)
+
+
+class KeyedCacheTestCase(unittest.TestCase):
+    """
+    Argument aware cache decorator tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.calls = []
+
+    def cached(self, *args, **kwargs):
+        """
+        Creates cached function recording its calls.
+        """
+        @utils.cache(*args, **kwargs)
+        def compute(*args, **kwargs):
+            """
+            Records call and returns its arguments.
+            """
+            self.calls.append(args)
+            return [args, kwargs]
+        return compute
+
+    def test_keyed(self):
+        """
+        Test values are cached per call arguments.
+        """
+        compute = self.cached(600, max_entries=10)
+        self.assertEqual(compute(1), [(1,), {}])
+        self.assertEqual(compute(2), [(2,), {}])
+        self.assertEqual(compute(1, a=1), [(1,), {'a': 1}])
+        self.assertEqual(compute(1), [(1,), {}])
+        self.assertEqual(len(self.calls), 3)
+        info = compute.cache_info()
+        self.assertEqual(info['entries'], 3)
+        self.assertEqual(info['hits'], 1)
+        self.assertEqual(info['misses'], 3)
+        self.assertAlmostEqual(info['hit_ratio'], 0.25)
+        self.assertGreater(info['bytes'], 0)
+
+    def test_max_entries(self):
+        """
+        Test least recently used values are evicted.
+        """
+        compute = self.cached(600, max_entries=2)
+        compute(1)
+        compute(2)
+        compute(1)
+        compute(3)
+        compute(1)
+        compute(2)
+        self.assertListEqual(self.calls, [(1,), (2,), (3,), (2,)])
+        self.assertEqual(compute.cache_info()['evictions'], 2)
+
+    def test_max_bytes(self):
+        """
+        Test values are evicted when they take too much memory.
+        """
+        size = caching.approximate_size([(1,), {}])
+        compute = self.cached(600, max_bytes=size * 2)
+        compute(1)
+        compute(2)
+        self.assertEqual(compute.cache_info()['entries'], 2)
+        compute(3)
+        self.assertEqual(compute.cache_info()['entries'], 2)
+        self.assertLessEqual(compute.cache_info()['bytes'], size * 2)
+        compute(1)
+        self.assertEqual(len(self.calls), 4)
+
+    def test_unsupported_options(self):
+        """
+        Test options of stale values are rejected.
+        """
+        self.assertRaises(TypeError, utils.cache, 600, jitter=60,
+                          max_entries=10)
+        self.assertRaises(TypeError, utils.cache, 600, max_stale=1800,
+                          max_bytes=1000)
+
+    def test_ttl(self):
+        """
+        Test expired values are computed again.
+        """
+        compute = self.cached(0, max_entries=2)
+        compute(1)
+        compute(1)
+        self.assertEqual(len(self.calls), 2)
+        compute = self.cached(None, max_entries=2)
+        compute(1)
+        compute(1)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_invalidate(self):
+        """
+        Test invalidation of single value and of whole generation.
+        """
+        compute = self.cached(600, max_entries=10)
+        compute(1)
+        compute(2)
+        compute.invalidate(1)
+        compute(1)
+        compute(2)
+        self.assertEqual(len(self.calls), 3)
+        compute.invalidate_all()
+        self.assertEqual(compute.cache_info()['entries'], 0)
+        self.assertEqual(compute.cache_info()['generation'], 1)
+        compute(2)
+        self.assertEqual(len(self.calls), 4)
+
+    def test_approximate_size(self):
+        """
+        Test size estimation of nested values.
+        """
+        flat = caching.approximate_size([])
+        nested = caching.approximate_size([{'a': 'x' * 1000}])
+        self.assertGreater(nested, flat + 1000)
+
+
+class PresenceStoreTestCase(unittest.TestCase):
+    """
+    Columnar presence store tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.day = datetime.date(2013, 9, 10).toordinal()
+        self.store = store.PresenceStore.from_rows([
+            (11, self.day + 1, 100, 200),
+            (10, self.day + 1, 300, 400),
+            (10, self.day, 500, 600),
+            (11, self.day, 700, 800),
+            (10, self.day, 900, 1000),
+        ])
+
+    def test_columns(self):
+        """
+        Test rows are sorted by user and day and duplicates are dropped.
+        """
+        self.assertListEqual(list(self.store.user_ids), [10, 10, 11, 11])
+        self.assertListEqual(list(self.store.days), [
+            self.day, self.day + 1, self.day, self.day + 1])
+        self.assertListEqual(list(self.store.starts), [900, 300, 700, 100])
+        self.assertEqual(self.store.slice(10), (0, 2))
+        self.assertEqual(self.store.slice(11), (2, 4))
+
+    def test_mapping_view(self):
+        """
+        Test the store still behaves like the old nested mapping.
+        """
+        self.assertListEqual(list(self.store), [10, 11])
+        self.assertIn(10, self.store)
+        self.assertNotIn(12, self.store)
+        user = self.store[10]
+        self.assertEqual(len(user), 2)
+        sample_date = datetime.date(2013, 9, 11)
+        self.assertIn(sample_date, user)
+        self.assertNotIn(datetime.date(2013, 9, 12), user)
+        self.assertDictEqual(user[sample_date], {
+            'start': datetime.time(0, 5, 0),
+            'end': datetime.time(0, 6, 40),
+        })
+        self.assertListEqual(list(user.rows()), [
+            (self.day, 900, 1000), (self.day + 1, 300, 400)])
+
+    def test_weekday_stats(self):
+        """
+        Test per weekday aggregates are computed and kept on merge.
+        """
+        weekday = datetime.date(2013, 9, 10).weekday()
+        stats = self.store.weekday_stats(10)
+        self.assertEqual(len(stats), 7)
+        self.assertEqual(stats[weekday], (1, 100, 900, 1000))
+        self.assertEqual(stats[weekday + 1], (1, 100, 300, 400))
+        self.assertEqual(stats[weekday + 2], (0, 0, 0, 0))
+        merged = self.store.merge([(10, self.day + 7, 100, 400)])
+        self.assertEqual(merged.weekday_stats(10)[weekday],
+                         (2, 400, 1000, 1400))
+        self.assertIs(merged.weekday_stats(11), self.store.weekday_stats(11))
+
+    def test_weekday_sketches(self):
+        """
+        Test sketches are built with the store and kept on merge.
+        """
+        weekday = datetime.date(2013, 9, 10).weekday()
+        start, end = self.store.weekday_sketches(10)[weekday]
+        self.assertEqual(start.total, 1)
+        self.assertEqual(start.quantile(0.5), 900 + sketch.RESOLUTION // 2)
+        self.assertEqual(end.quantile(0.5), 960 + sketch.RESOLUTION // 2)
+        merged = self.store.merge([(10, self.day + 7, 100, 400)])
+        self.assertEqual(merged.weekday_sketches(10)[weekday][0].total, 2)
+        self.assertIs(merged.weekday_sketches(11),
+                      self.store.weekday_sketches(11))
+
+    def test_merge(self):
+        """
+        Test merged store equals store of all rows and appended rows are
+        summarized on their own.
+        """
+        rows = [(10, self.day + 7, 100, 400), (12, self.day, 1, 2),
+                (11, self.day, 5, 6)]
+        summarized = []
+        summarize = store.summarize
+
+        def counting_summarize(rows):
+            """
+            Remembers amount of summarized rows.
+            """
+            rows = list(rows)
+            summarized.append(len(rows))
+            return summarize(rows)
+
+        self.addCleanup(setattr, store, 'summarize', summarize)
+        store.summarize = counting_summarize
+        merged = self.store.merge(rows)
+        # new rows, and both entries of user 11 whose day was replaced
+        self.assertEqual(sum(summarized), 3 + 2)
+        store.summarize = summarize
+
+        expected = store.PresenceStore.from_rows(
+            [(user_id, day, start, end) for user_id in self.store
+             for day, start, end in self.store[user_id].rows()] + rows)
+        for name in ('user_ids', 'days', 'starts', 'ends'):
+            self.assertListEqual(list(getattr(merged, name)),
+                                 list(getattr(expected, name)))
+        for user_id in expected:
+            self.assertEqual(merged.slice(user_id), expected.slice(user_id))
+            self.assertListEqual(merged.weekday_stats(user_id),
+                                 expected.weekday_stats(user_id))
+            for pair, other in zip(merged.weekday_sketches(user_id),
+                                   expected.weekday_sketches(user_id)):
+                self.assertListEqual([list(item.counts) for item in pair],
+                                     [list(item.counts) for item in other])
+
+    def test_concatenate(self):
+        """
+        Test concatenated stores equal store of all their rows.
+        """
+        rows = [(user_id, self.day + i, 100 * i, 100 * i + 50 * user_id)
+                for user_id in (10, 11, 12) for i in range(20)]
+        rows += [(10, self.day + 3, 1, 2), (13, self.day, 5, 6)]
+        parts = [rows[:10], rows[10:30], [], rows[30:]]
+        result = store.PresenceStore.concatenate(
+            [store.PresenceStore.from_rows(part) for part in parts])
+        expected = store.PresenceStore.from_rows(rows)
+        for name in ('user_ids', 'days', 'starts', 'ends'):
+            self.assertListEqual(list(getattr(result, name)),
+                                 list(getattr(expected, name)))
+        for user_id in expected:
+            self.assertListEqual(result.weekday_stats(user_id),
+                                 expected.weekday_stats(user_id))
+            for pair, other in zip(result.weekday_sketches(user_id),
+                                   expected.weekday_sketches(user_id)):
+                self.assertListEqual([list(item.counts) for item in pair],
+                                     [list(item.counts) for item in other])
+        self.assertEqual(len(store.PresenceStore.concatenate([])), 0)
+
+    def test_between(self):
+        """
+        Test entries limited to range of days.
+        """
+        user = self.store[11]
+        self.assertListEqual(list(user.between().days), list(user.days))
+        self.assertListEqual(list(user.between(self.day + 1).days),
+                             [self.day + 1])
+        self.assertListEqual(list(user.between(last=self.day).days),
+                             [self.day])
+        self.assertEqual(len(user.between(self.day + 2)), 0)
+        self.assertEqual(len(self.store[10].between(self.day + 5)), 0)
+
+    def test_range_stats(self):
+        """
+        Test aggregates of entries from range of days.
+        """
+        weekday = datetime.date(2013, 9, 10).weekday()
+        day = self.day
+        self.assertListEqual(self.store.weekday_stats(10, day, day + 1),
+                             self.store.weekday_stats(10))
+        stats = self.store.weekday_stats(10, day + 1)
+        self.assertEqual(stats[weekday], (0, 0, 0, 0))
+        self.assertEqual(stats[weekday + 1], (1, 100, 300, 400))
+        stats = self.store.weekday_stats(10, last=day)
+        self.assertEqual(stats[weekday], (1, 100, 900, 1000))
+        self.assertEqual(stats[weekday + 1], (0, 0, 0, 0))
+        self.assertListEqual(self.store.weekday_stats(10, day + 1, day),
+                             [(0, 0, 0, 0)] * 7)
+        merged = self.store.merge([(10, day + 7, 100, 400)])
+        self.assertEqual(merged.weekday_stats(10, day, day + 7)[weekday],
+                         (2, 400, 1000, 1400))
+        self.assertEqual(merged.weekday_stats(10, day + 1)[weekday],
+                         (1, 300, 100, 400))
+
+    def test_group_weekday_stats(self):
+        """
+        Test summing aggregates of many users in the NumPy table and from
+        the columns.
+        """
+        expected = [
+            (a[0] + b[0], a[1] + b[1], a[2] + b[2], a[3] + b[3])
+            for a, b in zip(self.store.weekday_stats(10),
+                            self.store.weekday_stats(11))
+        ]
+        self.assertListEqual(
+            aggregate.group_weekday_stats(self.store), expected)
+        self.assertIn('aggregate_table', self.store.derived)
+        self.assertListEqual(aggregate.group_weekday_stats(
+            self.store, [10, 11, 12]), expected)
+        self.assertListEqual(aggregate.group_weekday_stats(self.store, [11]),
+                             self.store.weekday_stats(11))
+        self.assertListEqual(aggregate.group_weekday_stats(self.store, []),
+                             [(0, 0, 0, 0)] * 7)
+        # ranged queries reduce the columns, without per user indexes
+        self.assertListEqual(aggregate.group_weekday_stats(
+            self.store, None, self.day, self.day + 6), expected)
+        self.assertListEqual(aggregate.group_weekday_stats(
+            self.store, None, self.day + 1, self.day), [(0, 0, 0, 0)] * 7)
+        single = aggregate.group_weekday_stats(self.store, [11], self.day + 1)
+        ending = aggregate.group_weekday_stats(self.store, [10, 12],
+                                               last=self.day)
+        self.assertListEqual(self.store.derived.keys(), ['aggregate_table'])
+        self.assertListEqual(single,
+                             self.store.weekday_stats(11, self.day + 1))
+        self.assertListEqual(ending,
+                             self.store.weekday_stats(10, last=self.day))
+
+    def test_group_weekday_sketches(self):
+        """
+        Test sketches of many users counted from the columns equal merged
+        sketches of every user.
+        """
+        def counts(pairs):
+            return [[(item.first, list(item.counts), item.total)
+                     for item in pair] for pair in pairs]
+
+        def merged(user_ids, first=None, last=None):
+            users = [self.store.weekday_sketches(user_id, first, last)
+                     for user_id in user_ids]
+            return [[sketch.QuantileSketch.merged(user[day][i]
+                                                  for user in users)
+                     for i in range(2)] for day in range(7)]
+
+        office = aggregate.group_weekday_sketches(self.store)
+        self.assertListEqual(counts(office), counts(merged([10, 11])))
+        self.assertIs(aggregate.group_weekday_sketches(self.store), office)
+        self.assertListEqual(
+            counts(aggregate.group_weekday_sketches(
+                self.store, [11, 12], self.day + 1)),
+            counts(merged([11], self.day + 1)))
+        self.assertListEqual(
+            counts(aggregate.group_weekday_sketches(self.store, [])),
+            counts(merged([])))
+
+    def test_weekday(self):
+        """
+        Test weekday calculation from day ordinal.
+        """
+        sample_date = datetime.date(2013, 9, 10)
+        for offset in range(7):
+            day = sample_date + datetime.timedelta(days=offset)
+            self.assertEqual(store.weekday(day.toordinal()), day.weekday())
+
+
+class IngestTestCase(unittest.TestCase):
+    """
+    Fast CSV ingest tests.
+    """
+
+    def test_parse_lines(self):
+        """
+        Test parsing presence lines into integer tuples.
+        """
+        lines = [
+            'user_id,date,start,end,comment\n',
+            '10,2013-09-10,09:39:05,17:59:52\r\n',
+            '10,2013-09-11,25:00:00,17:59:52\n',
+            '10,2013-02-30,09:00:00,17:00:00\n',
+            'x,2013-09-11,09:00:00,17:00:00\n',
+            '11,2013-9-1,00:00:00,23:59:59\n',
+            'footer\n',
+        ]
+        rows = ingest.parse_lines(lines)
+        self.assertListEqual(rows, [
+            (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792),
+            (11, datetime.date(2013, 9, 1).toordinal(), 0, 86399),
+        ])
+
+    def test_parse_time(self):
+        """
+        Test conversion of time strings to seconds since midnight.
+        """
+        self.assertEqual(ingest.parse_time('16:44:33'), 60273)
+        self.assertRaises(ValueError, ingest.parse_time, '12:60:00')
+        self.assertRaises(ValueError, ingest.parse_time, '12:00')
+
+    def test_parse_day(self):
+        """
+        Test conversion of date strings to day ordinals.
+        """
+        self.assertEqual(ingest.parse_day('2013-09-10'),
+                         datetime.date(2013, 9, 10).toordinal())
+        self.assertRaises(ValueError, ingest.parse_day, '2013-13-01')
+
+
+class CSVLoaderTestCase(unittest.TestCase):
+    """
+    Incremental CSV loading tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        self.loader = ingest.CSVLoader()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, text, mode='ab'):
+        """
+        Writes text to the data file, making sure its mtime changes.
+        """
+        with open(self.path, mode) as csvfile:
+            csvfile.write(text)
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+
+    def test_unchanged(self):
+        """
+        Test loading unchanged file returns the same store.
+        """
+        data = self.loader.load(self.path)
+        self.assertEqual(len(data), 4)
+        self.assertEqual(self.loader.state['offset'],
+                         os.path.getsize(self.path))
+        self.assertIs(self.loader.load(self.path), data)
+
+    def test_append(self):
+        """
+        Test only appended lines are parsed and merged.
+        """
+        data = self.loader.load(self.path)
+        offset = self.loader.state['offset']
+        self.write('10,2013-09-13,08:00:00,16:00:00\n12,2013-09-13,08:00')
+        self.assertIs(self.loader.load(self.path), self.loader.store)
+        appended = self.loader.store
+        self.assertEqual(len(appended[10]), len(data[10]) + 1)
+        self.assertNotIn(12, appended)
+        self.assertEqual(self.loader.state['offset'], offset + 32)
+        self.write(':00,16:00:00\n')
+        self.assertIn(12, self.loader.load(self.path))
+        self.assertEqual(self.loader.state['offset'],
+                         os.path.getsize(self.path))
+        self.assertListEqual(list(self.loader.store), [10, 11, 12, 124, 154])
+
+    def test_append_overrides(self):
+        """
+        Test appended entry replaces existing one for the same day.
+        """
+        self.loader.load(self.path)
+        self.write('10,2013-09-10,08:00:00,16:00:00\n')
+        entry = self.loader.load(self.path)[10][datetime.date(2013, 9, 10)]
+        self.assertEqual(entry['start'], datetime.time(8, 0, 0))
+        self.assertEqual(len(self.loader.store[10]), 3)
+
+    def test_truncate(self):
+        """
+        Test truncated or rewritten file is loaded from scratch.
+        """
+        self.loader.load(self.path)
+        self.write('10,2013-09-10,08:00:00,16:00:00\n', mode='wb')
+        data = self.loader.load(self.path)
+        self.assertListEqual(list(data), [10])
+        self.assertEqual(len(data[10]), 1)
+        self.write('11,2013-09-10,08:00:00,16:00:00\n', mode='r+b')
+        self.assertListEqual(list(self.loader.load(self.path)), [11])
+
+    def test_replace(self):
+        """
+        Test file replaced by another one is loaded from scratch.
+        """
+        self.loader.load(self.path)
+        other = os.path.join(self.tmpdir, 'other.csv')
+        with open(other, 'w') as csvfile:
+            csvfile.write('11,2013-09-10,08:00:00,16:00:00\n' * 30)
+        os.rename(other, self.path)
+        self.assertListEqual(list(self.loader.load(self.path)), [11])
+
+    def test_chunks(self):
+        """
+        Test file parsed in chunks by many processes equals file parsed
+        at once, and is loaded incrementally afterwards.
+        """
+        self.write('10,2013-09-10,08:00:00,16:00:00\n12,2013-09-13,08:00')
+        ranges = ingest.split_ranges(self.path, os.path.getsize(self.path),
+                                     chunk_size=100)
+        self.assertGreater(len(ranges), 3)
+        self.assertEqual(ranges[0][1], 0)
+        self.assertEqual(ranges[-1][2], os.path.getsize(self.path))
+        expected = self.loader.load(self.path)
+        state = dict(self.loader.state)
+
+        loader = ingest.CSVLoader()
+        loader.prepare(self.path)
+        loader.finish(ingest.parse_ranges(ranges, processes=2))
+        self.assertDictEqual(loader.state, state)
+        self.assertEqual(loader.store.source, expected.source)
+        for name in ('user_ids', 'days', 'starts', 'ends'):
+            self.assertListEqual(list(getattr(loader.store, name)),
+                                 list(getattr(expected, name)))
+        self.assertEqual(loader.store[10][datetime.date(2013, 9, 10)],
+                         {'start': datetime.time(8, 0, 0),
+                          'end': datetime.time(16, 0, 0)})
+        self.write(':00,16:00:00\n')
+        self.assertIn(12, loader.load(self.path))
+
+
+class DatasetLoaderTestCase(unittest.TestCase):
+    """
+    Multiple files loading tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        with open(TEST_DATA_CSV) as csvfile:
+            lines = csvfile.readlines()
+        for name, part in (('a.csv', lines[:7]), ('b.csv', lines[7:15]),
+                           ('c.csv', lines[15:])):
+            with open(os.path.join(self.tmpdir, name), 'w') as csvfile:
+                csvfile.writelines(part)
+        with open(os.path.join(self.tmpdir, 'notes.txt'), 'w') as notes:
+            notes.write('1,2,3,4\n')
+        self.loader = ingest.DatasetLoader()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_data_files(self):
+        """
+        Test directories, glob patterns and single files.
+        """
+        names = [os.path.join(self.tmpdir, name)
+                 for name in ('a.csv', 'b.csv', 'c.csv')]
+        self.assertListEqual(ingest.data_files(self.tmpdir), names)
+        self.assertListEqual(
+            ingest.data_files(os.path.join(self.tmpdir, '[ab].csv')),
+            names[:2])
+        self.assertListEqual(ingest.data_files(names[2]), names[2:])
+
+    def test_single_process(self):
+        """
+        Test no pool of processes is started unless asked for.
+        """
+        def no_pool(*args, **kwargs):
+            """
+            Fails the test when a pool is started.
+            """
+            self.fail('pool started')
+        for name, value in (('Pool', no_pool), ('cpu_count', lambda: 4)):
+            self.addCleanup(setattr, ingest.multiprocessing, name,
+                            getattr(ingest.multiprocessing, name))
+            setattr(ingest.multiprocessing, name, value)
+        data = backends.MemoryBackend().load({'DATA_CSV': self.tmpdir})
+        self.assertItemsEqual(data, ingest.CSVLoader().load(TEST_DATA_CSV))
+
+    def test_load(self):
+        """
+        Test files are parsed in parallel and only changed ones again.
+        """
+        expected = ingest.CSVLoader().load(TEST_DATA_CSV)
+        data = self.loader.load(self.tmpdir, processes=2)
+        for name in ('user_ids', 'days', 'starts', 'ends'):
+            self.assertListEqual(list(getattr(data, name)),
+                                 list(getattr(expected, name)))
+        for user_id in expected:
+            self.assertListEqual(data.weekday_stats(user_id),
+                                 expected.weekday_stats(user_id))
+        self.assertIs(self.loader.load(self.tmpdir), data)
+        self.assertEqual(data.source[-1], max(
+            os.path.getmtime(path) for path in ingest.data_files(self.tmpdir)))
+
+        path = os.path.join(self.tmpdir, 'c.csv')
+        stores = dict((name, loader.store)
+                      for name, loader in self.loader.loaders.items())
+        with open(path, 'a') as csvfile:
+            csvfile.write('999,2013-09-10,08:00:00,16:00:00\n')
+        os.utime(path, (0, os.path.getmtime(path) + 10))
+        changed = self.loader.load(self.tmpdir)
+        self.assertIn(999, changed)
+        self.assertNotEqual(changed.source, data.source)
+        for name, loader in self.loader.loaders.items():
+            if name != path:
+                self.assertIs(loader.store, stores[name])
+
+        os.remove(path)
+        self.assertNotIn(999, self.loader.load(self.tmpdir))
+        self.assertEqual(len(self.loader.loaders), 2)
+
+
+class SQLiteBackendTestCase(unittest.TestCase):
+    """
+    SQLite storage backend tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        self.config = {'DATA_CSV': self.path}
+        self.backend = backends.SQLiteBackend()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, text, mode='ab'):
+        """
+        Writes text to the data file, making sure its mtime changes.
+        """
+        with open(self.path, mode) as csvfile:
+            csvfile.write(text)
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+
+    def assert_same(self, data, expected):
+        """
+        Checks SQLite store answers like the in-memory one.
+        """
+        self.assertEqual(data.source, expected.source)
+        self.assertListEqual(list(data), list(expected))
+        for user_id in expected:
+            self.assertDictEqual(dict(data[user_id]), dict(expected[user_id]))
+            self.assertListEqual(data.weekday_stats(user_id),
+                                 expected.weekday_stats(user_id))
+            first = datetime.date(2013, 9, 6).toordinal()
+            self.assertListEqual(data.weekday_stats(user_id, first),
+                                 expected.weekday_stats(user_id, first))
+            for pair, other in zip(data.weekday_sketches(user_id),
+                                   expected.weekday_sketches(user_id)):
+                self.assertListEqual(
+                    [(item.first, list(item.counts)) for item in pair],
+                    [(item.first, list(item.counts)) for item in other])
+        for user_ids in (None, [10, 11, 999]):
+            self.assertListEqual(
+                aggregate.group_weekday_stats(data, user_ids),
+                aggregate.group_weekday_stats(expected, user_ids))
+            for pair, other in zip(
+                    aggregate.group_weekday_sketches(data, user_ids),
+                    aggregate.group_weekday_sketches(expected, user_ids)):
+                self.assertListEqual([item.quantile(0.5) for item in pair],
+                                     [item.quantile(0.5) for item in other])
+
+    def test_load(self):
+        """
+        Test store answers queries like in-memory one.
+        """
+        data = self.backend.load(self.config)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmpdir, 'presence.sqlite')))
+        self.assert_same(data, ingest.CSVLoader().load(self.path))
+        self.assertRaises(KeyError, data.__getitem__, 999)
+        self.assertIs(self.backend.load(self.config), data)
+        other = backends.SQLiteBackend().load(self.config)
+        self.assertListEqual(list(other), list(data))
+
+    def test_append(self):
+        """
+        Test appended lines are inserted and rewritten file reloaded.
+        """
+        self.backend.load(self.config)
+        self.write('10,2013-09-10,08:00:00,16:00:00\n999,2013-09-13,08:00')
+        data = self.backend.load(self.config)
+        self.assertNotIn(999, data)
+        self.assertEqual(data[10][datetime.date(2013, 9, 10)]['start'],
+                         datetime.time(8, 0, 0))
+        self.write(':00,16:00:00\n')
+        data = self.backend.load(self.config)
+        self.assertIn(999, data)
+        self.assert_same(data, ingest.CSVLoader().load(self.path))
+
+        self.write('11,2013-09-10,08:00:00,16:00:00\n', mode='wb')
+        data = self.backend.load(self.config)
+        self.assertListEqual(list(data), [11])
+        self.assert_same(data, ingest.CSVLoader().load(self.path))
+
+    def test_shared_database(self):
+        """
+        Test loading already done by another process is not done again.
+        """
+        first, other = backends.SQLiteBackend(), backends.SQLiteBackend()
+        first.load(self.config)
+        other.load(self.config)
+        self.write('10,2013-09-10,08:00:00,16:00:00\n')
+        first.load(self.config)
+        database = os.path.join(self.tmpdir, 'presence.sqlite')
+        connection = other.connect(database)
+        self.assertEqual(
+            connection.execute('PRAGMA busy_timeout').fetchone()[0],
+            backends.BUSY_TIMEOUT * 1000)
+        calls = []
+        insert_file = backends.insert_file
+        backends.insert_file = lambda *args: calls.append(args)
+        try:
+            # as if states were read before the first backend committed
+            other.update(connection, [self.path], [os.stat(self.path)])
+        finally:
+            backends.insert_file = insert_file
+        self.assertListEqual(calls, [])
+        data = other.load(self.config)
+        self.assertEqual(data[10][datetime.date(2013, 9, 10)]['start'],
+                         datetime.time(8, 0, 0))
+
+    def test_views(self):
+        """
+        Test views answer the same with both backends.
+        """
+        main.app.config.update({'DATA_CSV': self.path,
+                                'USERS_XML': TEST_USERS_XML})
+        client = main.app.test_client()
+        urls = ('/api/v1/users', '/api/v1/presence_weekday/10',
+                '/api/v1/mean_time_weekday/11?from=2013-09-06',
+                '/api/v1/presence_start_end_percentiles/10',
+                '/api/v1/office/presence_start_end',
+                '/api/v1/group/presence_start_end_percentiles?users=10,11',
+                '/api/v1/presence_start_end_percentiles/11?to=2013-09-11')
+        utils.get_data.invalidate()
+        expected = [json.loads(client.get(url).data) for url in urls]
+        main.app.config['DATA_BACKEND'] = 'sqlite'
+        self.addCleanup(main.app.config.pop, 'DATA_BACKEND')
+        self.addCleanup(utils.get_data.invalidate)
+        utils.get_data.invalidate()
+        self.assertIsInstance(utils.get_data(), backends.SQLiteStore)
+        self.assertListEqual([json.loads(client.get(url).data)
+                              for url in urls], expected)
+
+
+class LazyBackendTestCase(SQLiteBackendTestCase):
+    """
+    Lazy storage backend tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        super(LazyBackendTestCase, self).setUp()
+        self.backend = backends.LazyBackend()
+
+    def test_index(self):
+        """
+        Test users' byte ranges are indexed and saved next to the file.
+        """
+        stat = os.stat(self.path)
+        index = lazy.load_index(self.path, stat)
+        self.assertListEqual([user_id for user_id, _, _ in index['ranges']],
+                             [10, 11, 124, 154])
+        self.assertEqual(index['ranges'][0][1], 0)
+        self.assertEqual(index['ranges'][-1][2], stat.st_size)
+        self.assertEqual(index['lines'], 20)
+        self.assertDictEqual(
+            lazy.read_index(lazy.index_path(self.path)), index)
+        self.assertIs(lazy.load_index(self.path, stat, index), index)
+
+        with open(lazy.index_path(self.path), 'r+b') as index_file:
+            index_file.truncate(lazy.HEADER.size + 1)
+        self.assertRaises(lazy.IndexFileError, lazy.read_index,
+                          lazy.index_path(self.path))
+
+    def test_load(self):
+        """
+        Test users are parsed on demand and only recently used ones kept.
+        """
+        self.config['DATA_LAZY_USERS'] = 2
+        data = self.backend.load(self.config)
+        self.assertTrue(os.path.exists(lazy.index_path(self.path)))
+        info = data.cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['entries']),
+                         (0, 0, 0))
+        self.assert_same(data, ingest.CSVLoader().load(self.path))
+        self.assertRaises(KeyError, data.__getitem__, 999)
+        self.assertLessEqual(data.cache_info()['entries'], 2)
+        self.assertGreater(data.cache_info()['evictions'], 0)
+        self.assertIs(self.backend.load(self.config), data)
+        self.config['DATA_LAZY_USERS'] = 3
+        self.assertEqual(self.backend.load(self.config).cache_info()['misses'],
+                         0)
+
+    def test_append(self):
+        """
+        Test appended lines are indexed and rewritten file indexed again.
+        """
+        data = self.backend.load(self.config)
+        data.weekday_stats(11)
+        self.write('10,2013-09-10,08:00:00,16:00:00\n999,2013-09-13,08:00')
+        data = self.backend.load(self.config)
+        self.assertNotIn(999, data)
+        hits = data.cache_info()['hits']
+        data.weekday_stats(11)
+        self.assertEqual(data.cache_info()['hits'], hits + 1)
+        self.assertEqual(data[10][datetime.date(2013, 9, 10)]['start'],
+                         datetime.time(8, 0, 0))
+        self.write(':00,16:00:00\n')
+        data = self.backend.load(self.config)
+        self.assertIn(999, data)
+        self.assert_same(data, ingest.CSVLoader().load(self.path))
+        self.assertDictEqual(backends.LazyBackend().load(self.config).ranges,
+                             data.ranges)
+
+        self.write('11,2013-09-10,08:00:00,16:00:00\n', mode='wb')
+        data = self.backend.load(self.config)
+        self.assertEqual(data.cache_info()['entries'], 0)
+        self.assertListEqual(list(data), [11])
+        self.assert_same(data, ingest.CSVLoader().load(self.path))
+
+    def test_views(self):
+        """
+        Test views answer the same as with the default backend.
+        """
+        main.app.config.update({'DATA_CSV': self.path,
+                                'USERS_XML': TEST_USERS_XML})
+        client = main.app.test_client()
+        urls = ('/api/v1/users', '/api/v1/presence_weekday/10',
+                '/api/v1/mean_time_weekday/11?from=2013-09-06',
+                '/api/v1/presence_start_end_percentiles/10',
+                '/api/v1/office/presence_start_end',
+                '/api/v1/group/presence_start_end_percentiles?users=10,11',
+                '/api/v1/export?users=10,11')
+        utils.get_data.invalidate()
+        expected = [client.get(url).data for url in urls]
+        main.app.config['DATA_BACKEND'] = 'lazy'
+        self.addCleanup(main.app.config.pop, 'DATA_BACKEND')
+        self.addCleanup(utils.get_data.invalidate)
+        utils.get_data.invalidate()
+        self.assertIsInstance(utils.get_data(), backends.LazyStore)
+        self.assertListEqual([client.get(url).data for url in urls],
+                             expected)
+        self.assertGreater(
+            views.cache_events()[('lazy_user_store', 'misses')], 0)
+
+
+class SnapshotTestCase(unittest.TestCase):
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        self.snapshot = snapshot.snapshot_path(self.path)
+        shutil.copy(TEST_DATA_CSV, self.path)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        """
+        Test snapshot restores the same store and loader state.
+        """
+        loader = ingest.CSVLoader()
+        data = loader.load(self.path)
+        snapshot.write_snapshot(self.snapshot, data, loader.state)
+        self.assertItemsEqual(os.listdir(self.tmpdir),
+                              ['data.csv', 'data.csv.snapshot'])
+        mapped, state = snapshot.read_snapshot(self.snapshot)
+        self.assertDictEqual(state, loader.state)
+        self.assertIsInstance(mapped.days, snapshot.MappedColumn)
+        self.assertListEqual(list(mapped), list(data))
+        for column in ('user_ids', 'days', 'starts', 'ends'):
+            self.assertListEqual(list(getattr(mapped, column)),
+                                 list(getattr(data, column)))
+        for user_id in data:
+            self.assertListEqual(list(mapped[user_id].rows()),
+                                 list(data[user_id].rows()))
+            self.assertListEqual(mapped.weekday_stats(user_id),
+                                 data.weekday_stats(user_id))
+        sample_date = datetime.date(2013, 9, 10)
+        self.assertEqual(mapped[10][sample_date], data[10][sample_date])
+        self.assertListEqual(list(numpy.asarray(mapped.days)),
+                             list(data.days))
+        first = sample_date.toordinal()
+        self.assertListEqual(
+            aggregate.group_weekday_stats(mapped, [10], first),
+            aggregate.group_weekday_stats(data, [10], first))
+
+    def test_invalid(self):
+        """
+        Test missing or damaged snapshot is refused.
+        """
+        self.assertRaises(snapshot.SnapshotError, snapshot.read_snapshot,
+                          self.snapshot)
+        with open(self.snapshot, 'wb') as snapshot_file:
+            snapshot_file.write('x' * 1000)
+        self.assertRaises(snapshot.SnapshotError, snapshot.read_snapshot,
+                          self.snapshot)
+
+    def test_loader(self):
+        """
+        Test loader writes snapshot and later loaders start from it.
+        """
+        data = ingest.CSVLoader().load(self.path, snapshot=True)
+        self.assertTrue(os.path.exists(self.snapshot))
+        loader = ingest.CSVLoader()
+        mapped = loader.load(self.path, snapshot=True)
+        self.assertIsInstance(mapped.days, snapshot.MappedColumn)
+        self.assertListEqual(list(mapped.days), list(data.days))
+        with open(self.path, 'ab') as csvfile:
+            csvfile.write('10,2013-09-13,08:00:00,16:00:00\n')
+        appended = loader.load(self.path, snapshot=True)
+        self.assertEqual(len(appended[10]), len(data[10]) + 1)
+
+    def test_stale(self):
+        """
+        Test snapshot of replaced file is not used and gets rebuilt.
+        """
+        ingest.CSVLoader().load(self.path, snapshot=True)
+        other = os.path.join(self.tmpdir, 'other.csv')
+        with open(other, 'w') as csvfile:
+            csvfile.write('11,2013-09-10,08:00:00,16:00:00\n' * 30)
+        os.rename(other, self.path)
+        data = ingest.CSVLoader().load(self.path, snapshot=True)
+        self.assertListEqual(list(data), [11])
+        _, state = snapshot.read_snapshot(self.snapshot)
+        self.assertEqual(state['size'], os.path.getsize(self.path))
+
+
+class QuantileSketchTestCase(unittest.TestCase):
+    """
+    Quantile sketch tests.
+    """
+
+    def test_quantile(self):
+        """
+        Test quantiles are exact up to the bucket width.
+        """
+        values = range(0, 36000, 100)
+        result = sketch.QuantileSketch.from_values(values)
+        self.assertEqual(result.total, len(values))
+        for fraction in (0.1, 0.5, 0.9, 1):
+            expected = values[int(fraction * len(values)) - 1]
+            self.assertLessEqual(abs(result.quantile(fraction) - expected),
+                                 sketch.RESOLUTION)
+        self.assertEqual(result.quantile(0), sketch.RESOLUTION // 2)
+        self.assertEqual(sketch.QuantileSketch().quantile(0.5), 0)
+
+    def test_merged(self):
+        """
+        Test merged sketch equals sketch of all values.
+        """
+        first = range(30000, 40000, 7)
+        second = range(20000, 32000, 13)
+        merged = sketch.QuantileSketch.merged([
+            sketch.QuantileSketch.from_values(first),
+            sketch.QuantileSketch(),
+            sketch.QuantileSketch.from_values(second),
+        ])
+        expected = sketch.QuantileSketch.from_values(first + second)
+        self.assertEqual(merged.total, expected.total)
+        self.assertEqual(merged.first, expected.first)
+        self.assertListEqual(list(merged.counts), list(expected.counts))
+
+
+class MetricsTestCase(unittest.TestCase):
+    """
+    Metrics tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV,
+                                'USERS_XML': TEST_USERS_XML})
+        self.client = main.app.test_client()
+
+    def test_render(self):
+        """
+        Test text exposition format of counters and histograms.
+        """
+        counter = metrics.Counter('requests_total', 'Requests.', ['path'],
+                                  registry=None)
+        counter.inc(2, '/a"b')
+        self.assertEqual(counter.render(),
+                         '# HELP requests_total Requests.\n'
+                         '# TYPE requests_total counter\n'
+                         'requests_total{path="/a\\"b"} 2')
+        histogram = metrics.Histogram('duration', 'Time.', buckets=(1, 2),
+                                      registry=None)
+        histogram.observe(0.5)
+        histogram.observe(1.5)
+        histogram.observe(3)
+        lines = histogram.render().split('\n')[2:]
+        self.assertListEqual(lines, [
+            'duration_bucket{le="1"} 1',
+            'duration_bucket{le="2"} 2',
+            'duration_bucket{le="+Inf"} 3',
+            'duration_sum 5.0',
+            'duration_count 3',
+        ])
+
+    def test_metrics_view(self):
+        """
+        Test metrics endpoint reports requests, stages and caches.
+        """
+        self.client.get('/api/v1/presence_weekday/10')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertIn('presence_analyzer_request_duration_seconds_count{'
+                      'endpoint="presence_weekday_view",method="GET"}',
+                      resp.data)
+        self.assertIn('presence_analyzer_responses_total{'
+                      'endpoint="presence_weekday_view",status="200"}',
+                      resp.data)
+        self.assertIn('presence_analyzer_stage_duration_seconds_count{'
+                      'stage="json_encode"}', resp.data)
+        self.assertIn('presence_analyzer_cache_events_total{'
+                      'cache="get_data",event="misses"}', resp.data)
+        self.assertIn('presence_analyzer_requests_in_flight 1', resp.data)
+
+
+class XMLServerHandler(BaseHTTPRequestHandler):
+    """
+    Serves users XML file of the test server, honouring If-None-Match.
+    """
+
+    def do_GET(self):  # pylint: disable-msg=C0103
+        """
+        Answers with the document or 304.
+        """
+        server = self.server
+        server.requests.append(dict(self.headers))
+        etag = '"{0}"'.format(server.version)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', 'Mon, 02 Jan 2012 10:00:00 GMT')
+        self.send_header('Content-Length', str(len(server.document)))
+        self.end_headers()
+        self.wfile.write(server.document)
+
+    def log_message(self, *args):  # pylint: disable-msg=W0221
+        """
+        Keeps test output clean.
+        """
+
+
+class FetchTestCase(unittest.TestCase):
+    """
+    Users XML download tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'users.xml')
+        self.server = HTTPServer(('127.0.0.1', 0), XMLServerHandler)
+        self.server.requests = []
+        self.server.version = 1
+        with open(TEST_USERS_XML) as xml_file:
+            self.server.document = xml_file.read()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{0}/users.xml'.format(
+            self.server.server_port)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_fetch(self):
+        """
+        Test file is downloaded only when it changed.
+        """
+        self.assertTrue(fetch.fetch(self.url, self.path))
+        with open(self.path) as xml_file:
+            self.assertEqual(xml_file.read(), self.server.document)
+        self.assertNotIn('if-none-match', self.server.requests[0])
+
+        inode = os.stat(self.path).st_ino
+        self.assertFalse(fetch.fetch(self.url, self.path))
+        self.assertEqual(self.server.requests[1]['if-none-match'], '"1"')
+        self.assertEqual(self.server.requests[1]['if-modified-since'],
+                         'Mon, 02 Jan 2012 10:00:00 GMT')
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+
+        self.server.version = 2
+        self.server.document = self.server.document.replace(
+            'Maciej D.', 'Maciej E.')
+        self.assertTrue(fetch.fetch(self.url, self.path))
+        with open(self.path) as xml_file:
+            self.assertIn('Maciej E.', xml_file.read())
+        self.assertItemsEqual(os.listdir(self.tmpdir),
+                              ['users.xml', 'users.xml.meta'])
+
+    def test_fetch_invalid(self):
+        """
+        Test malformed download does not replace the file.
+        """
+        fetch.fetch(self.url, self.path)
+        self.server.version = 2
+        self.server.document = '<intranet><users>'
+        with self.assertRaises(fetch.etree.XMLSyntaxError):
+            fetch.fetch(self.url, self.path)
+        with open(TEST_USERS_XML) as xml_file, open(self.path) as result:
+            self.assertEqual(result.read(), xml_file.read())
+        self.assertItemsEqual(os.listdir(self.tmpdir),
+                              ['users.xml', 'users.xml.meta'])
+
+
+class WatchTestCase(unittest.TestCase):
+    """
+    File watcher tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        self.other = os.path.join(self.tmpdir, 'other.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        self.changes = []
+        self.changed = threading.Event()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        utils.stop_watching()
+        shutil.rmtree(self.tmpdir)
+
+    def callback(self, paths):
+        """
+        Records changed paths.
+        """
+        self.changes.append(paths)
+        self.changed.set()
+
+    def check_watcher(self, watcher):
+        """
+        Checks burst of appends and replacing of the file are reported.
+        """
+        self.addCleanup(watcher.stop)
+        watcher.start()
+        with open(self.other, 'w') as other:
+            other.write('unrelated\n')
+        for _ in range(3):
+            with open(self.path, 'a') as csvfile:
+                csvfile.write('10,2013-09-10,09:00:00,17:00:00\n')
+            time.sleep(0.01)
+        self.assertTrue(self.changed.wait(5))
+        self.assertEqual(self.changes, [set([self.path])])
+
+        self.changed.clear()
+        os.rename(self.other, self.path)
+        self.assertTrue(self.changed.wait(5))
+        self.assertEqual(self.changes[-1], set([self.path]))
+
+    def test_inotify(self):
+        """
+        Test changes are noticed by inotify watcher.
+        """
+        try:
+            watcher = watch.InotifyWatcher([self.path], self.callback,
+                                           debounce=0.2)
+        except OSError:
+            self.skipTest('inotify is not available')
+        self.check_watcher(watcher)
+
+    def test_polling(self):
+        """
+        Test changes are noticed by polling watcher.
+        """
+        self.check_watcher(watch.PollingWatcher(
+            [self.path], self.callback, interval=0.05, debounce=0.2))
+
+    def test_start_watching(self):
+        """
+        Test data is reloaded as soon as the file changes.
+        """
+        main.app.config.update({'DATA_CSV': self.path,
+                                'USERS_XML': TEST_USERS_XML,
+                                'DATA_WATCH_DEBOUNCE': 0.05})
+        self.addCleanup(main.app.config.pop, 'DATA_WATCH_DEBOUNCE')
+        utils.get_data.invalidate()
+        self.assertNotIn(999, utils.get_data())
+        self.assertIs(utils.start_watching(), utils.start_watching())
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('999,2013-09-10,09:00:00,17:00:00\n')
+        for _ in range(500):
+            if 999 in utils.get_data():
+                break
+            time.sleep(0.01)
+        self.assertIn(999, utils.get_data())
+        utils.get_data.invalidate()
+
+
+class BenchmarkGeneratorTestCase(unittest.TestCase):
+    """
+    Benchmark data generator tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_generate(self):
+        """
+        Test generated files are deterministic and can be loaded.
+        """
+        first = os.path.join(self.tmpdir, 'first')
+        second = os.path.join(self.tmpdir, 'second')
+        os.mkdir(first)
+        os.mkdir(second)
+        csv_path, xml_path, rows = generator.generate(first, 20, 1, seed=3)
+        generator.generate(second, 20, 1, seed=3)
+        for name in ('data.csv', 'users.xml'):
+            with open(os.path.join(first, name)) as one, \
+                    open(os.path.join(second, name)) as other:
+                self.assertEqual(one.read(), other.read())
+        data = ingest.CSVLoader().load(csv_path)
+        self.assertEqual(len(data), 20)
+        self.assertEqual(sum(len(data[user_id]) for user_id in data), rows)
+        self.assertEqual(len(utils.read_users_xml(xml_path)), 20)
+
+
 def suite():
     """
     Default test suite.
@@ -288,6 +2105,20 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(CacheTestCase))
+    suite.addTest(unittest.makeSuite(KeyedCacheTestCase))
+    suite.addTest(unittest.makeSuite(PresenceStoreTestCase))
+    suite.addTest(unittest.makeSuite(IngestTestCase))
+    suite.addTest(unittest.makeSuite(CSVLoaderTestCase))
+    suite.addTest(unittest.makeSuite(DatasetLoaderTestCase))
+    suite.addTest(unittest.makeSuite(SQLiteBackendTestCase))
+    suite.addTest(unittest.makeSuite(LazyBackendTestCase))
+    suite.addTest(unittest.makeSuite(SnapshotTestCase))
+    suite.addTest(unittest.makeSuite(QuantileSketchTestCase))
+    suite.addTest(unittest.makeSuite(MetricsTestCase))
+    suite.addTest(unittest.makeSuite(FetchTestCase))
+    suite.addTest(unittest.makeSuite(WatchTestCase))
+    suite.addTest(unittest.makeSuite(BenchmarkGeneratorTestCase))
     return suite
 
 
@@ -3,110 +3,509 @@
 Helper functions used in views.
 """
 
-import csv
-from json import dumps
+import calendar
+import json
 from functools import wraps
 from datetime import datetime, timedelta
+import hashlib
+import os
+import random
 import time
 import threading
+import zlib
 from urlparse import urljoin
 
-from flask import Response
+from flask import Response, g, has_request_context, request
 from lxml import etree
 
 from presence_analyzer.main import app
+from presence_analyzer.caching import keyed_cache
+from presence_analyzer.backends import (MemoryBackend, SQLiteBackend,
+                                        LazyBackend)
+from presence_analyzer.ingest import data_files
+from presence_analyzer.metrics import STAGE_LATENCY, timed
+from presence_analyzer.watch import watch
+from presence_analyzer.store import UserPresence, weekday
+
+try:
+    import ujson
+except ImportError:
+    ujson = None  # pylint: disable-msg=C0103
+
+try:
+    from gevent import monkey
+except ImportError:
+    monkey = None  # pylint: disable-msg=C0103
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
+# storage backends selectable with DATA_BACKEND setting
+backends = {  # pylint: disable-msg=C0103
+    'memory': MemoryBackend(),
+    'sqlite': SQLiteBackend(),
+    'lazy': LazyBackend(),
+}
+
+watchers = {}  # pylint: disable-msg=C0103
+watchers_lock = threading.Lock()  # pylint: disable-msg=C0103
+
+users_lock = threading.Lock()  # pylint: disable-msg=C0103
+users_cache = {  # pylint: disable-msg=C0103
+    #'identity': (path, inode, size, mtime),
+    #'users': {},
+}
+
+# percentiles of start and end times reported by the api
+PERCENTILES = (0.1, 0.5, 0.9)
+
+
+# compression level of gzipped responses
+GZIP_LEVEL = 6
+
+
+def dumps(value):
+    """
+    Encodes value as JSON, with ujson when it is installed.
+
+    ujson rounds floats to 10 decimal places by default, so the highest
+    precision it supports is asked for.
+    """
+    if ujson is not None:
+        return ujson.dumps(value, escape_forward_slashes=False,
+                           double_precision=15)
+    return json.dumps(value)
+
+
+def gzip_compress(data):
+    """
+    Compresses data into gzip format.
+    """
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class JSONBytes(str):
+    """
+    Already encoded JSON document, sent by jsonify as it is.
+
+    Its gzipped form is computed once, so cached documents are not
+    compressed again for every response.
+    """
+
+    def gzipped(self):
+        """
+        Returns document compressed into gzip format.
+        """
+        try:
+            return self._gzipped
+        except AttributeError:
+            self._gzipped = gzip_compress(self)
+            return self._gzipped
+
+
+def accepts_gzip():
+    """
+    Checks whether client of current request accepts gzipped responses.
+    """
+    return request.accept_encodings['gzip'] > 0
+
 
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Wrapped function may also return ready Response, e.g. a streamed one.
+    Data is pinned for the request (see pin_snapshot), so the view should
+    take it with current_data. Response carries ETag computed from the
+    data generation and request path, Last-Modified of the data files and
+    Cache-Control taken from JSON_CACHE_CONTROL setting. Conditional
+    requests for unchanged data are answered with 304 without calling the
+    wrapped function.
+
+    Documents of at least JSON_GZIP_MIN_SIZE bytes (1024 by default) are
+    gzipped for clients accepting it; such responses get their own ETag.
     """
     @wraps(function)
     def inner(*args, **kwargs):
-        return Response(dumps(function(*args, **kwargs)),
-                        mimetype='application/json')
+        pin_snapshot()
+        generation = get_generation()
+        etag = hashlib.sha1(
+            repr((generation, request.full_path))).hexdigest()
+        gzip_etag = etag + '-gzip'
+        modified = last_modified(generation)
+        if request.method in ('GET', 'HEAD') and \
+                is_not_modified((etag, gzip_etag), modified):
+            response = Response(status=304)
+            if request.if_none_match.contains(gzip_etag):
+                etag = gzip_etag
+        else:
+            result = function(*args, **kwargs)
+            if isinstance(result, Response):
+                response = result
+            else:
+                if not isinstance(result, JSONBytes):
+                    with STAGE_LATENCY.time('json_encode'):
+                        result = JSONBytes(dumps(result))
+                if len(result) >= app.config.get('JSON_GZIP_MIN_SIZE',
+                                                 1024) and accepts_gzip():
+                    with STAGE_LATENCY.time('gzip'):
+                        response = Response(result.gzipped(),
+                                            mimetype='application/json')
+                    response.headers['Content-Encoding'] = 'gzip'
+                    etag = gzip_etag
+                else:
+                    response = Response(result, mimetype='application/json')
+        response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        if modified is not None:
+            response.last_modified = modified
+        response.headers['Cache-Control'] = app.config.get(
+            'JSON_CACHE_CONTROL', 'no-cache')
+        return response
     return inner
 
 
-def get_users_from_xml():
+def last_modified(generation):
     """
-    Extracts user name and avatar's url (with hostname, port and protocol)
-    from xml file.
+    Returns modification time of newest data file of given generation.
+    """
+    times = [identity[-1] for identity in generation if identity]
+    if not times:
+        return None
+    return datetime.utcfromtimestamp(int(max(times)))
+
+
+def is_not_modified(etags, modified):
+    """
+    Checks whether current request's validators match the response, whose
+    representations have given ETags.
+    """
+    if request.if_none_match:
+        return any(request.if_none_match.contains(etag) for etag in etags)
+    if request.if_modified_since and modified is not None:
+        return modified <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def read_users_xml(path):
+    """
+    Extracts all users from xml file, clearing parsed elements on the go.
 
     It returns dictionary like this:
     {1: {'avatar_url':'https://example.com:443/api/images/1',
         {'name': 'John Doe'}}
     """
+    server = {}
+    users = {}
+    for _, element in etree.iterparse(path, events=('end',)):
+        if element.tag in ('host', 'port', 'protocol') and \
+                element.getparent().tag == 'server':
+            server[element.tag] = element.text
+        elif element.tag == 'user':
+            users[int(element.get('id'))] = {
+                'name': element.findtext('name'),
+                'avatar_url': element.findtext('avatar'),
+            }
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    host_url = ''.join([server['protocol'], '://', server['host'], ':',
+                        server['port'], '/'])
+    for user in users.itervalues():
+        user['avatar_url'] = urljoin(host_url, user['avatar_url'])
+    return users
+
+
+def users_snapshot():
+    """
+    Returns (identity, users) of USERS_XML file, see get_users_directory.
+    """
+    path = app.config['USERS_XML']
+    try:
+        stat = os.stat(path)
+    except OSError:
+        log.debug("Error reading xml file from config.", exc_info=True)
+        with users_lock:
+            users_cache['identity'] = None
+            users_cache['users'] = {}
+        return None, {}
+    identity = (path, stat.st_ino, stat.st_size, stat.st_mtime)
+    with users_lock:
+        if users_cache.get('identity') == identity:
+            return identity, users_cache['users']
+
     try:
-        tree = etree.parse(app.config['USERS_XML'])
-    except (IOError, etree.XMLSyntaxError):
+        with STAGE_LATENCY.time('users_xml_parse'):
+            users = read_users_xml(path)
+    except (IOError, KeyError, ValueError, etree.XMLSyntaxError):
         log.debug("Error reading xml file from config.", exc_info=True)
-        return {}
+        users = {}
+    with users_lock:
+        users_cache['identity'] = identity
+        users_cache['users'] = users
+    return identity, users
 
-    root = tree.getroot()
 
-    host = root.xpath("/intranet/server/host")[0].text
-    port = root.xpath("/intranet/server/port")[0].text
-    protocol = root.xpath("/intranet/server/protocol")[0].text
+def pinned_snapshot():
+    """
+    Returns (store, users identity, users) pinned for the current request
+    by jsonify, None outside of such request.
+    """
+    if has_request_context():
+        return getattr(g, 'data_snapshot', None)
+    return None
 
-    host_url = ''.join([protocol, '://', host, ':', port, '/'])
 
-    users_data = root.xpath("/intranet/users")[0]
-    users = {}
-    csv_data = get_data()
+def pin_snapshot():
+    """
+    Pins data served by the current request, so that the view and
+    validators of its response describe the same data even when it is
+    reloaded meanwhile.
+    """
+    identity, users = users_snapshot()
+    g.data_snapshot = (get_data(), identity, users)
+
 
-    for user in users_data.iter("user"):
-        user_id = int(user.get('id'))
-        if user_id not in csv_data:
+def current_data():
+    """
+    Returns store pinned for the current request, or the current one
+    outside of requests.
+    """
+    snapshot = pinned_snapshot()
+    return get_data() if snapshot is None else snapshot[0]
+
+
+def get_users_directory():
+    """
+    Returns all users from USERS_XML file.
+
+    Parsed file is kept until its inode, size or modification time
+    changes.
+    """
+    snapshot = pinned_snapshot()
+    return users_snapshot()[1] if snapshot is None else snapshot[2]
+
+
+def get_users_generation():
+    """
+    Returns identity of USERS_XML file whose users are being served.
+    """
+    snapshot = pinned_snapshot()
+    return users_snapshot()[0] if snapshot is None else snapshot[1]
+
+
+def get_generation():
+    """
+    Returns identity of presence and users data being served. It changes
+    whenever DATA_CSV or USERS_XML changes.
+    """
+    return (current_data().source, get_users_generation())
+
+
+@timed('get_users_from_xml')
+def get_users_from_xml():
+    """
+    Extracts user name and avatar's url (with hostname, port and protocol)
+    of users present in CSV file from xml file.
+
+    It returns dictionary like this:
+    {1: {'avatar_url':'https://example.com:443/api/images/1',
+        {'name': 'John Doe'}}
+    """
+    user_ids = current_data().ids
+    users = {}
+    for user_id, user in get_users_directory().iteritems():
+        if user_id not in user_ids:
             log.debug("User %s not found in csv file!", user_id)
             continue
-        user_name = user.findtext("name")
-        user_avatar = urljoin(host_url,
-                              user.findtext("avatar"))
-
-        users[user_id] = {'name': user_name,
-                          'avatar_url': user_avatar}
+        users[user_id] = user
     return users
 
 
-def cache(time_in_sec):
+def start_thread(function, *args):
+    """
+    Calls function with given arguments in a new daemon thread.
+
+    Under gevent server mode, where threading is monkey patched, an
+    operating system thread is started instead of a greenlet, so that
+    loading data does not block the event loop. Module level locks are
+    created before patching, so they still are real locks shared with
+    such threads.
+    """
+    if monkey is not None and monkey.is_module_patched('threading'):
+        monkey.get_original('thread', 'start_new_thread')(function, args)
+        return
+    thread = threading.Thread(target=function, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+def cache(time_in_sec, jitter=0, max_stale=None, max_entries=None,
+          max_bytes=None):
     """
     Creates cache decorator.
+
+    Expired value is still returned while a single background thread
+    computes the new one, which then replaces it. Random amount of up to
+    `jitter` seconds is added to every expiry time. Value older than
+    `max_stale` seconds is never returned, the caller computes a new one.
+
+    Decorated function gets invalidate(), which drops the value, and
+    refresh(*args, **kwargs), which computes a new one right away while
+    other callers are still served the old one.
+
+    When `max_entries` or `max_bytes` is given, values are cached per call
+    arguments instead, see caching.keyed_cache. Such values are never
+    served stale, so `jitter` and `max_stale` can not be combined with
+    them.
     """
+    if max_entries is not None or max_bytes is not None:
+        if jitter or max_stale is not None:
+            raise TypeError('jitter and max_stale are not supported with '
+                            'max_entries or max_bytes.')
+        return keyed_cache(time_in_sec, max_entries, max_bytes)
+
     def wrap(function):
         lock = threading.Lock()
+        compute_lock = threading.Lock()
         function._cache = {
             #'data': '',
             #'timeout': datetime.datetime,
+            #'max_age': datetime.datetime,
+            'refreshing': False,
+            'stats': {
+                'hits': 0,
+                'stale_hits': 0,
+                'misses': 0,
+                'refreshes': 0,
+                'refresh_time': 0.0,
+                'last_refresh_time': 0.0,
+            },
         }
+        stats = function._cache['stats']
+
+        def compute(args, kwargs):
+            """
+            Calls wrapped function and stores its result.
+            """
+            started = time.time()
+            data = function(*args, **kwargs)
+            duration = time.time() - started
+            now = datetime.now()
+            timeout = now + timedelta(
+                seconds=time_in_sec + random.uniform(0, jitter))
+            with lock:
+                function._cache['data'] = data
+                function._cache['timeout'] = timeout
+                if max_stale is not None:
+                    function._cache['max_age'] = now + timedelta(
+                        seconds=max_stale)
+                stats['refreshes'] += 1
+                stats['refresh_time'] += duration
+                stats['last_refresh_time'] = duration
+            return data
+
+        def refresh(args, kwargs):
+            """
+            Computes new value in background, unless another caller
+            computed it while this one waited.
+            """
+            try:
+                with compute_lock:
+                    with lock:
+                        if lookup():
+                            return
+                    compute(args, kwargs)
+            except Exception:  # pylint: disable-msg=W0703
+                log.exception('Refreshing %s failed.', function.__name__)
+            finally:
+                with lock:
+                    function._cache['refreshing'] = False
+
+        def lookup():
+            """
+            Tells whether cached value is fresh, stale or missing.
+            """
+            now = datetime.now()
+            if 'data' not in function._cache or \
+                    now >= function._cache.get('max_age', datetime.max):
+                return None
+            return now < function._cache['timeout']
 
         @wraps(function)
         def inner(*args, **kwargs):
             with lock:
-                if 'data' in function._cache:
-                    data = function._cache['data']
-                    timeout = function._cache['timeout']
-                    if datetime.now() < timeout:
-                        return data
-
-                data = function(*args, **kwargs)
-                timeout = datetime.now() + timedelta(seconds=time_in_sec)
-                function._cache['data'] = data
-                function._cache['timeout'] = timeout
-                return data
+                fresh = lookup()
+                if fresh:
+                    stats['hits'] += 1
+                    return function._cache['data']
+                if fresh is not None:
+                    stats['stale_hits'] += 1
+                    if not function._cache['refreshing']:
+                        function._cache['refreshing'] = True
+                        start_thread(refresh, args, kwargs)
+                    return function._cache['data']
+                stats['misses'] += 1
+
+            with compute_lock:
+                with lock:
+                    if lookup():
+                        # computed by another caller in the meantime
+                        return function._cache['data']
+                return compute(args, kwargs)
+
+        def cache_info():
+            """
+            Returns copy of cache counters.
+            """
+            with lock:
+                return dict(stats)
+
+        def invalidate():
+            """
+            Forgets cached value.
+            """
+            with lock:
+                function._cache.pop('data', None)
+
+        def refresh_now(*args, **kwargs):
+            """
+            Computes and caches new value.
+            """
+            with compute_lock:
+                return compute(args, kwargs)
+
+        inner.cache_info = cache_info
+        inner.invalidate = invalidate
+        inner.refresh = refresh_now
         return inner
     return wrap
 
 
-@cache(600)
+@cache(600, jitter=60, max_stale=1800)
+@timed('get_data_load')
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
 
-    It creates structure like this:
+    DATA_CSV may also be a directory or a glob pattern of many files,
+    which are parsed in DATA_PROCESSES processes (a single one by default,
+    None for as many as CPUs), see ingest.DatasetLoader.
+
+    Only lines appended to the file since the previous call are parsed,
+    unless the file was truncated or replaced. With DATA_SNAPSHOT enabled,
+    binary snapshot kept next to the file is used instead of parsing it
+    from scratch.
+
+    Data is kept by DATA_BACKEND storage backend: 'memory' (default),
+    'sqlite' or 'lazy', see backends.py.
+
+    It returns PresenceStore, which keeps entries in parallel integer
+    columns (or SQLiteStore or LazyStore with the same interface) and
+    still can be used like the old mapping:
     data = {
         'user_id': {
             datetime.date(2013, 10, 1): {
@@ -120,25 +519,73 @@ def get_data():
         }
     }
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    return backends[app.config.get('DATA_BACKEND', 'memory')].load(
+        app.config)
+
+
+def watched_paths():
+    """
+    Returns paths of DATA_CSV files, their directory when DATA_CSV is
+    a directory or a glob pattern, and USERS_XML.
+    """
+    pattern = app.config['DATA_CSV']
+    paths = data_files(pattern)
+    if paths != [pattern]:
+        paths.append(pattern if os.path.isdir(pattern)
+                     else os.path.dirname(pattern) or os.curdir)
+    return tuple(paths) + (app.config['USERS_XML'],)
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+def reload_changed(paths):
+    """
+    Loads changed DATA_CSV and USERS_XML files.
+    """
+    users_xml = os.path.abspath(app.config['USERS_XML'])
+    if paths - set([users_xml]):
+        get_data.refresh()
+    if users_xml in paths:
+        get_users_directory()
+
+
+def start_watching():
+    """
+    Starts watching DATA_CSV and USERS_XML, so they are loaded as soon as
+    they change instead of when get_data's cache expires, which remains
+    as a safety net. Changes are gathered for DATA_WATCH_DEBOUNCE seconds
+    (half a second by default).
+    """
+    paths = watched_paths()
+    with watchers_lock:
+        if paths in watchers:
+            return watchers[paths]
+        watchers[paths] = watch(
+            paths, reload_changed,
+            debounce=app.config.get('DATA_WATCH_DEBOUNCE', 0.5))
+        return watchers[paths]
+
+
+def stop_watching():
+    """
+    Stops all watchers started by start_watching.
+    """
+    with watchers_lock:
+        for watcher in watchers.values():
+            watcher.stop()
+        watchers.clear()
+
 
-    return data
+def iter_rows(items):
+    """
+    Yields (day ordinal, start seconds, end seconds) tuples of user entries.
+
+    Works both with UserPresence views and plain {date: {'start': time,
+    'end': time}} dictionaries.
+    """
+    if isinstance(items, UserPresence):
+        return items.rows()
+    return ((date.toordinal(), seconds_since_midnight(items[date]['start']),
+             seconds_since_midnight(items[date]['end']))
+            for date in items)
 
 
 def group_by_weekday(items):
@@ -146,10 +593,8 @@ def group_by_weekday(items):
     Groups presence entries by weekday.
     """
     result = {i: [] for i in range(7)}
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    for day, start, end in iter_rows(items):
+        result[weekday(day)].append(end - start)
     return result
 
 
@@ -174,6 +619,52 @@ def mean(items):
     return float(sum(items)) / len(items) if len(items) > 0 else 0
 
 
+def average(total, count):
+    """
+    Calculates arithmetic mean from sum and amount of items. Returns zero
+    when there are no items.
+    """
+    return float(total) / count if count > 0 else 0
+
+
+def mean_time_weekday(weekdays):
+    """
+    Formats mean presence time from list of seven WeekdayStats.
+    """
+    return [(calendar.day_abbr[weekday], average(stats.total, stats.count))
+            for weekday, stats in enumerate(weekdays)]
+
+
+def presence_weekday(weekdays):
+    """
+    Formats total presence time from list of seven WeekdayStats.
+    """
+    result = [(calendar.day_abbr[weekday], stats.total)
+              for weekday, stats in enumerate(weekdays)]
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def presence_start_end(weekdays):
+    """
+    Formats mean start and end times from list of seven WeekdayStats.
+    """
+    return [[calendar.day_abbr[weekday], average(stats.start, stats.count),
+             average(stats.end, stats.count)]
+            for weekday, stats in enumerate(weekdays)]
+
+
+def presence_start_end_percentiles(sketches):
+    """
+    Formats 10th, 50th and 90th percentile of start and end times from
+    list of seven (start, end) QuantileSketch pairs.
+    """
+    return [[calendar.day_abbr[weekday]] +
+            [sketch.quantile(fraction)
+             for sketch in (start, end) for fraction in PERCENTILES]
+            for weekday, (start, end) in enumerate(sketches)]
+
+
 def group_by_start_end(user):
     """
     Groups presence entries by weekday and start/end time.
@@ -187,10 +678,7 @@ def group_by_start_end(user):
     }
     """
     result = {i: {'start_list': [], 'end_list': []} for i in range(7)}
-    for date in user:
-        weekday = datetime.weekday(date)
-        start = seconds_since_midnight(user[date]['start'])
-        end = seconds_since_midnight(user[date]['end'])
-        result[weekday]['start_list'].append(start)
-        result[weekday]['end_list'].append(end)
+    for day, start, end in iter_rows(user):
+        result[weekday(day)]['start_list'].append(start)
+        result[weekday(day)]['end_list'].append(end)
     return result
@@ -3,19 +3,57 @@
 Defines views.
 """
 
-import calendar
 import locale
-from flask import redirect, render_template
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from flask import Response, abort, redirect, render_template, request
 
+from presence_analyzer import metrics
 from presence_analyzer.main import app
-from presence_analyzer.utils import (jsonify, get_data, mean, group_by_weekday,
-                                     group_by_start_end, get_users_from_xml)
+from presence_analyzer.aggregate import (group_weekday_stats,
+                                         group_weekday_sketches)
+from presence_analyzer.ingest import parse_day
+from presence_analyzer.utils import (jsonify, dumps, get_data, cache,
+                                     current_data,
+                                     get_users_from_xml, get_generation,
+                                     mean_time_weekday, presence_weekday,
+                                     presence_start_end,
+                                     presence_start_end_percentiles,
+                                     JSONBytes, backends, start_thread)
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
 locale.setlocale(locale.LC_COLLATE, 'pl_PL.UTF-8')
 
+# amount of rows encoded into a single piece of streamed export
+EXPORT_CHUNK = 1000
+
+# warm-up state reported by /health/ready; without WARMUP configured
+# nothing is preloaded and the application is ready from the start
+readiness_lock = threading.Lock()  # pylint: disable-msg=C0103
+readiness = {  # pylint: disable-msg=C0103
+    'state': 'ready',
+    'timings': OrderedDict(),
+    'error': None,
+}
+
+# seconds before failed warm-up is run again, doubled after every further
+# failure up to WARMUP_RETRY_MAX
+WARMUP_RETRY = 5
+WARMUP_RETRY_MAX = 300
+
+# statistics available in batch requests
+METRICS = {
+    'mean_time_weekday': mean_time_weekday,
+    'presence_weekday': presence_weekday,
+    'presence_start_end': presence_start_end,
+}
+
+metrics.init_app(app)
+
 
 @app.route('/')
 def mainpage():
@@ -49,19 +87,36 @@ def presence_start_end_page():
     return render_template('presence_start_end.html')
 
 
-@app.route('/api/v2/users', methods=['GET'])
-@jsonify
-def users_view_v2():
+@cache(3600, max_entries=4)
+def users_listing_v2(generation):  # pylint: disable-msg=W0613
     """
-    Users listing for dropdown, new api.
+    Encodes users listing sorted by name, once per data generation.
     """
-
     data = get_users_from_xml()
     result = [{'user_id': i, 'name': data[i]['name'],
               'avatar_url': data[i]['avatar_url']}
               for i in data.keys()]
-    result.sort(key=lambda user: user['name'], cmp=locale.strcoll)
-    return result
+    result.sort(key=lambda user: locale.strxfrm(user['name'].encode('utf-8')))
+    return JSONBytes(dumps(result))
+
+
+@cache(3600, max_entries=4)
+def users_listing(generation):  # pylint: disable-msg=W0613
+    """
+    Encodes users listing, once per data generation.
+    """
+    data = current_data()
+    return JSONBytes(dumps([{'user_id': i, 'name': 'User {0}'.format(str(i))}
+                            for i in data.keys()]))
+
+
+@app.route('/api/v2/users', methods=['GET'])
+@jsonify
+def users_view_v2():
+    """
+    Users listing for dropdown, new api.
+    """
+    return users_listing_v2(get_generation())
 
 
 @app.route('/api/v1/users', methods=['GET'])
@@ -70,9 +125,7 @@ def users_view():
     """
     Users listing for dropdown.
     """
-    data = get_data()
-    return [{'user_id': i, 'name': 'User {0}'.format(str(i))}
-            for i in data.keys()]
+    return users_listing(current_data().source)
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
@@ -80,17 +133,16 @@ def users_view():
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
+
+    Entries can be limited with 'from' and 'to' query parameters.
     """
-    data = get_data()
+    data = current_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], mean(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    return result
+    first, last = requested_range()
+    return mean_time_weekday(data.weekday_stats(user_id, first, last))
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
@@ -98,18 +150,16 @@ def mean_time_weekday_view(user_id):
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
+
+    Entries can be limited with 'from' and 'to' query parameters.
     """
-    data = get_data()
+    data = current_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], sum(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    first, last = requested_range()
+    return presence_weekday(data.weekday_stats(user_id, first, last))
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
@@ -117,17 +167,407 @@ def presence_weekday_view(user_id):
 def presence_start_end_view(user_id):
     """
     Returns presence average time.
+
+    Entries can be limited with 'from' and 'to' query parameters.
     """
-    data = get_data()
+    data = current_data()
+    if user_id not in data:
+        log.debug('User %s not found!', user_id)
+        return []
+
+    first, last = requested_range()
+    return presence_start_end(data.weekday_stats(user_id, first, last))
+
+
+@app.route('/api/v1/presence_start_end_percentiles/<int:user_id>',
+           methods=['GET'])
+@jsonify
+def presence_start_end_percentiles_view(user_id):
+    """
+    Returns 10th, 50th and 90th percentile of start and end times of given
+    user grouped by weekday.
+
+    Entries can be limited with 'from' and 'to' query parameters.
+    """
+    data = current_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_start_end(data[user_id])
-    result = []
+    first, last = requested_range()
+    return presence_start_end_percentiles(
+        data.weekday_sketches(user_id, first, last))
+
+
+@app.route('/api/v1/batch', methods=['GET'])
+@jsonify
+def batch_view():
+    """
+    Returns statistics of many users at once.
+
+    Query parameters:
+     - 'users': comma separated user ids, or 'all' (default),
+     - 'metrics': comma separated names of statistics (default all of
+       them, see METRICS),
+     - 'stream': when set, the document is streamed user by user,
+     - 'from' and 'to': optional date range, see requested_range.
+
+    It returns dictionary like this:
+    {"10": {"mean_time_weekday": [...], "presence_weekday": [...]}, ...}
+    Unknown users are left out.
+    """
+    data = current_data()
+    user_ids = requested_users()
+    if user_ids is None:
+        user_ids = list(data)
+    first, last = requested_range()
+    names = request.args.get('metrics')
+    names = names.split(',') if names else sorted(METRICS)
+    if any(name not in METRICS for name in names):
+        abort(400)
+
+    def results():
+        """
+        Yields (user_id, statistics) pairs in a single pass over users.
+        """
+        for user_id in user_ids:
+            if user_id not in data:
+                log.debug('User %s not found!', user_id)
+                continue
+            weekdays = data.weekday_stats(user_id, first, last)
+            yield str(user_id), dict((name, METRICS[name](weekdays))
+                                     for name in names)
+
+    if not request.args.get('stream'):
+        return dict(results())
+
+    def stream():
+        """
+        Encodes the document piece by piece.
+        """
+        yield '{'
+        for i, (user_id, result) in enumerate(results()):
+            yield '{0}{1}: {2}'.format(', ' if i else '', dumps(user_id),
+                                       dumps(result))
+        yield '}'
+    return Response(stream(), mimetype='application/json')
+
+
+def format_time(seconds):
+    """
+    Formats amount of seconds since midnight as HH:MM:SS.
+    """
+    return '{0:02d}:{1:02d}:{2:02d}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def export_rows(data, user_ids, first, last):
+    """
+    Yields (user_id, date, start, end, interval) rows of given users
+    within given day range, formatted as strings except the numbers.
+    """
+    days = {}
+    for user_id in user_ids:
+        if user_id not in data:
+            continue
+        for day, start, end in data[user_id].between(first, last).rows():
+            if day not in days:
+                days[day] = date.fromordinal(day).isoformat()
+            yield (user_id, days[day], format_time(start), format_time(end),
+                   end - start)
+
+
+def export_csv(rows):
+    """
+    Encodes rows as CSV lines, EXPORT_CHUNK rows per piece.
+    """
+    yield 'user_id,date,start,end,interval\r\n'
+    lines = []
+    for row in rows:
+        lines.append('%d,%s,%s,%s,%d\r\n' % row)
+        if len(lines) == EXPORT_CHUNK:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines)
+
+
+def export_ndjson(rows):
+    """
+    Encodes rows as JSON objects, one per line, EXPORT_CHUNK rows per
+    piece.
+    """
+    lines = []
+    for user_id, day, start, end, interval in rows:
+        lines.append(dumps({'user_id': user_id, 'date': day, 'start': start,
+                            'end': end, 'interval': interval}))
+        lines.append('\n')
+        if len(lines) == 2 * EXPORT_CHUNK:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines)
+
+
+# export formats: (encoder, mimetype)
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv'),
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+}
+
 
-    for (weekday, presence_dict) in weekdays.items():
-        start = mean(presence_dict['start_list'])
-        end = mean(presence_dict['end_list'])
-        result.append([calendar.day_abbr[weekday], start, end])
-    return result
+@app.route('/api/v1/export', methods=['GET'])
+def export_view():
+    """
+    Streams presence entries with their intervals (in seconds).
+
+    Query parameters:
+     - 'format': 'csv' (default) or 'ndjson', one JSON object per line,
+     - 'users': comma separated user ids, or 'all' (default),
+     - 'from' and 'to': optional date range, see requested_range.
+
+    Entries are encoded while they are sent, a chunk at a time.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    data = current_data()
+    user_ids = requested_users()
+    if user_ids is None:
+        user_ids = list(data)
+    first, last = requested_range()
+    encode, mimetype = EXPORT_FORMATS[export_format]
+    response = Response(encode(export_rows(data, user_ids, first, last)),
+                        mimetype=mimetype)
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=presence.{0}'.format(export_format)
+    return response
+
+
+@app.route('/api/v1/office/presence_start_end_percentiles', methods=['GET'],
+           defaults={'office': True})
+@app.route('/api/v1/group/presence_start_end_percentiles', methods=['GET'])
+@jsonify
+def group_percentiles_view(office=False):
+    """
+    Returns percentiles of start and end times of group of users taken
+    together, see group_view.
+    """
+    user_ids = None if office else requested_users()
+    first, last = requested_range()
+    return presence_start_end_percentiles(
+        group_weekday_sketches(current_data(), user_ids, first, last))
+
+
+@app.route('/api/v1/office/<metric>', methods=['GET'],
+           defaults={'office': True})
+@app.route('/api/v1/group/<metric>', methods=['GET'])
+@jsonify
+def group_view(metric, office=False):
+    """
+    Returns statistics of group of users taken together.
+
+    Group is given in 'users' query parameter as comma separated user ids,
+    or 'all' (default), which is what /api/v1/office/ returns. Unknown
+    users are left out. Entries can be limited to 'from' and 'to' dates.
+    """
+    if metric not in METRICS:
+        abort(404)
+    user_ids = None if office else requested_users()
+    first, last = requested_range()
+    return METRICS[metric](
+        group_weekday_stats(current_data(), user_ids, first, last))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns application metrics in Prometheus text format.
+    """
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def cache_events():
+    """
+    Returns counters of cached functions for the metrics endpoint.
+    """
+    events = {}
+    cached_functions = [get_data, users_listing, users_listing_v2]
+    if backends['lazy'].load_user is not None:
+        cached_functions.append(backends['lazy'].load_user)
+    for cached in cached_functions:
+        info = cached.cache_info()
+        for event in ('hits', 'stale_hits', 'misses', 'evictions'):
+            if event in info:
+                events[(cached.__name__, event)] = info[event]
+    return events
+
+
+metrics.Callback('presence_analyzer_cache_events_total',
+                 'Lookups of cached functions, by outcome.',
+                 ['cache', 'event'], cache_events, kind='counter')
+
+
+def warm_up_aggregates():
+    """
+    Computes aggregates of all users, unless the store computes them on
+    its own for every query.
+    """
+    data = get_data()
+    if not hasattr(data, 'group_weekday_stats'):
+        group_weekday_stats(data)
+        group_weekday_sketches(data)
+
+
+def warm_up_listings():
+    """
+    Encodes both users listings.
+    """
+    users_listing(get_data().source)
+    users_listing_v2(get_generation())
+
+
+# steps of warm-up, in order: (name, function)
+WARMUP_STEPS = (
+    ('data', get_data),
+    ('users_xml', get_users_from_xml),
+    ('aggregates', warm_up_aggregates),
+    ('users_listings', warm_up_listings),
+)
+
+
+def warm_up(retry=None):
+    """
+    Runs all warm-up steps, recording how long each of them took.
+
+    When a step fails, warm-up is run again after `retry` seconds
+    (WARMUP_RETRY by default) in a background thread, unless `retry` is
+    False.
+    """
+    retry = WARMUP_RETRY if retry is None else retry
+    total = 0.0
+    try:
+        for name, step in WARMUP_STEPS:
+            started = time.time()
+            step()
+            duration = time.time() - started
+            total += duration
+            with readiness_lock:
+                readiness['timings'][name] = duration
+    except Exception as error:  # pylint: disable-msg=W0703
+        with readiness_lock:
+            readiness['state'] = 'failed'
+            readiness['error'] = str(error)
+        if retry is False:
+            log.exception('Warm-up failed.')
+            return
+        log.exception('Warm-up failed, retrying in %ss.', retry)
+        start_thread(retry_warm_up, retry)
+        return
+    with readiness_lock:
+        readiness['state'] = 'ready'
+        readiness['error'] = None
+    log.info('Warm-up finished in %.3fs.', total)
+
+
+def retry_warm_up(retry):
+    """
+    Runs failed warm-up again after `retry` seconds, unless it was started
+    again meanwhile. Error of the previous attempt is reported until this
+    one finishes.
+    """
+    time.sleep(retry)
+    with readiness_lock:
+        if readiness['state'] != 'failed':
+            return
+        readiness['state'] = 'running'
+        readiness['timings'] = OrderedDict()
+    warm_up(min(retry * 2, WARMUP_RETRY_MAX))
+
+
+def start_warm_up(blocking=False, retry=True):
+    """
+    Loads data, users and aggregates before requests ask for them.
+
+    Warm-up runs in a background thread, unless `blocking` is set. Until
+    it finishes, /health/ready reports the application is not ready.
+    Warm-up already in progress is not started again. Failed warm-up is
+    retried, unless `retry` is False.
+    """
+    with readiness_lock:
+        if readiness['state'] == 'running':
+            return
+        readiness['state'] = 'running'
+        readiness['timings'] = OrderedDict()
+        readiness['error'] = None
+    if blocking:
+        warm_up(None if retry else False)
+    else:
+        start_thread(warm_up, None if retry else False)
+
+
+@app.route('/health/ready', methods=['GET'])
+def ready_view():
+    """
+    Tells whether the application finished warming up.
+
+    Answers with 200 once it is ready and 503 before that or when warm-up
+    failed (it is retried then), along with durations of warm-up steps (in
+    seconds). Without WARMUP configured it answers with 200 right away.
+    """
+    with readiness_lock:
+        status = {
+            'ready': readiness['state'] == 'ready',
+            'state': readiness['state'],
+            'timings': dict(readiness['timings']),
+        }
+        if readiness['error'] is not None:
+            status['error'] = readiness['error']
+    response = Response(dumps(status), mimetype='application/json',
+                        status=200 if status['ready'] else 503)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def warm_up_timings():
+    """
+    Returns durations of finished warm-up steps for the metrics endpoint.
+    """
+    with readiness_lock:
+        return dict(((name,), duration)
+                    for name, duration in readiness['timings'].iteritems())
+
+
+metrics.Callback('presence_analyzer_warmup_seconds',
+                 'Duration of warm-up steps.',
+                 ['step'], warm_up_timings, kind='gauge')
+
+
+def requested_users():
+    """
+    Returns list of user ids given in 'users' query parameter, or None
+    when all users are requested.
+    """
+    users = request.args.get('users', 'all')
+    if users == 'all':
+        return None
+    try:
+        return [int(user_id) for user_id in users.split(',')]
+    except ValueError:
+        abort(400)
+
+
+def requested_range():
+    """
+    Returns (first, last) day ordinals given in 'from' and 'to' query
+    parameters as YYYY-MM-DD dates, inclusive. Missing ones are None.
+    Range ending before it starts is a bad request.
+    """
+    try:
+        first, last = [parse_day(request.args[name])
+                       if request.args.get(name) else None
+                       for name in ('from', 'to')]
+    except ValueError:
+        abort(400)
+    if first is not None and last is not None and first > last:
+        abort(400)
+    return first, last
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Watching data files for changes.
+
+On Linux the directories of the files are watched with inotify, so
+changes are noticed as soon as they happen; elsewhere file identities are
+polled. Bursts of writes are debounced into a single notification.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# inotify constants, see <sys/inotify.h>
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_CLOEXEC = 0x80000
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE)
+EVENT = struct.Struct('iIII')
+
+
+def identity(path):
+    """
+    Returns (inode, size, modification time) of file, or None when it
+    does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+
+class Watcher(threading.Thread):
+    """
+    Thread calling callback with set of changed paths once they stop
+    changing for `debounce` seconds, but at least every `max_delay`
+    seconds while they keep changing.
+    """
+
+    def __init__(self, paths, callback, debounce=0.5, max_delay=5.0):
+        super(Watcher, self).__init__(name='watcher')
+        self.daemon = True
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.callback = callback
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.stopped = threading.Event()
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds (forever for None) and returns set of
+        paths which changed in the meantime.
+        """
+        raise NotImplementedError
+
+    def run(self):
+        pending = set()
+        first = deadline = None
+        while not self.stopped.is_set():
+            timeout = None if deadline is None else \
+                max(deadline - time.time(), 0)
+            changed = self.wait(timeout)
+            if self.stopped.is_set():
+                break
+            now = time.time()
+            if changed:
+                if not pending:
+                    first = now
+                pending |= changed
+                deadline = min(now + self.debounce, first + self.max_delay)
+            elif deadline is not None and now >= deadline:
+                self.notify(pending)
+                pending = set()
+                deadline = None
+
+    def notify(self, paths):
+        """
+        Calls callback with changed paths, logging its failures.
+        """
+        log.debug('Changed: %s', ', '.join(sorted(paths)))
+        try:
+            self.callback(paths)
+        except Exception:  # pylint: disable-msg=W0703
+            log.exception('Handling changes of %s failed.', paths)
+
+    def stop(self):
+        """
+        Stops watching.
+        """
+        self.stopped.set()
+
+
+class PollingWatcher(Watcher):
+    """
+    Watcher comparing file identities every `interval` seconds. Watched
+    directories change when their files are added or removed.
+    """
+
+    def __init__(self, paths, callback, interval=2.0, **kwargs):
+        super(PollingWatcher, self).__init__(paths, callback, **kwargs)
+        self.interval = interval
+        self.identities = dict((path, identity(path)) for path in self.paths)
+
+    def wait(self, timeout):
+        self.stopped.wait(self.interval if timeout is None
+                          else min(timeout, self.interval))
+        changed = set()
+        for path in self.paths:
+            current = identity(path)
+            if current != self.identities[path]:
+                self.identities[path] = current
+                changed.add(path)
+        return changed
+
+
+class InotifyWatcher(Watcher):
+    """
+    Watcher using inotify on directories of the files, which also notices
+    files replaced by rename. Watched directories change whenever any of
+    their files does.
+
+    Raises OSError when inotify is not available.
+    """
+
+    def __init__(self, paths, callback, **kwargs):
+        super(InotifyWatcher, self).__init__(paths, callback, **kwargs)
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            init = libc.inotify_init1
+            add_watch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = init(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.wake_read, self.wake_write = os.pipe()
+        self.closed = False
+        self.directories = {}
+        for path in self.paths:
+            directories = [os.path.dirname(path)]
+            if os.path.isdir(path):
+                directories.append(path)
+            for directory in directories:
+                if directory in self.directories.values():
+                    continue
+                descriptor = add_watch(self.fd, directory, WATCH_MASK)
+                if descriptor < 0:
+                    self.close()
+                    raise OSError(ctypes.get_errno(),
+                                  'Can not watch {0}'.format(directory))
+                self.directories[descriptor] = directory
+
+    def wait(self, timeout):
+        try:
+            readable = select.select([self.fd, self.wake_read], [], [],
+                                     timeout)[0]
+        except select.error as error:
+            if error.args[0] == errno.EINTR:
+                return set()
+            raise
+        if self.fd not in readable:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            descriptor, _, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if descriptor not in self.directories:
+                continue
+            directory = self.directories[descriptor]
+            if directory in self.paths:
+                changed.add(directory)
+            path = os.path.join(directory, name)
+            if path in self.paths:
+                changed.add(path)
+        return changed
+
+    def stop(self):
+        super(InotifyWatcher, self).stop()
+        try:
+            os.write(self.wake_write, 'x')
+        except OSError:
+            # already closed
+            pass
+
+    def run(self):
+        try:
+            super(InotifyWatcher, self).run()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Releases file descriptors.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for descriptor in (self.fd, self.wake_read, self.wake_write):
+            os.close(descriptor)
+
+
+def watch(paths, callback, debounce=0.5, interval=2.0):
+    """
+    Starts and returns watcher of given files, inotify one when possible.
+    """
+    try:
+        watcher = InotifyWatcher(paths, callback, debounce=debounce)
+    except OSError:
+        log.info('Can not use inotify, polling files.', exc_info=True)
+        watcher = PollingWatcher(paths, callback, interval=interval,
+                                 debounce=debounce)
+    watcher.start()
+    return watcher